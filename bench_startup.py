@@ -0,0 +1,80 @@
+"""
+Startup benchmark: time to import the fitting modules in a fresh interpreter.
+
+Workers only import zpfeval; the client imports paramselect. Each module is imported
+in a new process several times and the median is reported, so results can be tracked
+across changes (use --record to append them to a CSV file).
+"""
+import os
+import sys
+import csv
+import argparse
+import subprocess
+from datetime import datetime
+import numpy as np
+
+parser = argparse.ArgumentParser(description=__doc__)
+
+parser.add_argument(
+    "modules",
+    metavar="MODULE",
+    nargs="*",
+    default=["zpfeval", "paramselect"],
+    help="Modules to import (default: zpfeval paramselect)")
+
+parser.add_argument(
+    "--repeat",
+    metavar="N",
+    type=int,
+    default=5,
+    help="Number of fresh interpreters per module")
+
+parser.add_argument(
+    "--record",
+    metavar="FILE",
+    default=None,
+    help="Append results to this CSV file")
+
+IMPORT_TEMPLATE = """
+import sys, time
+start = time.time()
+import {0}
+elapsed = time.time() - start
+print(elapsed, len(sys.modules), int('matplotlib' in sys.modules), int('sklearn' in sys.modules))
+"""
+
+
+def time_import(module):
+    """
+    Import a module in a new interpreter.
+
+    Returns
+    =======
+    (seconds, number of loaded modules, matplotlib loaded, sklearn loaded)
+    """
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_TEMPLATE.format(module)],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    elapsed, num_modules, matplotlib, sklearn = output.decode('utf-8').split()
+    return float(elapsed), int(num_modules), bool(int(matplotlib)), bool(int(sklearn))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args(sys.argv[1:])
+    rows = []
+    for module in args.modules:
+        results = [time_import(module) for _ in range(args.repeat)]
+        times = [result[0] for result in results]
+        _, num_modules, matplotlib, sklearn = results[-1]
+        print('{}: median {:.3f} s, min {:.3f} s, {} modules loaded, matplotlib {}, sklearn {}'.format(
+            module, np.median(times), np.min(times), num_modules,
+            'loaded' if matplotlib else 'not loaded', 'loaded' if sklearn else 'not loaded'))
+        rows.append([datetime.utcnow().isoformat(), module, np.median(times), np.min(times), num_modules,
+                     int(matplotlib), int(sklearn)])
+    if args.record:
+        write_header = not os.path.exists(args.record)
+        with open(args.record, 'a') as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(['time', 'module', 'median_seconds', 'min_seconds', 'modules_loaded',
+                                 'matplotlib', 'sklearn'])
+            writer.writerows(rows)
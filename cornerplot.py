@@ -0,0 +1,132 @@
+"""
+The cornerplot module draws corner plots of MCMC traces from binned counts instead of samples.
+
+Histograms are accumulated one block of samples at a time, so the cost of accumulating is
+linear in the trace length and the cost of rendering depends only on the number of
+parameters and bins.
+"""
+import numpy as np
+import matplotlib.pyplot as plt
+
+
+class CornerHistogram(object):
+    """
+    One-dimensional and pairwise two-dimensional histograms of P parameters.
+
+    Parameters
+    ==========
+    ranges : array_like (P, 2)
+        Lower and upper bin edges for each parameter. Samples outside are clipped to the edge bins.
+    bins : int, optional
+    pair_batch : int, optional
+        Number of parameter pairs binned together in one vectorized call.
+    """
+    def __init__(self, ranges, bins=50, pair_batch=64):
+        self.ranges = np.array(ranges, dtype=np.float64)
+        num_params = self.ranges.shape[0]
+        # Degenerate ranges (constant parameters) would give zero-width bins
+        degenerate = ~(self.ranges[:, 1] > self.ranges[:, 0])
+        self.ranges[degenerate] += np.array([-0.5, 0.5])
+        self.bins = bins
+        self.pair_batch = pair_batch
+        self.count = 0
+        self.counts_1d = np.zeros((num_params, bins))
+        self.pairs = np.array([(i, j) for i in range(num_params) for j in range(i)], dtype=np.int64).reshape(-1, 2)
+        self.counts_2d = np.zeros((len(self.pairs), bins, bins))
+
+    def edges(self, param_idx):
+        return np.linspace(self.ranges[param_idx, 0], self.ranges[param_idx, 1], self.bins + 1)
+
+    def update(self, block):
+        """
+        Parameters
+        ==========
+        block : array_like (N, P)
+        """
+        block = np.asarray(block, dtype=np.float64)
+        if block.shape[0] == 0:
+            return
+        self.count += block.shape[0]
+        # Digitize each column once; every pair then reuses the bin indices
+        scaled = (block - self.ranges[:, 0]) / (self.ranges[:, 1] - self.ranges[:, 0])
+        indices = np.clip((scaled * self.bins).astype(np.int64), 0, self.bins - 1)
+        num_params = block.shape[1]
+        offsets = np.arange(num_params) * self.bins
+        self.counts_1d += np.bincount((indices + offsets).ravel(),
+                                      minlength=num_params * self.bins).reshape(num_params, self.bins)
+        bins_2d = self.bins * self.bins
+        for start in range(0, len(self.pairs), self.pair_batch):
+            pairs = self.pairs[start:start+self.pair_batch]
+            flat = (indices[:, pairs[:, 0]] * self.bins + indices[:, pairs[:, 1]]
+                    + np.arange(len(pairs)) * bins_2d)
+            self.counts_2d[start:start+len(pairs)] += np.bincount(
+                flat.ravel(), minlength=len(pairs) * bins_2d).reshape(len(pairs), self.bins, self.bins)
+
+    def quantile(self, param_idx, q):
+        "Quantile of one parameter, interpolated within bins."
+        cumulative = np.concatenate([[0], np.cumsum(self.counts_1d[param_idx])])
+        return np.interp(np.asarray(q) * cumulative[-1], cumulative, self.edges(param_idx))
+
+
+def binned_corner(hist, labels, quantiles=(0.16, 0.5, 0.84), truths=None, show_titles=True, title_kwargs=None):
+    """
+    Draw a corner plot from a CornerHistogram.
+
+    Parameters
+    ==========
+    hist : CornerHistogram
+    labels : list of str
+    quantiles : sequence of float, optional
+        Quantiles marked with dashed lines on the one-dimensional histograms.
+    truths : list, optional
+        Reference values, or None for parameters without one.
+    show_titles : bool, optional
+        Title each one-dimensional histogram with the median and the quantile range.
+    title_kwargs : dict, optional
+
+    Returns
+    =======
+    matplotlib.figure.Figure
+    """
+    num_params = len(labels)
+    truths = truths if truths is not None else [None] * num_params
+    title_kwargs = title_kwargs or {}
+    figure, axes = plt.subplots(num_params, num_params, squeeze=False,
+                                figsize=(2.5 * num_params, 2.5 * num_params))
+    pair_index = {(i, j): idx for idx, (i, j) in enumerate(hist.pairs)}
+    for i in range(num_params):
+        edges_i = hist.edges(i)
+        for j in range(num_params):
+            ax = axes[i, j]
+            if j > i:
+                ax.set_visible(False)
+                continue
+            if i == j:
+                ax.step(edges_i[:-1], hist.counts_1d[i], where='post', color='k')
+                for q in hist.quantile(i, quantiles):
+                    ax.axvline(q, color='k', linestyle='dashed')
+                if truths[i] is not None:
+                    ax.axvline(truths[i], color='#4682b4')
+                if show_titles:
+                    low, median, high = hist.quantile(i, [quantiles[0], 0.5, quantiles[-1]])
+                    ax.set_title('{0} = {1:.3g} (+{2:.2g}/-{3:.2g})'.format(labels[i], median, high - median,
+                                                                             median - low), **title_kwargs)
+                ax.set_yticklabels([])
+                ax.set_xlim(edges_i[0], edges_i[-1])
+            else:
+                edges_j = hist.edges(j)
+                ax.pcolormesh(edges_j, edges_i, hist.counts_2d[pair_index[(i, j)]], cmap='Greys', rasterized=True)
+                if truths[j] is not None:
+                    ax.axvline(truths[j], color='#4682b4')
+                if truths[i] is not None:
+                    ax.axhline(truths[i], color='#4682b4')
+                if j == 0:
+                    ax.set_ylabel(labels[i])
+                else:
+                    ax.set_yticklabels([])
+            if i == num_params - 1:
+                ax.set_xlabel(labels[j])
+            else:
+                ax.set_xticklabels([])
+    figure.subplots_adjust(wspace=0.05, hspace=0.05)
+    return figure
@@ -0,0 +1,328 @@
+"""
+The diagnostics module computes convergence diagnostics for MCMC traces.
+
+All functions operate on NumPy arrays so they can be used on traces from any backend.
+"""
+import numpy as np
+
+
+def gelman_rubin(chains):
+    """
+    Potential scale reduction factor (R-hat) for several independent chains.
+
+    Parameters
+    ==========
+    chains : array_like (M, N) or (M, N, P)
+        M chains of N samples each, for one parameter or P parameters.
+
+    Returns
+    =======
+    float or ndarray (P,)
+        Values close to 1 indicate the chains have mixed.
+    """
+    chains = np.asarray(chains, dtype=np.float64)
+    num_chains, num_samples = chains.shape[:2]
+    if num_chains < 2:
+        raise ValueError('At least two chains are required to compute R-hat')
+    chain_means = chains.mean(axis=1)
+    # Between-chain and within-chain variances
+    between = num_samples * chain_means.var(axis=0, ddof=1)
+    within = chains.var(axis=1, ddof=1).mean(axis=0)
+    pooled = (num_samples - 1) / num_samples * within + between / num_samples
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt(pooled / within)
+
+
+def split_gelman_rubin(chains):
+    """
+    R-hat computed after splitting each chain into halves, which also detects trends within a chain.
+    Works with a single chain.
+
+    Parameters
+    ==========
+    chains : array_like (M, N) or (M, N, P)
+
+    Returns
+    =======
+    float or ndarray (P,)
+    """
+    chains = np.asarray(chains, dtype=np.float64)
+    half = chains.shape[1] // 2
+    return gelman_rubin(np.concatenate([chains[:, :half], chains[:, half:2*half]], axis=0))
+
+
+def acceptance_rate(x):
+    """
+    Fraction of steps where a Metropolis trace moved.
+
+    Parameters
+    ==========
+    x : array_like (N,) or (N, P)
+
+    Returns
+    =======
+    float or ndarray (P,)
+    """
+    x = np.asarray(x)
+    if x.shape[0] < 2:
+        return np.full(x.shape[1:], np.nan) if x.ndim > 1 else np.nan
+    return np.mean(x[1:] != x[:-1], axis=0)
+
+
+def autocorrelation(x):
+    """
+    Normalized autocorrelation function, computed with FFTs.
+
+    Parameters
+    ==========
+    x : array_like (N,) or (N, P)
+        One trace, or P traces as columns.
+
+    Returns
+    =======
+    ndarray, same shape as 'x'
+        Autocorrelation at lags 0 to N-1, with the value at lag 0 equal to one.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    num_samples = x.shape[0]
+    x = x - x.mean(axis=0)
+    # Zero-pad to avoid circular correlation
+    fft_size = 2 ** int(np.ceil(np.log2(2 * num_samples)))
+    transformed = np.fft.rfft(x, n=fft_size, axis=0)
+    acf = np.fft.irfft(transformed * np.conjugate(transformed), n=fft_size, axis=0)[:num_samples]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return acf / acf[:1]
+
+
+def integrated_autocorrelation_time(x, c=5.0):
+    """
+    Integrated autocorrelation time, using the automatic window of Sokal (1997):
+    the smallest window M with M >= c * tau(M).
+
+    Parameters
+    ==========
+    x : array_like (N,) or (N, P)
+    c : float, optional
+        Window size factor. Larger is more conservative.
+
+    Returns
+    =======
+    float or ndarray (P,)
+    """
+    return iat_from_acf(autocorrelation(x), c=c)
+
+
+def iat_from_acf(acf, c=5.0):
+    """
+    Integrated autocorrelation time from an autocorrelation function already computed with `autocorrelation`.
+
+    Parameters
+    ==========
+    acf : array_like (N,) or (N, P)
+    c : float, optional
+        See integrated_autocorrelation_time.
+
+    Returns
+    =======
+    float or ndarray (P,)
+    """
+    acf = np.asarray(acf)
+    one_dim = acf.ndim == 1
+    if one_dim:
+        acf = acf[:, None]
+    taus = 2 * np.cumsum(acf, axis=0) - 1
+    lags = np.arange(taus.shape[0])[:, None]
+    within_window = lags < c * taus
+    # First lag where the window condition holds; last lag if it never does
+    window = np.where(np.any(~within_window, axis=0), np.argmin(within_window, axis=0), taus.shape[0] - 1)
+    result = taus[window, np.arange(taus.shape[1])]
+    return result[0] if one_dim else result
+
+
+def effective_sample_size(x, c=5.0):
+    """
+    Number of samples divided by the integrated autocorrelation time.
+
+    Parameters
+    ==========
+    x : array_like (N,) or (N, P)
+    c : float, optional
+        See integrated_autocorrelation_time.
+
+    Returns
+    =======
+    float or ndarray (P,)
+    """
+    x = np.asarray(x)
+    return x.shape[0] / integrated_autocorrelation_time(x, c=c)
+
+
+class QuantileSketch(object):
+    """
+    Mergeable quantile sketch with bounded memory (a simplified KLL sketch).
+
+    Items are kept in levels of compactors. When a level is full it is sorted and every other item,
+    starting at a random offset, is promoted to the next level with twice the weight.
+
+    Parameters
+    ==========
+    k : int, optional
+        Capacity of each level. Rank error is roughly proportional to 1/k.
+    random_state : numpy.random.RandomState, optional
+    """
+    def __init__(self, k=256, random_state=None):
+        self.k = k
+        self.count = 0
+        self.levels = [np.zeros(0)]
+        self.random_state = random_state if random_state is not None else np.random.RandomState(0)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other):
+        self.count += other.count
+        for level_idx, items in enumerate(other.levels):
+            if level_idx >= len(self.levels):
+                self.levels.append(np.zeros(0))
+            self.levels[level_idx] = np.concatenate([self.levels[level_idx], items])
+        self._compress()
+
+    def _compress(self):
+        level_idx = 0
+        while level_idx < len(self.levels):
+            items = self.levels[level_idx]
+            if len(items) > self.k:
+                items = np.sort(items)
+                # Keep an even number of items to compact; carry the remainder
+                num_compact = len(items) - (len(items) % 2)
+                promoted = items[self.random_state.randint(2):num_compact:2]
+                self.levels[level_idx] = items[num_compact:]
+                if level_idx + 1 == len(self.levels):
+                    self.levels.append(np.zeros(0))
+                self.levels[level_idx + 1] = np.concatenate([self.levels[level_idx + 1], promoted])
+            level_idx += 1
+
+    def weighted_items(self):
+        "Sorted values and their cumulative weights."
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2.0 ** idx) for idx, items in enumerate(self.levels)])
+        order = np.argsort(values, kind='mergesort')
+        return values[order], np.cumsum(weights[order])
+
+    def quantile(self, q):
+        """
+        Parameters
+        ==========
+        q : float or array_like
+            Quantiles in [0, 1].
+        """
+        values, cumulative = self.weighted_items()
+        if len(values) == 0:
+            return np.full(np.shape(q), np.nan)
+        ranks = np.asarray(q) * cumulative[-1]
+        return values[np.minimum(np.searchsorted(cumulative, ranks), len(values) - 1)]
+
+    def hpd(self, alpha=0.05):
+        """
+        Approximate highest posterior density interval: the narrowest interval containing 1-alpha of the weight.
+
+        Returns
+        =======
+        (lower, upper)
+        """
+        values, cumulative = self.weighted_items()
+        if len(values) == 0:
+            return np.nan, np.nan
+        mass = (1 - alpha) * cumulative[-1]
+        starts_below = np.concatenate([[0], cumulative[:-1]])
+        ends = np.searchsorted(cumulative, starts_below + mass)
+        valid = ends < len(values)
+        if not np.any(valid):
+            return values[0], values[-1]
+        widths = np.where(valid, values[np.minimum(ends, len(values) - 1)] - values, np.inf)
+        best = np.argmin(widths)
+        return values[best], values[ends[best]]
+
+
+class StreamingSummary(object):
+    """
+    Single-pass summary statistics for P parameters, updated one chunk of samples at a time.
+    Memory use does not depend on the number of samples.
+
+    Parameters
+    ==========
+    num_params : int
+    total_samples : int
+        Total number of samples which will be passed to `update`. Needed to size the batches
+        for the batch-means Monte Carlo error.
+    batches : int, optional
+        Number of batches for the batch-means Monte Carlo error.
+    sketch_size : int, optional
+        Capacity of each level of the quantile sketches.
+    """
+    def __init__(self, num_params, total_samples, batches=100, sketch_size=256):
+        self.count = 0
+        self.mean = np.zeros(num_params)
+        self._m2 = np.zeros(num_params)
+        self.batches = max(min(batches, total_samples), 1)
+        self.batch_size = max(total_samples // self.batches, 1)
+        self._batch_sums = np.zeros((self.batches, num_params))
+        self.sketches = [QuantileSketch(k=sketch_size) for _ in range(num_params)]
+
+    def update(self, block):
+        """
+        Parameters
+        ==========
+        block : array_like (N, P)
+            Consecutive samples, continuing from the previous call.
+        """
+        block = np.asarray(block, dtype=np.float64)
+        num = block.shape[0]
+        if num == 0:
+            return
+        # Chan et al. parallel update of mean and sum of squared deviations
+        block_mean = block.mean(axis=0)
+        block_m2 = np.square(block - block_mean).sum(axis=0)
+        delta = block_mean - self.mean
+        total = self.count + num
+        self.mean = self.mean + delta * num / total
+        self._m2 = self._m2 + block_m2 + np.square(delta) * self.count * num / total
+        # Samples past batches * batch_size are excluded, as in pymc's batchsd
+        batch_ids = np.arange(self.count, total) // self.batch_size
+        in_batch = batch_ids < self.batches
+        np.add.at(self._batch_sums, batch_ids[in_batch], block[in_batch])
+        self.count = total
+        for sketch, column in zip(self.sketches, block.T):
+            sketch.update(column)
+
+    @property
+    def std(self):
+        return np.sqrt(self._m2 / max(self.count, 1))
+
+    @property
+    def mc_error(self):
+        "Batch-means estimate of the Monte Carlo standard error of the mean."
+        if self.batches == 1:
+            return self.std / np.sqrt(max(self.count, 1))
+        batch_means = self._batch_sums / self.batch_size
+        return batch_means.std(axis=0) / np.sqrt(self.batches)
+
+    def quantiles(self, qlist):
+        """
+        Parameters
+        ==========
+        qlist : sequence of float
+            Percentiles in [0, 100].
+
+        Returns
+        =======
+        ndarray (P, len(qlist))
+        """
+        return np.array([sketch.quantile(np.asarray(qlist) / 100.) for sketch in self.sketches])
+
+    def hpd(self, alpha=0.05):
+        "ndarray (P, 2) of approximate HPD interval bounds."
+        return np.array([sketch.hpd(alpha) for sketch in self.sketches])
@@ -0,0 +1,165 @@
+"""
+The ensemble module implements an affine-invariant ensemble MCMC sampler (the "stretch move"
+of Goodman and Weare, 2010).
+
+Walkers are split into two halves. Moves for every walker in one half are proposed using
+the positions of the other half, so all proposals in a half are independent and their
+log-probabilities can be evaluated together as a single batch.
+"""
+import csv
+import os
+import numpy as np
+
+
+class ChainStore(object):
+    """
+    Append-only CSV store of walker positions, one row per walker per iteration.
+    Rows are flushed after every iteration, so an interrupted run can be resumed
+    from the last complete iteration.
+
+    Parameters
+    ==========
+    fname : str
+    names : list of str
+        Parameter names, in the order of the position vectors.
+    """
+    def __init__(self, fname, names):
+        self.fname = fname
+        self.names = list(names)
+
+    def load(self, nwalkers):
+        """
+        Read the last complete iteration.
+
+        Returns
+        =======
+        (iteration, positions, log_probs), or None if there is nothing to resume
+        """
+        if not os.path.exists(self.fname):
+            return None
+        last = {}
+        with open(self.fname) as csvfile:
+            reader = csv.reader(csvfile)
+            header = next(reader, None)
+            if header is None:
+                return None
+            if header[3:] != self.names:
+                raise ValueError('Parameters in {} do not match the parameters being fit'.format(self.fname))
+            for row in reader:
+                if len(row) != len(header):
+                    # Partially written row from an interrupted run
+                    continue
+                iteration, walker = int(row[0]), int(row[1])
+                last.setdefault(iteration, {})[walker] = (float(row[2]), [float(x) for x in row[3:]])
+        complete = [it for it, walkers in last.items() if len(walkers) == nwalkers]
+        if len(complete) == 0:
+            return None
+        iteration = max(complete)
+        walkers = last[iteration]
+        positions = np.array([walkers[k][1] for k in range(nwalkers)])
+        log_probs = np.array([walkers[k][0] for k in range(nwalkers)])
+        return iteration, positions, log_probs
+
+    def append(self, iteration, positions, log_probs):
+        new_file = not os.path.exists(self.fname) or os.path.getsize(self.fname) == 0
+        with open(self.fname, 'a') as csvfile:
+            writer = csv.writer(csvfile)
+            if new_file:
+                writer.writerow(['iteration', 'walker', 'lnprob'] + self.names)
+            for walker, (position, log_prob) in enumerate(zip(positions, log_probs)):
+                writer.writerow([iteration, walker, repr(float(log_prob))] + [repr(float(x)) for x in position])
+
+
+class EnsembleSampler(object):
+    """
+    Affine-invariant ensemble sampler with batched log-probability evaluations.
+
+    Parameters
+    ==========
+    log_prob_batch : callable
+        Maps an array of positions (K, ndim) to an array of log-probabilities (K,).
+    nwalkers : int
+        Number of walkers. Must be even and greater than twice the number of dimensions
+        for the ensemble to span the parameter space.
+    a : float, optional
+        Scale of the stretch move.
+    store : ChainStore, optional
+        If specified, positions are appended to it after each iteration and
+        `run` resumes from its last complete iteration.
+    random_state : numpy.random.RandomState, optional
+
+    Attributes
+    ==========
+    chain : ndarray (iterations, nwalkers, ndim)
+        Positions sampled during the most recent call to `run`.
+    lnprob : ndarray (iterations, nwalkers)
+    acceptance_fraction : ndarray (nwalkers,)
+    """
+    def __init__(self, log_prob_batch, nwalkers, a=2.0, store=None, random_state=None):
+        if nwalkers % 2 != 0:
+            raise ValueError('Number of walkers must be even')
+        self.log_prob_batch = log_prob_batch
+        self.nwalkers = nwalkers
+        self.a = a
+        self.store = store
+        self.random_state = random_state if random_state is not None else np.random.RandomState()
+        self.chain = None
+        self.lnprob = None
+        self.acceptance_fraction = np.zeros(nwalkers)
+
+    def _stretch(self, positions, log_probs, active, complement):
+        ndim = positions.shape[-1]
+        num_active = len(active)
+        # z is distributed as 1/sqrt(z) on [1/a, a]
+        z = ((self.a - 1) * self.random_state.uniform(size=num_active) + 1) ** 2 / self.a
+        partners = positions[complement[self.random_state.randint(len(complement), size=num_active)]]
+        proposals = partners + z[:, None] * (positions[active] - partners)
+        new_log_probs = np.asarray(self.log_prob_batch(proposals), dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            log_accept = (ndim - 1) * np.log(z) + new_log_probs - log_probs[active]
+        accepted = np.log(self.random_state.uniform(size=num_active)) < log_accept
+        positions[active[accepted]] = proposals[accepted]
+        log_probs[active[accepted]] = new_log_probs[accepted]
+        return accepted
+
+    def run(self, initial_positions, iterations):
+        """
+        Advance the ensemble.
+
+        Parameters
+        ==========
+        initial_positions : ndarray (nwalkers, ndim)
+            Ignored if resuming from the chain store.
+        iterations : int
+            Total number of iterations, including any already in the chain store.
+
+        Returns
+        =======
+        positions : ndarray (nwalkers, ndim)
+            Final walker positions.
+        """
+        start_iteration = 0
+        resumed = self.store.load(self.nwalkers) if self.store is not None else None
+        if resumed is not None:
+            start_iteration, positions, log_probs = resumed
+            start_iteration += 1
+            print('RESUMING ENSEMBLE AT ITERATION', start_iteration)
+        else:
+            positions = np.array(initial_positions, dtype=np.float64)
+            if positions.shape[0] != self.nwalkers:
+                raise ValueError('Expected {} initial positions, got {}'.format(self.nwalkers, positions.shape[0]))
+            log_probs = np.asarray(self.log_prob_batch(positions), dtype=np.float64)
+        halves = (np.arange(0, self.nwalkers // 2), np.arange(self.nwalkers // 2, self.nwalkers))
+        num_iterations = max(iterations - start_iteration, 0)
+        self.chain = np.empty((num_iterations,) + positions.shape)
+        self.lnprob = np.empty((num_iterations, self.nwalkers))
+        accepted = np.zeros(self.nwalkers)
+        for idx, iteration in enumerate(range(start_iteration, iterations)):
+            for active, complement in (halves, halves[::-1]):
+                accepted[active] += self._stretch(positions, log_probs, active, complement)
+            self.chain[idx] = positions
+            self.lnprob[idx] = log_probs
+            if self.store is not None:
+                self.store.append(iteration, positions, log_probs)
+        self.acceptance_fraction = accepted / max(num_iterations, 1)
+        return positions
@@ -7,7 +7,8 @@ import fnmatch
 import argparse
 import logging
 import multiprocessing
-from paramselect import fit, load_datasets
+from paramselect import fit, load_datasets, ObjectiveCache
+from instrumentation import registry as timing_registry, fit_metrics, start_metrics_server
 from distributed import Client, LocalCluster
 
 parser = argparse.ArgumentParser(description=__doc__)
@@ -40,6 +41,125 @@ parser.add_argument(
     default="out.tdb",
     help="Output TDB file")
 
+parser.add_argument(
+    "--timing-report",
+    metavar="FILE",
+    default=None,
+    help="Output file for per-call timing statistics, broken down by phase, dataset and region (CSV)")
+
+parser.add_argument(
+    "--metrics-port",
+    metavar="PORT",
+    type=int,
+    default=None,
+    help="Serve Prometheus-style fit metrics over HTTP on this port (e.g., 9786)")
+
+parser.add_argument(
+    "--cache-size",
+    metavar="N",
+    type=int,
+    default=1024,
+    help="Number of objective evaluations to memoize, keyed by parameter vector (0 disables)")
+
+parser.add_argument(
+    "--cache-file",
+    metavar="FILE",
+    default=None,
+    help="Persistent store for memoized objective evaluations, reused across runs")
+
+parser.add_argument(
+    "--mcmc-chains",
+    metavar="N",
+    type=int,
+    default=0,
+    help="After finding the MAP estimate, sample the posterior with N concurrent chains (default: no sampling)")
+
+parser.add_argument(
+    "--mcmc-walkers",
+    metavar="N",
+    type=int,
+    default=0,
+    help="After finding the MAP estimate, sample the posterior with an ensemble sampler of N walkers "
+         "(default: no sampling). Cannot be combined with --mcmc-chains")
+
+parser.add_argument(
+    "--mcmc-iter",
+    metavar="N",
+    type=int,
+    default=1000,
+    help="Number of MCMC iterations per chain")
+
+parser.add_argument(
+    "--mcmc-burn",
+    metavar="N",
+    type=int,
+    default=0,
+    help="Number of MCMC iterations to discard as burn-in")
+
+parser.add_argument(
+    "--mcmc-thin",
+    metavar="N",
+    type=int,
+    default=1,
+    help="Keep every Nth MCMC sample")
+
+parser.add_argument(
+    "--trace-path",
+    metavar="DIR",
+    default="traces",
+    help="Output directory for MCMC traces, one file per chain")
+
+parser.add_argument(
+    "--screen-trajectories",
+    metavar="N",
+    type=int,
+    default=0,
+    help="Before optimizing, screen parameters with N Morris trajectories and freeze the inert ones "
+         "(default: no screening)")
+
+parser.add_argument(
+    "--screen-threshold",
+    metavar="F",
+    type=float,
+    default=0.01,
+    help="Freeze parameters whose Morris effects are below this fraction of the largest effect")
+
+parser.add_argument(
+    "--screen-report",
+    metavar="FILE",
+    default="screening.csv",
+    help="Output CSV file ranking parameters by screening influence")
+
+parser.add_argument(
+    "--surrogate-evaluations",
+    metavar="N",
+    type=int,
+    default=0,
+    help="Find the MAP estimate with a surrogate-assisted trust region method using at most N objective "
+         "evaluations, instead of pymc.MAP (default: pymc.MAP)")
+
+parser.add_argument(
+    "--surrogate-history",
+    metavar="FILE",
+    default=None,
+    help="Iteration log from previous runs used to seed the surrogate model")
+
+parser.add_argument(
+    "--minibatch-fractions",
+    metavar="F",
+    type=float,
+    nargs="+",
+    default=None,
+    help="Optimize in stages on stratified random subsets of the ZPF tie-lines of these sizes, "
+         "finishing on all tie-lines, e.g., 0.1 0.3 (default: all tie-lines throughout)")
+
+parser.add_argument(
+    "--minibatch-seed",
+    metavar="N",
+    type=int,
+    default=0,
+    help="Random seed for selecting the ZPF tie-line subsets")
+
 def recursive_glob(start, pattern):
     matches = []
     for root, dirnames, filenames in os.walk(start):
@@ -56,13 +176,47 @@ if __name__ == '__main__':
         "Running with dask scheduler: %s [%s cores]" % (
             args.dask_scheduler,
             sum(client.ncores().values())))
+    fit_metrics.workers = sum(client.ncores().values())
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = start_metrics_server(args.metrics_port)
+        logging.info("Serving fit metrics on port %d" % args.metrics_port)
     datasets = load_datasets(sorted(recursive_glob('Al-Ni', '*.json')))
     recfile = open(args.iter_record, 'a') if args.iter_record else None
+    mcmc = None
+    if args.mcmc_chains > 0 and args.mcmc_walkers > 0:
+        parser.error('--mcmc-chains and --mcmc-walkers are mutually exclusive')
+    elif args.mcmc_chains > 0:
+        mcmc = {'chains': args.mcmc_chains, 'iter': args.mcmc_iter, 'burn': args.mcmc_burn,
+                'thin': args.mcmc_thin, 'trace_path': args.trace_path}
+    elif args.mcmc_walkers > 0:
+        mcmc = {'sampler': 'ensemble', 'walkers': args.mcmc_walkers, 'iter': args.mcmc_iter,
+                'trace_path': args.trace_path}
+    cache = ObjectiveCache(maxsize=args.cache_size, path=args.cache_file) if args.cache_size > 0 else None
+    screening = None
+    if args.screen_trajectories > 0:
+        screening = {'trajectories': args.screen_trajectories, 'threshold': args.screen_threshold,
+                     'report': args.screen_report}
+    surrogate = None
+    if args.surrogate_evaluations > 0:
+        surrogate = {'evaluations': args.surrogate_evaluations, 'history': args.surrogate_history}
+    minibatch = None
+    if args.minibatch_fractions:
+        minibatch = {'fractions': args.minibatch_fractions, 'seed': args.minibatch_seed}
     try:
-        dbf, mdl, model_dof = fit(args.fit_settings, datasets, scheduler=client, recfile=recfile)
+        dbf, mdl, model_dof = fit(args.fit_settings, datasets, scheduler=client, recfile=recfile, mcmc=mcmc,
+                                  cache=cache, screening=screening, surrogate=surrogate, minibatch=minibatch)
     finally:
         if recfile:
             recfile.close()
+        if cache:
+            cache.close()
+        print(timing_registry.report(by=('function',)))
+        print(timing_registry.report(by=('function', 'region')))
+        if args.timing_report:
+            timing_registry.write_csv(args.timing_report)
+        if metrics_server:
+            metrics_server.shutdown()
     dbf.to_file(args.output_tdb, if_exists='overwrite')
 
 
@@ -0,0 +1,310 @@
+"""
+Fit queue: run many fits concurrently on one dask cluster from a single long-lived process.
+
+Each fit is described by a JSON specification in a directory:
+
+    {
+        "fit_settings": "input.json",
+        "datasets": "Al-Ni",
+        "output_tdb": "out-variant.tdb",
+        "iter_record": "iterations-variant.csv",
+        "cache_size": 1024,
+        "mcmc": {"chains": 2, "iter": 1000},
+        "screening": null,
+        "surrogate": null,
+        "minibatch": null
+    }
+
+Only 'fit_settings' is required. 'datasets' is a directory searched for JSON datasets
+(default "Al-Ni") or a list of dataset files. Relative paths are relative to the
+specification file. 'mcmc', 'screening', 'surrogate' and 'minibatch' are passed to `fit`.
+
+Every output is specific to one fit. For a specification named variant.json, 'output_tdb'
+defaults to variant.tdb, the MCMC 'trace_path' to variant-traces and the screening 'report'
+to variant-screening.csv. Specifications sharing an output path are rejected before any fit
+starts, since concurrent fits would overwrite each other's files (and an ensemble run would
+resume from another fit's chain).
+
+Fits share the cluster fairly: at most --batches-in-flight objective batches run at once,
+and when fits are waiting the one with the fewest batches running goes next.
+Fits with matching phase models share compiled callables and their broadcast copies on the
+workers (see paramselect.CompiledFunctionCache). Fits reading the same dataset files share
+one loaded copy.
+
+Each fit records its progress in its own FitMetrics; with --metrics-port the samples are
+labelled with fit="<name>". Call timings are aggregated over all fits.
+"""
+import os
+import sys
+import json
+import glob
+import argparse
+import logging
+import itertools
+import threading
+import traceback
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import registry as timing_registry, FitMetrics, start_metrics_server
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument(
+    "spec_dir",
+    metavar="DIR",
+    help="Directory of fit specifications (*.json)")
+
+parser.add_argument(
+    "--dask-scheduler",
+    metavar="HOST:PORT",
+    help="Host and port of dask distributed scheduler")
+
+parser.add_argument(
+    "--max-fits",
+    metavar="N",
+    type=int,
+    default=4,
+    help="Number of fits run concurrently")
+
+parser.add_argument(
+    "--batches-in-flight",
+    metavar="N",
+    type=int,
+    default=None,
+    help="Number of objective batches on the cluster at once, shared fairly between fits "
+         "(default: the number of concurrent fits)")
+
+parser.add_argument(
+    "--timing-report",
+    metavar="FILE",
+    default=None,
+    help="Output file for per-call timing statistics of all fits (CSV)")
+
+parser.add_argument(
+    "--metrics-port",
+    metavar="PORT",
+    type=int,
+    default=None,
+    help="Serve Prometheus-style fit metrics over HTTP on this port (e.g., 9786)")
+
+
+class FairShareGate(object):
+    """
+    Limits the objective batches running on the cluster and admits waiting fits fairly.
+
+    When a slot frees up, the waiting fit with the fewest batches already running is admitted,
+    ties going to the one that has waited longest, so a fit that submits batches quickly
+    (e.g., an ensemble sampler) cannot starve one that submits them one at a time.
+
+    Parameters
+    ==========
+    capacity : int
+        Maximum number of batches running at once.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._condition = threading.Condition()
+        self._running = defaultdict(int)
+        self._waiting = []
+        self._tickets = itertools.count()
+
+    def _next_ticket(self):
+        return min(self._waiting, key=lambda waiter: (self._running[waiter[1]], waiter[0]))[0]
+
+    def acquire(self, name):
+        with self._condition:
+            ticket = next(self._tickets)
+            self._waiting.append((ticket, name))
+            while sum(self._running.values()) >= self.capacity or self._next_ticket() != ticket:
+                self._condition.wait()
+            self._waiting.remove((ticket, name))
+            self._running[name] += 1
+            # Other slots may be free too; let the next waiter in line check
+            self._condition.notify_all()
+
+    def release(self, name):
+        with self._condition:
+            self._running[name] -= 1
+            self._condition.notify_all()
+
+
+class FairShareScheduler(object):
+    """
+    A dask client as seen by one fit: computations wait for a FairShareGate slot, which is
+    held until all of their results are ready. Everything else, e.g., `persist` or `gather`,
+    goes straight to the client.
+
+    Parameters
+    ==========
+    client : distributed.Client
+    gate : FairShareGate
+    name : str
+        Name of the fit, used to share the gate fairly.
+    """
+    def __init__(self, client, gate, name):
+        self.client = client
+        self.gate = gate
+        self.name = name
+
+    def compute(self, collections, **kwargs):
+        "Submit a list of collections; returns their futures."
+        self.gate.acquire(self.name)
+        try:
+            futures = self.client.compute(collections, **kwargs)
+        except Exception:
+            self.gate.release(self.name)
+            raise
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def finished(future):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.gate.release(self.name)
+        if len(futures) == 0:
+            self.gate.release(self.name)
+        for future in futures:
+            future.add_done_callback(finished)
+        return futures
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class SharedDatasets(object):
+    "Loaded datasets, shared between fits reading the same files."
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, dataset_filenames):
+        key = tuple(sorted(os.path.abspath(fname) for fname in dataset_filenames))
+        with self._lock:
+            if key not in self._entries:
+                from paramselect import load_datasets
+                self._entries[key] = load_datasets(list(key))
+            return self._entries[key]
+
+
+def load_spec(spec_fname):
+    "Read a fit specification, resolving its paths relative to the specification file."
+    from fit import recursive_glob
+    with open(spec_fname) as f:
+        spec = json.load(f)
+    base = os.path.dirname(os.path.abspath(spec_fname))
+    name = os.path.splitext(os.path.basename(spec_fname))[0]
+    resolve = lambda path: os.path.join(base, path)
+    datasets = spec.get('datasets', 'Al-Ni')
+    if isinstance(datasets, str):
+        spec['dataset_files'] = recursive_glob(resolve(datasets), '*.json')
+    else:
+        spec['dataset_files'] = sorted(resolve(fname) for fname in datasets)
+    spec['fit_settings'] = resolve(spec['fit_settings'])
+    spec['output_tdb'] = resolve(spec.get('output_tdb', name + '.tdb'))
+    if spec.get('iter_record'):
+        spec['iter_record'] = resolve(spec['iter_record'])
+    if spec.get('mcmc') is not None:
+        spec['mcmc']['trace_path'] = resolve(spec['mcmc'].get('trace_path', name + '-traces'))
+    if spec.get('screening') is not None:
+        report = spec['screening'].get('report', name + '-screening.csv')
+        spec['screening']['report'] = resolve(report) if report else None
+    spec['name'] = name
+    return spec
+
+
+def output_paths(spec):
+    "(description, path) of every file or directory a fit writes."
+    paths = [('output_tdb', spec['output_tdb'])]
+    if spec.get('iter_record'):
+        paths.append(('iter_record', spec['iter_record']))
+    if spec.get('mcmc') is not None:
+        paths.append(('mcmc trace_path', spec['mcmc']['trace_path']))
+    if spec.get('screening') is not None and spec['screening']['report']:
+        paths.append(('screening report', spec['screening']['report']))
+    return paths
+
+
+def check_output_paths(specs):
+    "Raise ValueError if two fits (or two outputs of one fit) would write to the same path."
+    owners = {}
+    conflicts = []
+    for spec in specs:
+        for description, path in output_paths(spec):
+            key = os.path.normcase(os.path.abspath(path))
+            if key in owners:
+                conflicts.append('{} ({} of {}, {} of {})'.format(path, owners[key][1], owners[key][0],
+                                                                   description, spec['name']))
+            else:
+                owners[key] = (spec['name'], description)
+    if len(conflicts) > 0:
+        raise ValueError('Fit specifications share output paths:\n' + '\n'.join(conflicts))
+
+
+def run_fit(spec, client, gate, shared_datasets, metrics=None):
+    "Run one fit from a specification, recording its progress in 'metrics'. Returns the fitted Database."
+    from paramselect import fit, ObjectiveCache
+    name = spec['name']
+    logging.info("Starting fit %s" % name)
+    datasets = shared_datasets.get(spec['dataset_files'])
+    scheduler = FairShareScheduler(client, gate, name)
+    cache_size = spec.get('cache_size', 1024)
+    cache = ObjectiveCache(maxsize=cache_size) if cache_size > 0 else None
+    recfile = open(spec['iter_record'], 'a') if spec.get('iter_record') else None
+    try:
+        dbf, mdl, model_dof = fit(spec['fit_settings'], datasets, scheduler=scheduler, recfile=recfile,
+                                  mcmc=spec.get('mcmc'), cache=cache, screening=spec.get('screening'),
+                                  surrogate=spec.get('surrogate'), minibatch=spec.get('minibatch'),
+                                  metrics=metrics)
+    finally:
+        if recfile:
+            recfile.close()
+        if cache:
+            cache.close()
+    dbf.to_file(spec['output_tdb'], if_exists='overwrite')
+    logging.info("Finished fit %s: %s" % (name, spec['output_tdb']))
+    return dbf
+
+
+if __name__ == '__main__':
+    from distributed import Client, LocalCluster
+    args = parser.parse_args(sys.argv[1:])
+    if not args.dask_scheduler:
+        args.dask_scheduler = LocalCluster(n_workers=int(multiprocessing.cpu_count() / 2), threads_per_worker=1, nanny=True)
+    client = Client(args.dask_scheduler)
+    logging.info(
+        "Running with dask scheduler: %s [%s cores]" % (
+            args.dask_scheduler,
+            sum(client.ncores().values())))
+    specs = [load_spec(fname) for fname in sorted(glob.glob(os.path.join(args.spec_dir, '*.json')))]
+    check_output_paths(specs)
+    logging.info("Queued %d fits from %s" % (len(specs), args.spec_dir))
+    fit_metrics = {spec['name']: FitMetrics() for spec in specs}
+    for metrics in fit_metrics.values():
+        metrics.workers = sum(client.ncores().values())
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = start_metrics_server(args.metrics_port, metrics=fit_metrics)
+        logging.info("Serving fit metrics on port %d" % args.metrics_port)
+    gate = FairShareGate(args.batches_in_flight or args.max_fits)
+    shared_datasets = SharedDatasets()
+    failures = 0
+    try:
+        with ThreadPoolExecutor(max_workers=args.max_fits) as executor:
+            futures = [(spec, executor.submit(run_fit, spec, client, gate, shared_datasets, fit_metrics[spec['name']]))
+                       for spec in specs]
+            for spec, future in futures:
+                try:
+                    future.result()
+                except Exception:
+                    failures += 1
+                    logging.error("Fit %s failed:\n%s" % (spec['name'], traceback.format_exc()))
+    finally:
+        print(timing_registry.report(by=('function',)))
+        if args.timing_report:
+            timing_registry.write_csv(args.timing_report)
+        if metrics_server:
+            metrics_server.shutdown()
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,95 @@
+"""
+The inputstore module archives run inputs by content.
+
+Each distinct file is stored once under its SHA-1 digest and hardlinked (or copied, where
+hardlinks are not supported) into the input directory of every record that uses it.
+Digests are cached by path, modification time and size, so unchanged files are never re-read.
+"""
+import hashlib
+import json
+import os
+import shutil
+import stat
+
+
+def file_digest(fname, block_size=2**20):
+    "SHA-1 hex digest of a file's contents, the same digest Sumatra uses for data keys."
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class InputStore(object):
+    """
+    Content-addressed file store.
+
+    Parameters
+    ==========
+    root : str
+        Directory holding the blobs and the digest cache.
+    """
+    def __init__(self, root):
+        self.root = root
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self.cache_fname = os.path.join(root, 'digests.json')
+        self._cache = {}
+        if os.path.exists(self.cache_fname):
+            with open(self.cache_fname) as f:
+                self._cache = json.load(f)
+        self._cache_dirty = False
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest)
+
+    def digest(self, fname):
+        "Digest of a file, re-read only if its modification time or size changed."
+        fname = os.path.abspath(fname)
+        st = os.stat(fname)
+        cached = self._cache.get(fname)
+        if cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+            return cached[2]
+        digest = file_digest(fname)
+        self._cache[fname] = [st.st_mtime, st.st_size, digest]
+        self._cache_dirty = True
+        return digest
+
+    def add(self, fname):
+        """
+        Store a file if its contents are not already stored.
+
+        Returns
+        =======
+        str
+            Digest of the file.
+        """
+        digest = self.digest(fname)
+        blob = self.blob_path(digest)
+        if not os.path.exists(blob):
+            tmp_fname = blob + '.tmp'
+            shutil.copy2(fname, tmp_fname)
+            # Blobs are shared between records through hardlinks, so they must never be modified in place
+            os.chmod(tmp_fname, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(tmp_fname, blob)
+        return digest
+
+    def link(self, digest, dest):
+        "Make 'dest' refer to a stored blob, by hardlink if possible."
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            os.link(self.blob_path(digest), dest)
+        except OSError:
+            shutil.copy2(self.blob_path(digest), dest)
+
+    def save(self):
+        "Write the digest cache, if it changed."
+        if not self._cache_dirty:
+            return
+        tmp_fname = self.cache_fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(self._cache, f)
+        os.rename(tmp_fname, self.cache_fname)
+        self._cache_dirty = False
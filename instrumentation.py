@@ -0,0 +1,487 @@
+"""
+The instrumentation module records call counts, latencies and failures on the fitting hot path.
+
+Timings are aggregated into fixed histogram buckets as they are recorded, so the cost of
+a measurement is a couple of clock reads and a dictionary update. This is cheap enough
+to leave on for production fits.
+
+Each measurement is keyed by (function, phase, dataset, region):
+
+function : Instrumented call, e.g., 'tieline_error' or 'equilibrium'
+phase    : Phase being computed, or None
+dataset  : File name of the dataset being evaluated, or None
+region   : Phase region (sorted tuple of phase names joined by '+'), or None
+
+Work running in dask tasks should go through `timed_task`, which captures the timings
+recorded inside the task and hands them back to the client with the task result.
+
+Fit progress (iterations, objective value, batch size, queue depth, worker utilization) is tracked
+in a FitMetrics, by default the module's `fit_metrics`; a process running several fits
+keeps one per fit. Both can be served as Prometheus text metrics with `start_metrics_server`.
+"""
+import bisect
+import csv
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+
+class TimingStats(object):
+    """
+    Aggregated latency statistics for one instrumentation key.
+    """
+    __slots__ = ('count', 'failures', 'total', 'maximum', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, elapsed, failed=False):
+        self.count += 1
+        self.failures += int(failed)
+        self.total += elapsed
+        self.maximum = max(self.maximum, elapsed)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.failures += other.failures
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def quantile(self, q):
+        """
+        Estimate a latency quantile by interpolating within the histogram buckets.
+
+        Parameters
+        ==========
+        q : float
+            Quantile in [0, 1].
+
+        Returns
+        =======
+        float, or NaN if nothing was recorded
+        """
+        if self.count == 0:
+            return float('nan')
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for upper, num in zip(LATENCY_BUCKETS, self.buckets):
+            if num > 0 and seen + num >= rank:
+                upper = min(upper, self.maximum)
+                return lower + (upper - lower) * (rank - seen) / num
+            seen += num
+            lower = upper
+        return self.maximum
+
+    def __getstate__(self):
+        return self.count, self.failures, self.total, self.maximum, self.buckets
+
+    def __setstate__(self, state):
+        self.count, self.failures, self.total, self.maximum, self.buckets = state
+
+
+class Timer(object):
+    """
+    Handle yielded by `TimingRegistry.timer`. Set `failed` to record a soft failure,
+    e.g., a calculation which returned all NaN instead of raising.
+    """
+    __slots__ = ('failed',)
+
+    def __init__(self):
+        self.failed = False
+
+
+class TimingRegistry(object):
+    """
+    Thread-safe collection of TimingStats, keyed by (function, phase, dataset, region).
+    """
+    def __init__(self):
+        self.enabled = True
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, function, elapsed, failed=False, phase=None, dataset=None, region=None):
+        key = (function, phase, dataset, region)
+        with self._lock:
+            stats = self._stats.get(key, None)
+            if stats is None:
+                stats = self._stats[key] = TimingStats()
+            stats.add(elapsed, failed=failed)
+
+    def merge(self, stats_dict):
+        """
+        Add the statistics in a snapshot (e.g., one returned from a worker) to this registry.
+        """
+        with self._lock:
+            for key, other in stats_dict.items():
+                stats = self._stats.get(key, None)
+                if stats is None:
+                    stats = self._stats[key] = TimingStats()
+                stats.merge(other)
+
+    def snapshot(self):
+        "Copy of the current statistics, safe to pickle or inspect while recording continues."
+        with self._lock:
+            result = {}
+            for key, stats in self._stats.items():
+                result[key] = TimingStats()
+                result[key].merge(stats)
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def summarize(self, by=('function',)):
+        """
+        Aggregate statistics over the instrumentation labels not listed in `by`.
+
+        Parameters
+        ==========
+        by : sequence of str
+            Any of 'function', 'phase', 'dataset' and 'region'.
+
+        Returns
+        =======
+        OrderedDict mapping tuple of label values -> TimingStats
+        """
+        fields = ('function', 'phase', 'dataset', 'region')
+        indices = [fields.index(f) for f in by]
+        result = {}
+        for key, stats in self.snapshot().items():
+            group = tuple(key[i] for i in indices)
+            if group not in result:
+                result[group] = TimingStats()
+            result[group].merge(stats)
+        return OrderedDict(sorted(result.items(), key=lambda x: tuple(str(i) for i in x[0])))
+
+    def report(self, by=('function',)):
+        "Human-readable table of call counts, failure rates and latency quantiles."
+        header = '{:<48} {:>9} {:>8} {:>10} {:>10} {:>10} {:>10} {:>11}'.format(
+            '/'.join(by), 'calls', 'fail%', 'mean(s)', 'p50(s)', 'p95(s)', 'max(s)', 'total(s)')
+        lines = [header, '-' * len(header)]
+        for group, stats in self.summarize(by=by).items():
+            label = '/'.join(str(i) for i in group)
+            lines.append('{:<48} {:>9d} {:>8.2f} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f} {:>11.2f}'.format(
+                label[:48], stats.count, 100. * stats.failures / max(stats.count, 1),
+                stats.total / max(stats.count, 1), stats.quantile(0.5), stats.quantile(0.95),
+                stats.maximum, stats.total))
+        return '\n'.join(lines)
+
+    def write_csv(self, fname):
+        "Write the full breakdown, including histogram bucket counts, to a CSV file."
+        with open(fname, 'w') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['function', 'phase', 'dataset', 'region', 'calls', 'failures', 'total', 'max'] +
+                            ['le_{}'.format(b) for b in LATENCY_BUCKETS])
+            for key, stats in sorted(self.snapshot().items(), key=lambda x: tuple(str(i) for i in x[0])):
+                writer.writerow([str(k) if k is not None else '' for k in key] +
+                                [stats.count, stats.failures, stats.total, stats.maximum] + stats.buckets)
+
+    @contextmanager
+    def timer(self, function, phase=None, dataset=None, region=None):
+        """
+        Time the enclosed block. Exceptions are recorded as failures and re-raised.
+
+        Examples
+        ========
+        >>> with registry.timer('equilibrium', phase='LIQUID') as t:
+        ...     eqdata = equilibrium(...)
+        ...     t.failed = np.all(np.isnan(eqdata.NP.values))
+        """
+        handle = Timer()
+        if not self.enabled:
+            yield handle
+            return
+        start = time.perf_counter()
+        try:
+            yield handle
+        except Exception:
+            handle.failed = True
+            raise
+        finally:
+            self.record(function, time.perf_counter() - start, failed=handle.failed,
+                        phase=phase, dataset=dataset, region=region)
+
+
+registry = TimingRegistry()
+
+# Registry used by the current thread; `timed_task` swaps this out to capture task timings
+_local = threading.local()
+
+
+def active_registry():
+    return getattr(_local, 'registry', registry)
+
+
+def timer(function, phase=None, dataset=None, region=None):
+    "Time a block of code in the active registry. See TimingRegistry.timer."
+    return active_registry().timer(function, phase=phase, dataset=dataset, region=region)
+
+
+def timed(function):
+    """
+    Decorator which records every call of the wrapped function under the name `function`.
+    """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with timer(function):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__wrapped__ = func
+        return wrapper
+    return decorator
+
+
+def timed_task(func, *args, **kwargs):
+    """
+    Run func(*args, **kwargs) while capturing all timings recorded in this thread.
+    Intended to be wrapped in dask.delayed(..., nout=2).
+
+    Returns
+    =======
+    (result, dict of timing statistics)
+    """
+    previous = getattr(_local, 'registry', None)
+    task_registry = TimingRegistry()
+    task_registry.enabled = registry.enabled
+    _local.registry = task_registry
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        if previous is None:
+            del _local.registry
+        else:
+            _local.registry = previous
+    return result, task_registry.snapshot()
+
+
+class FitMetrics(object):
+    """
+    In-process counters describing the progress of a fit.
+
+    Attributes
+    ==========
+    workers : int
+        Number of worker cores available to the scheduler.
+    window : float
+        Length of the moving window (seconds) used for rates and utilization.
+    """
+    def __init__(self, window=300.):
+        self.window = window
+        self.workers = 0
+        self.iterations = 0
+        self.objective = float('nan')
+        self.best_objective = float('nan')
+        self.last_iteration_time = float('nan')
+        self.batch_size = 0
+        self.queue_depth = 0
+        self.tasks_completed = 0
+        self.start_time = time.time()
+        # (timestamp, duration) for recent iterations
+        self._iteration_times = deque()
+        # (timestamp, wall seconds, busy task seconds) for recent task batches
+        self._batches = deque()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._iteration_times and self._iteration_times[0][0] < now - self.window:
+            self._iteration_times.popleft()
+        while self._batches and self._batches[0][0] < now - self.window:
+            self._batches.popleft()
+
+    def record_iteration(self, objective, elapsed, estimate=False):
+        "Record an objective evaluation. Estimates, e.g., on a data subset, do not update best_objective."
+        now = time.time()
+        with self._lock:
+            self.iterations += 1
+            self.objective = float(objective)
+            if not estimate and not (self.best_objective <= self.objective):
+                self.best_objective = self.objective
+            self.last_iteration_time = now
+            self._iteration_times.append((now, elapsed))
+            self._expire(now)
+
+    def set_batch_size(self, num_tasks):
+        "Number of tasks in the batch being computed, or 0 when none is. Not updated as tasks finish."
+        with self._lock:
+            self.batch_size = int(num_tasks)
+
+    def set_queue_depth(self, num_tasks):
+        "Number of submitted tasks which have not finished yet."
+        with self._lock:
+            self.queue_depth = int(num_tasks)
+
+    def task_done(self):
+        "One submitted task finished."
+        with self._lock:
+            self.queue_depth = max(self.queue_depth - 1, 0)
+
+    def record_batch(self, num_tasks, wall_seconds, busy_seconds):
+        "Record a completed batch of cluster tasks and the summed task run time."
+        now = time.time()
+        with self._lock:
+            self.tasks_completed += int(num_tasks)
+            self._batches.append((now, wall_seconds, busy_seconds))
+            self._expire(now)
+
+    def iterations_per_minute(self):
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if len(self._iteration_times) == 0:
+                return 0.
+            span = min(self.window, now - self.start_time)
+            return 60. * len(self._iteration_times) / max(span, 1e-9)
+
+    def worker_utilization(self):
+        "Fraction of available worker time spent running tasks, over the moving window."
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            wall = sum(b[1] for b in self._batches)
+            busy = sum(b[2] for b in self._batches)
+        if wall == 0 or self.workers == 0:
+            return float('nan')
+        return busy / (wall * self.workers)
+
+
+fit_metrics = FitMetrics()
+
+# Functions whose failures count as solver failures
+SOLVER_FUNCTIONS = ('calculate', 'equilibrium')
+LATENCY_QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _format_metric(name, value, labels=None):
+    if labels:
+        label_str = ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels)
+        return '{}{{{}}} {}'.format(name, label_str, repr(float(value)))
+    return '{} {}'.format(name, repr(float(value)))
+
+
+def render_metrics(timings=None, metrics=None):
+    """
+    Render timing statistics and fit progress in the Prometheus text exposition format.
+
+    Parameters
+    ==========
+    timings : TimingRegistry, optional
+        Defaults to the module registry.
+    metrics : FitMetrics or dict, optional
+        Defaults to `fit_metrics`. A dict maps fit names to their FitMetrics; the samples of
+        each fit are then labelled with fit="<name>".
+
+    Returns
+    =======
+    str
+    """
+    timings = timings if timings is not None else registry
+    metrics = metrics if metrics is not None else fit_metrics
+    if isinstance(metrics, FitMetrics):
+        fits = [(None, metrics)]
+    else:
+        fits = [([('fit', name)], fit) for name, fit in sorted(metrics.items())]
+    lines = []
+
+    def metric(name, kind, helptext, samples):
+        lines.append('# HELP {} {}'.format(name, helptext))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for sample in samples:
+            lines.append(_format_metric(*sample))
+
+    def fit_metric(name, kind, helptext, value):
+        metric(name, kind, helptext, [(name, value(fit), labels) for labels, fit in fits])
+
+    fit_metric('fit_iterations_total', 'counter', 'Objective evaluations completed.',
+               lambda fit: fit.iterations)
+    fit_metric('fit_iterations_per_minute', 'gauge', 'Objective evaluations per minute over the moving window.',
+               lambda fit: fit.iterations_per_minute())
+    fit_metric('fit_objective', 'gauge', 'Most recent objective value (sum of squared residuals).',
+               lambda fit: fit.objective)
+    fit_metric('fit_objective_best', 'gauge',
+               'Lowest objective value seen so far, excluding estimates on data subsets.',
+               lambda fit: fit.best_objective)
+    fit_metric('fit_last_iteration_timestamp_seconds', 'gauge', 'Unix time of the last completed evaluation.',
+               lambda fit: fit.last_iteration_time)
+    fit_metric('fit_batch_size', 'gauge', 'Cluster tasks in the objective batch being computed (0 when idle).',
+               lambda fit: fit.batch_size)
+    fit_metric('fit_queue_depth', 'gauge', 'Cluster tasks submitted and not yet finished.',
+               lambda fit: fit.queue_depth)
+    fit_metric('fit_tasks_completed_total', 'counter', 'Cluster tasks completed.',
+               lambda fit: fit.tasks_completed)
+    fit_metric('fit_workers', 'gauge', 'Worker cores available to the scheduler.',
+               lambda fit: fit.workers)
+    fit_metric('fit_worker_utilization', 'gauge', 'Fraction of worker time spent running tasks.',
+               lambda fit: fit.worker_utilization())
+    summary = timings.summarize(by=('function',))
+    samples = []
+    for (function,), stats in summary.items():
+        for q in LATENCY_QUANTILES:
+            samples.append(('fit_task_latency_seconds', stats.quantile(q),
+                            [('function', function), ('quantile', q)]))
+        samples.append(('fit_task_latency_seconds_sum', stats.total, [('function', function)]))
+        samples.append(('fit_task_latency_seconds_count', stats.count, [('function', function)]))
+    metric('fit_task_latency_seconds', 'summary', 'Latency of instrumented calls.', samples)
+    metric('fit_solver_failures_total', 'counter', 'Failed calculate/equilibrium calls.',
+           [('fit_solver_failures_total', stats.failures, [('function', function)])
+            for (function,), stats in summary.items() if function in SOLVER_FUNCTIONS])
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render_metrics(metrics=self.server.metrics).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise flood stderr
+        pass
+
+
+def start_metrics_server(port, host='', metrics=None):
+    """
+    Serve `render_metrics()` over HTTP from a daemon thread.
+
+    Parameters
+    ==========
+    port : int
+    host : str, optional
+        Interface to bind. Defaults to all interfaces.
+    metrics : FitMetrics or dict, optional
+        Passed to `render_metrics`.
+
+    Returns
+    =======
+    HTTPServer
+        Call shutdown() to stop serving.
+    """
+    server = HTTPServer((host, int(port)), _MetricsHandler)
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    return server
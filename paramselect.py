@@ -48,11 +48,7 @@ with uninformative priors. With bias of AIC toward complex models, I think doing
 with ridge regression is advisible.
 """
 import pycalphad.variables as v
-from pycalphad import binplot, calculate, equilibrium, Database, Model
-from pycalphad.plot.utils import phase_legend
-from pycalphad.core.sympydiff_utils import build_functions as compiled_build_functions
-import pycalphad.refdata
-from sklearn.linear_model import LinearRegression
+from pycalphad import calculate, equilibrium, Database, Model
 import tinydb
 import sympy
 import numpy as np
@@ -67,6 +63,14 @@ from functools import reduce, partial
 from datetime import datetime
 import time
 import textwrap
+import os
+import csv
+import threading
+import hashlib
+import shelve
+from instrumentation import timer, timed, timed_task, registry as timing_registry, fit_metrics
+# Work done on the dask workers lives in zpfeval, so workers need not import this module
+from zpfeval import estimate_hyperplane, tieline_error, _worker_rss
 
 # Mapping of energy polynomial coefficients to corresponding property coefficients
 feature_transforms = {"CPM_FORM": lambda x: -v.T*sympy.diff(x, v.T, 2),
@@ -93,14 +97,280 @@ plot_mapping = {
 }
 
 
+def model_revision(dbf):
+    "Revision counter of the parts of a Database that Models are built from."
+    return getattr(dbf, '_model_revision', 0)
+
+
+def bump_model_revision(dbf):
+    """
+    Invalidate cached Models of a Database. Called by _add_parameter and _set_symbol;
+    call it directly after changing parameters or symbols any other way.
+    """
+    dbf._model_revision = model_revision(dbf) + 1
+
+
+def _add_parameter(dbf, *args, **kwargs):
+    dbf.add_parameter(*args, **kwargs)
+    bump_model_revision(dbf)
+
+
+def _set_symbol(dbf, name, value):
+    dbf.symbols[name] = value
+    bump_model_revision(dbf)
+
+
+class ModelCache(object):
+    """
+    Cache of Model objects shared by the fitting and plotting stages.
+
+    Models are keyed on the Database, phase, components, parameter overrides, variant
+    and the Database's model revision, so changing the Database through _add_parameter or
+    _set_symbol makes later lookups build fresh Models. Cached Models are shared: do not modify them.
+
+    Variants are derived from the full Model without rebuilding it:
+    None (full model), 'noidmix' (ideal mixing zeroed) and 'refonly' (only the reference contribution).
+
+    Parameters
+    ==========
+    maxsize : int, optional
+        Maximum number of cached Models; the least recently used are dropped first.
+    """
+    variants = {
+        None: lambda models: models,
+        'noidmix': lambda models: dict(models, idmix=0),
+        'refonly': lambda models: {key: value for key, value in models.items() if key == 'ref'}
+    }
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, dbf, comps, phase_name, parameters=None, variant=None):
+        if variant not in self.variants:
+            raise ValueError('Unknown Model variant: {}'.format(variant))
+        overrides = tuple(sorted(parameters.items(), key=str)) if parameters is not None else ()
+        key = (id(dbf), model_revision(dbf), phase_name, tuple(sorted(comps)), overrides, variant)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            # id() may be reused by a new Database once the old one is garbage collected
+            if entry is not None and entry[0] is dbf:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            if variant is None:
+                mod = Model(dbf, comps, phase_name, parameters=parameters)
+            else:
+                mod = copy.copy(self.get(dbf, comps, phase_name, parameters=parameters))
+                mod.models = self.variants[variant](dict(mod.models))
+            self._entries[key] = (dbf, mod)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return mod
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+model_cache = ModelCache()
+
+
+class CompiledFunctionCache(object):
+    """
+    Compiled objective, gradient and Hessian callables and their persisted cluster copies,
+    keyed by the expression they were built from.
+
+    Fits running in one process (see fitqueue.py) share an entry whenever their phase models
+    give the same Gibbs energy, variables and callable parameters, so each distinct phase is
+    compiled and broadcast once. Concurrent requests for a key being built wait for that build.
+    Persisted entries belong to the scheduler that made them; use one cache per cluster.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._persisted = {}
+        self._building = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(expr, variables, parameters):
+        text = ';'.join([str(expr), ','.join(str(x) for x in variables), ','.join(str(x) for x in parameters)])
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, key, build):
+        """
+        Cached value for 'key', calling 'build()' to make it if no thread has yet.
+        """
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self.hits += 1
+                    return self._entries[key]
+                building = self._building.get(key, None)
+                if building is None:
+                    self.misses += 1
+                    building = self._building[key] = threading.Event()
+                    break
+            # Another fit is building this entry; if its build fails, try again ourselves
+            building.wait()
+        try:
+            result = build()
+            with self._lock:
+                self._entries[key] = result
+        finally:
+            with self._lock:
+                del self._building[key]
+            building.set()
+        return result
+
+    def persist(self, scheduler, key, obj):
+        "Broadcast 'obj' to every worker once per key, returning the persisted delayed object."
+        return self.get(('persist', key),
+                        lambda: scheduler.persist([dask.delayed(obj, pure=True)], broadcast=True)[0])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+compiled_cache = CompiledFunctionCache()
+
+
+def _payload_size(obj):
+    "Size in bytes of an object as serialized for the workers."
+    import cloudpickle
+    return len(cloudpickle.dumps(obj))
+
+
+def _normalize_zpf(dataset):
+    """
+    Validate a ZPF dataset and flatten its tie-lines to arrays, one row per tie-line vertex.
+    Within each equilibrium, vertices are sorted by phase name.
+
+    Returns
+    =======
+    dict
+        'components' : sorted components, excluding VA
+        'conditions' : OrderedDict mapping state variable name to an array with one value per equilibrium
+        'vertices' : number of vertices of each equilibrium
+        'phases' : phase name of each vertex
+        'compositions' : float array (vertices, components) of mole fractions, NaN where unknown
+        'specified' : bool array (vertices, components), True where the dataset gives a
+            (possibly unknown) mole fraction; the one unspecified component is dependent
+        'flags' : optional solver hint of each vertex, e.g., 'disordered', or None
+    """
+    components = sorted(set(c.upper() for c in dataset['components']) - {'VA'})
+    payload = dataset['values']
+    conditions = _expand_zpf_conditions(dataset['conditions'], len(payload),
+                                        broadcast=dataset.get('broadcast_conditions', False))
+    vertices, phases, compositions, specified, flags = [], [], [], [], []
+    for eq_idx, equilibrium in enumerate(payload):
+        vertices.append(len(equilibrium))
+        # Stable sort, so vertices of the same phase keep their order
+        for vertex in sorted(equilibrium, key=operator.itemgetter(0)):
+            if len(vertex) < 3 or len(vertex[1]) != len(vertex[2]):
+                raise ValueError('Equilibrium {}: vertex {} needs a phase, a list of components and a list of '
+                                 'compositions of the same length'.format(eq_idx, vertex))
+            vertex_comps = [c.upper() for c in vertex[1]]
+            unknown_comps = set(vertex_comps) - set(components)
+            if len(unknown_comps) > 0:
+                raise ValueError('Equilibrium {}: components {} are not in the dataset'.format(eq_idx, sorted(unknown_comps)))
+            if len(components) - len(set(vertex_comps)) > 1:
+                raise ValueError('Equilibrium {}: dependent components greater than one'.format(eq_idx))
+            row = np.full(len(components), np.nan)
+            row_specified = np.zeros(len(components), dtype=np.bool)
+            for comp, value in zip(vertex_comps, vertex[2]):
+                comp_idx = components.index(comp)
+                row[comp_idx] = np.nan if value is None else float(value)
+                row_specified[comp_idx] = True
+            phases.append(vertex[0])
+            compositions.append(row)
+            specified.append(row_specified)
+            # vertex[3] optionally contains additional flags, e.g., "disordered", to help the solver
+            flags.append(vertex[3] if len(vertex) > 3 else None)
+    return {
+        'components': components,
+        'conditions': conditions,
+        'vertices': np.array(vertices, dtype=np.int),
+        'phases': np.array(phases, dtype=np.object),
+        'compositions': np.array(compositions, dtype=np.float).reshape(-1, len(components)),
+        'specified': np.array(specified, dtype=np.bool).reshape(-1, len(components)),
+        'flags': flags
+    }
+
+
+def _normalize_thermochemical(dataset):
+    """
+    Validate a thermochemical dataset and convert its conditions and values to float arrays.
+    Values must have the shape (pressures, temperatures, sublattice configurations).
+    """
+    solver = dataset.get('solver', None)
+    if solver is None:
+        raise ValueError('Missing \'solver\'')
+    configurations = solver.get('sublattice_configurations', None)
+    if solver.get('mode', None) == 'manual' and configurations is None:
+        raise ValueError('Manual solver mode needs \'sublattice_configurations\'')
+    occupancies = solver.get('sublattice_occupancies', None)
+    if occupancies is not None and len(occupancies) != len(configurations):
+        raise ValueError('{} sublattice occupancies for {} sublattice configurations'.format(len(occupancies),
+                                                                                           len(configurations)))
+    conditions = OrderedDict((key, np.atleast_1d(np.asarray(value, dtype=np.float)))
+                             for key, value in sorted(dataset['conditions'].items()))
+    values = np.asarray(dataset['values'], dtype=np.float)
+    if configurations is not None and 'P' in conditions and 'T' in conditions:
+        expected_shape = (len(conditions['P']), len(conditions['T']), len(configurations))
+        if values.shape != expected_shape:
+            raise ValueError('Values have shape {}; expected {} from the pressures, temperatures and '
+                             'sublattice configurations'.format(values.shape, expected_shape))
+    return conditions, values
+
+
+def normalize_dataset(dataset):
+    """
+    Validate a dataset and convert it to the form used for fitting and plotting, in place.
+
+    ZPF datasets get a 'zpf' entry of flattened arrays (see _normalize_zpf).
+    Thermochemical datasets get float arrays for their conditions and values.
+    Raises ValueError if the dataset is malformed.
+    """
+    for key in ('components', 'phases', 'conditions', 'output', 'values'):
+        if key not in dataset:
+            raise ValueError('Missing \'{}\''.format(key))
+    if dataset['output'] == 'ZPF':
+        dataset['zpf'] = _normalize_zpf(dataset)
+    else:
+        dataset['conditions'], dataset['values'] = _normalize_thermochemical(dataset)
+    return dataset
+
+
+def _zpf_record(data):
+    "Normalized arrays of a ZPF dataset, normalizing it now if it was not loaded with load_datasets."
+    return data['zpf'] if 'zpf' in data else _normalize_zpf(data)
+
+
 def load_datasets(dataset_filenames):
     ds_database = tinydb.TinyDB(storage=tinydb.storages.MemoryStorage)
     for fname in dataset_filenames:
         with open(fname) as file_:
             try:
-                ds_database.insert(json.load(file_))
+                dataset = json.load(file_)
             except ValueError as e:
                 print('JSON Error in {}: {}'.format(fname, e))
+                continue
+        try:
+            normalize_dataset(dataset)
+        except (ValueError, TypeError, KeyError) as e:
+            print('Invalid dataset {}: {}'.format(fname, e))
+            continue
+        # Used to break down timings and errors by source file
+        dataset['dataset_file'] = os.path.basename(fname)
+        ds_database.insert(dataset)
     return ds_database
 
 
@@ -217,6 +487,7 @@ def _fit_parameters(feature_matrix, data_quantities, feature_tuple):
        Maps 'feature_tuple' to fitted parameter value.
        If a coefficient is not used, it maps to zero.
     """
+    from sklearn.linear_model import LinearRegression
     # Now generate candidate models; add parameters one at a time
     model_scores = []
     results = np.zeros((len(feature_tuple), len(feature_tuple)))
@@ -260,6 +531,7 @@ def _get_samples(desired_data):
     return all_samples
 
 
+@timed('_build_feature_matrix')
 def _build_feature_matrix(prop, features, desired_data):
     transformed_features = sympy.Matrix([feature_transforms[prop](i) for i in features])
     all_samples = _get_samples(desired_data)
@@ -309,7 +581,7 @@ def sigfigs(x, n):
 
 
 def fit_formation_energy(dbf, comps, phase_name, configuration, symmetry,
-                         datasets, features=None):
+                         datasets, features=None, max_degree=3):
     """
     Find suitable linear model parameters for the given phase.
     We do this by successively fitting heat capacities, entropies and
@@ -335,6 +607,8 @@ def fit_formation_energy(dbf, comps, phase_name, configuration, symmetry,
         Maps "property" to a list of features for the linear model.
         These will be transformed from "GM" coefficients
         e.g., {"CPM_FORM": (v.T*sympy.log(v.T), v.T**2, v.T**-1, v.T**3)}
+    max_degree : int (optional)
+        Highest Redlich-Kister degree fit for interactions.
 
     Returns
     =======
@@ -352,7 +626,7 @@ def fit_formation_energy(dbf, comps, phase_name, configuration, symmetry,
         YS = sympy.Symbol('YS')
         # Product of all binary interaction terms
         Z = sympy.Symbol('Z')
-        redlich_kister_features = (YS, YS*Z, YS*(Z**2), YS*(Z**3))
+        redlich_kister_features = (YS, YS*Z, YS*(Z**2), YS*(Z**3))[:max_degree+1]
         for feature in features.keys():
             all_features = list(itertools.product(redlich_kister_features, features[feature]))
             features[feature] = [i[0]*i[1] for i in all_features]
@@ -368,8 +642,8 @@ def fit_formation_energy(dbf, comps, phase_name, configuration, symmetry,
 
     # These is our previously fit partial model
     # Subtract out all of these contributions (zero out reference state because these are formation properties)
-    fixed_model = Model(dbf, comps, phase_name, parameters={'GHSER'+c.upper(): 0 for c in comps})
-    fixed_model.models['idmix'] = 0
+    fixed_model = model_cache.get(dbf, comps, phase_name, parameters={'GHSER'+c.upper(): 0 for c in comps},
+                                  variant='noidmix')
     fixed_portions = [0]
 
     moles_per_formula_unit = sympy.S(0)
@@ -463,8 +737,91 @@ def _build_sitefractions(phase_name, sublattice_configurations, sublattice_occup
     return result
 
 
-def _compare_data_to_parameters(dbf, comps, phase_name, desired_data, mod, configuration, x, y):
+class _PhasePredictor(object):
+    """
+    Batches property predictions for one phase.
+
+    Requests for the same Model and output are evaluated together, with one call to
+    calculate() over all of their temperatures and points. The result of each request
+    is then sliced out of the combined grid.
+    """
+    def __init__(self, dbf, comps, phase_name):
+        self.dbf = dbf
+        self.comps = comps
+        self.phase_name = phase_name
+        self._requests = []
+        self._results = {}
+        self._lattice_only = None
+
+    def lattice_only_model(self):
+        "Model with only the lattice stability (reference) contribution. Built once per predictor."
+        if self._lattice_only is None:
+            self._lattice_only = model_cache.get(self.dbf, self.comps, self.phase_name,
+                                                 parameters={'GHSER'+c.upper(): 0 for c in self.comps},
+                                                 variant='refonly')
+        return self._lattice_only
+
+    def request(self, mod, output, temperatures, points):
+        """
+        Parameters
+        ==========
+        mod : Model
+        output : str
+        temperatures : float or array_like
+        points : array_like (N, dof)
+            Site fractions, sorted by str of the site fraction variables.
+
+        Returns
+        =======
+        int
+            Handle for `result`.
+        """
+        self._requests.append((mod, output, np.atleast_1d(np.asarray(temperatures, dtype=np.float)),
+                               np.atleast_2d(np.asarray(points, dtype=np.float))))
+        return len(self._requests) - 1
+
+    def compute(self):
+        groups = OrderedDict()
+        for handle, (mod, output, temperatures, points) in enumerate(self._requests):
+            if handle not in self._results:
+                groups.setdefault((id(mod), output), []).append(handle)
+        for handles in groups.values():
+            mod, output = self._requests[handles[0]][:2]
+            all_temps = np.unique(np.concatenate([self._requests[h][2] for h in handles]))
+            all_points = np.concatenate([self._requests[h][3] for h in handles], axis=0)
+            with timer('calculate', phase=self.phase_name):
+                predicted = calculate(self.dbf, self.comps, [self.phase_name], output=output,
+                                      T=all_temps, P=101325, points=all_points[None, None],
+                                      model=mod, mode='numpy')
+            values = predicted[output].values.reshape(len(all_temps), len(all_points))
+            point_offset = 0
+            for h in handles:
+                temperatures, points = self._requests[h][2:]
+                self._results[h] = values[np.searchsorted(all_temps, temperatures),
+                                          point_offset:point_offset+len(points)]
+                point_offset += len(points)
+
+    def result(self, handle):
+        """
+        Returns
+        =======
+        ndarray (len(temperatures), N)
+        """
+        return self._results[handle]
+
+
+def _compare_data_to_parameters(dbf, comps, phase_name, desired_data, mod, configuration, x, y, predictor=None):
+    """
+    Plot model predictions against data for one property.
+
+    If a _PhasePredictor is passed, predictions are only requested from it and a function which
+    draws the figure, to be called after `predictor.compute()`, is returned. Otherwise the figure
+    is drawn immediately.
+    """
     import matplotlib.pyplot as plt
+    deferred = predictor is not None
+    if predictor is None:
+        predictor = _PhasePredictor(dbf, comps, phase_name)
     all_samples = np.array(_get_samples(desired_data), dtype=np.object)
     endpoints = _endmembers_from_interaction(configuration)
     interacting_subls = [c for c in _list_to_tuple(configuration) if isinstance(c, tuple)]
@@ -474,10 +831,7 @@ def _compare_data_to_parameters(dbf, comps, phase_name, desired_data, mod, confi
         # In general this is a high-dimensional space; just plot the diagonal to see the disordered mixing
         endpoints = [endpoints[0], endpoints[-1]]
         disordered_config = True
-    fig = plt.figure(figsize=(9, 9))
     bar_chart = False
-    bar_labels = []
-    bar_data = []
     if y.endswith('_FORM'):
         # We were passed a Model object with zeroed out reference states
         yattr = y[:-5]
@@ -492,27 +846,8 @@ def _compare_data_to_parameters(dbf, comps, phase_name, desired_data, mod, confi
             # We only have one temperature: let's do a bar chart instead
             bar_chart = True
             temperatures = temperatures.min()
-        endmember = _translate_endmember_to_array(endpoints[0], mod.ast.atoms(v.SiteFraction))[None, None]
-        predicted_quantities = calculate(dbf, comps, [phase_name], output=yattr,
-                                         T=temperatures, P=101325, points=endmember, model=mod, mode='numpy')
-        if y == 'HM' and x == 'T':
-            # Shift enthalpy data so that value at minimum T is zero
-            predicted_quantities[yattr] -= predicted_quantities[yattr].sel(T=temperatures[0]).values.flatten()
-        response_data = predicted_quantities[yattr].values.flatten()
-        if not bar_chart:
-            extra_kwargs = {}
-            if len(response_data) < 10:
-                extra_kwargs['markersize'] = 20
-                extra_kwargs['marker'] = '.'
-                extra_kwargs['linestyle'] = 'none'
-                extra_kwargs['clip_on'] = False
-            fig.gca().plot(temperatures, response_data,
-                           label='This work', color='k', **extra_kwargs)
-            fig.gca().set_xlabel(plot_mapping.get(x, x))
-            fig.gca().set_ylabel(plot_mapping.get(y, y))
-        else:
-            bar_labels.append('This work')
-            bar_data.append(response_data[0])
+        endmember = _translate_endmember_to_array(endpoints[0], mod.ast.atoms(v.SiteFraction))[None]
+        model_handle = predictor.request(mod, yattr, temperatures, endmember)
     elif len(endpoints) == 2:
         # Binary interaction parameter
         first_endpoint = _translate_endmember_to_array(endpoints[0], mod.ast.atoms(v.SiteFraction))
@@ -520,10 +855,33 @@ def _compare_data_to_parameters(dbf, comps, phase_name, desired_data, mod, confi
         point_matrix = np.linspace(0, 1, num=100)[None].T * second_endpoint + \
             (1 - np.linspace(0, 1, num=100))[None].T * first_endpoint
         # TODO: Real temperature support
-        point_matrix = point_matrix[None, None]
-        predicted_quantities = calculate(dbf, comps, [phase_name], output=yattr,
-                                         T=300, P=101325, points=point_matrix, model=mod, mode='numpy')
-        response_data = predicted_quantities[yattr].values.flatten()
+        model_handle = predictor.request(mod, yattr, 300, point_matrix)
+    else:
+        raise NotImplementedError('No support for plotting configuration {}'.format(configuration))
+
+    stability_handles = {}
+    for data_idx, data in enumerate(desired_data):
+        if x == 'Z' and y.endswith('_MIX') and data['output'].endswith('_FORM'):
+            # All the _FORM data we have still has the lattice stability contribution
+            # Need to zero it out to shift formation data to mixing
+            mod_latticeonly = predictor.lattice_only_model()
+            points = _build_sitefractions(phase_name, data['solver']['sublattice_configurations'],
+                                          data['solver']['sublattice_occupancies'])
+            site_fractions = sorted(mod_latticeonly.ast.atoms(v.SiteFraction), key=str)
+            # Unoccupied site fractions are zero
+            points = np.array([[point.get(key, 0) for key in site_fractions] for point in points], dtype=np.float)
+            # TODO: Real temperature support
+            stability_handles[data_idx] = predictor.request(mod_latticeonly, data['output'][:-5],
+                                                            data['conditions'].get('T', 300), points)
+
+    def draw():
+        fig = plt.figure(figsize=(9, 9))
+        bar_labels = []
+        bar_data = []
+        response_data = predictor.result(model_handle).flatten()
+        if len(endpoints) == 1 and y == 'HM' and x == 'T':
+            # Shift enthalpy data so that value at minimum T is zero
+            response_data = response_data - response_data[0]
         if not bar_chart:
             extra_kwargs = {}
             if len(response_data) < 10:
@@ -531,90 +889,78 @@ def _compare_data_to_parameters(dbf, comps, phase_name, desired_data, mod, confi
                 extra_kwargs['marker'] = '.'
                 extra_kwargs['linestyle'] = 'none'
                 extra_kwargs['clip_on'] = False
-            fig.gca().plot(np.linspace(0, 1, num=100), response_data,
-                           label='This work', color='k', **extra_kwargs)
-            fig.gca().set_xlim((0, 1))
-            fig.gca().set_xlabel(str(':'.join(endpoints[0])) + ' to ' + str(':'.join(endpoints[1])))
+            if len(endpoints) == 1:
+                fig.gca().plot(temperatures, response_data,
+                               label='This work', color='k', **extra_kwargs)
+                fig.gca().set_xlabel(plot_mapping.get(x, x))
+            else:
+                fig.gca().plot(np.linspace(0, 1, num=100), response_data,
+                               label='This work', color='k', **extra_kwargs)
+                fig.gca().set_xlim((0, 1))
+                fig.gca().set_xlabel(str(':'.join(endpoints[0])) + ' to ' + str(':'.join(endpoints[1])))
             fig.gca().set_ylabel(plot_mapping.get(y, y))
         else:
             bar_labels.append('This work')
             bar_data.append(response_data[0])
-    else:
-        raise NotImplementedError('No support for plotting configuration {}'.format(configuration))
 
-    for data in desired_data:
-        indep_var_data = None
-        response_data = np.zeros_like(data['values'], dtype=np.float)
-        if x == 'T' or x == 'P':
-            indep_var_data = np.array(data['conditions'][x], dtype=np.float).flatten()
-        elif x == 'Z':
-            if disordered_config:
-                # Take the second element of the first interacting sublattice as the coordinate
-                # Because it's disordered all sublattices should be equivalent
-                # TODO: Fix this to filter because we need to guarantee the plot points are disordered
-                occ = data['solver']['sublattice_occupancies']
-                subl_idx = np.nonzero([isinstance(c, (list, tuple)) for c in occ[0]])[0]
-                if len(subl_idx) > 1:
-                    subl_idx = int(subl_idx[0])
+        for data_idx, data in enumerate(desired_data):
+            indep_var_data = None
+            response_data = np.zeros_like(data['values'], dtype=np.float)
+            if x == 'T' or x == 'P':
+                indep_var_data = np.array(data['conditions'][x], dtype=np.float).flatten()
+            elif x == 'Z':
+                if disordered_config:
+                    # Take the second element of the first interacting sublattice as the coordinate
+                    # Because it's disordered all sublattices should be equivalent
+                    # TODO: Fix this to filter because we need to guarantee the plot points are disordered
+                    occ = data['solver']['sublattice_occupancies']
+                    subl_idx = np.nonzero([isinstance(c, (list, tuple)) for c in occ[0]])[0]
+                    if len(subl_idx) > 1:
+                        subl_idx = int(subl_idx[0])
+                    else:
+                        subl_idx = int(subl_idx)
+                    indep_var_data = [c[subl_idx][1] for c in occ]
                 else:
-                    subl_idx = int(subl_idx)
-                indep_var_data = [c[subl_idx][1] for c in occ]
+                    interactions = np.array([i[1][1] for i in _get_samples([data])], dtype=np.float)
+                    indep_var_data = 1 - (interactions+1)/2
+                if data_idx in stability_handles:
+                    # Same (P, T, points) layout as the dataset values
+                    response_data -= predictor.result(stability_handles[data_idx])[None]
+
+            response_data += np.array(data['values'], dtype=np.float)
+            response_data = response_data.flatten()
+            if not bar_chart:
+                extra_kwargs = {}
+                if len(response_data) < 10:
+                    extra_kwargs['markersize'] = 20
+                    extra_kwargs['marker'] = '.'
+                    extra_kwargs['linestyle'] = 'none'
+                    extra_kwargs['clip_on'] = False
+
+                fig.gca().plot(indep_var_data, response_data, label=data.get('reference', None),
+                               **extra_kwargs)
             else:
-                interactions = np.array([i[1][1] for i in _get_samples([data])], dtype=np.float)
-                indep_var_data = 1 - (interactions+1)/2
-            if y.endswith('_MIX') and data['output'].endswith('_FORM'):
-                # All the _FORM data we have still has the lattice stability contribution
-                # Need to zero it out to shift formation data to mixing
-                mod_latticeonly = Model(dbf, comps, phase_name, parameters={'GHSER'+c.upper(): 0 for c in comps})
-                mod_latticeonly.models = {key: value for key, value in mod_latticeonly.models.items()
-                                          if key == 'ref'}
-                temps = data['conditions'].get('T', 300)
-                pressures = data['conditions'].get('P', 101325)
-                points = _build_sitefractions(phase_name, data['solver']['sublattice_configurations'],
-                                              data['solver']['sublattice_occupancies'])
-                for point_idx in range(len(points)):
-                    missing_variables = mod_latticeonly.ast.atoms(v.SiteFraction) - set(points[point_idx].keys())
-                    # Set unoccupied values to zero
-                    points[point_idx].update({key: 0 for key in missing_variables})
-                    # Change entry to a sorted array of site fractions
-                    points[point_idx] = list(OrderedDict(sorted(points[point_idx].items(), key=str)).values())
-                points = np.array(points, dtype=np.float)
-                # TODO: Real temperature support
-                points = points[None, None]
-                stability = calculate(dbf, comps, [phase_name], output=data['output'][:-5],
-                                      T=temps, P=pressures, points=points,
-                                      model=mod_latticeonly, mode='numpy')
-                response_data -= stability[data['output'][:-5]].values
-
-        response_data += np.array(data['values'], dtype=np.float)
-        response_data = response_data.flatten()
-        if not bar_chart:
-            extra_kwargs = {}
-            if len(response_data) < 10:
-                extra_kwargs['markersize'] = 20
-                extra_kwargs['marker'] = '.'
-                extra_kwargs['linestyle'] = 'none'
-                extra_kwargs['clip_on'] = False
-
-            fig.gca().plot(indep_var_data, response_data, label=data.get('reference', None),
-                           **extra_kwargs)
+                bar_labels.append(data.get('reference', None))
+                bar_data.append(response_data[0])
+        if bar_chart:
+            fig.gca().barh(0.02 * np.arange(len(bar_data)), bar_data,
+                           color='k', height=0.01)
+            endmember_title = ' to '.join([':'.join(i) for i in endpoints])
+            fig.suptitle('{} (T = {} K)'.format(endmember_title, temperatures), fontsize=20)
+            fig.gca().set_yticks(0.02 * np.arange(len(bar_data)))
+            fig.gca().set_yticklabels(bar_labels, fontsize=20)
+            # This bar chart is rotated 90 degrees, so "y" is now x
+            fig.gca().set_xlabel(plot_mapping.get(y, y))
         else:
-            bar_labels.append(data.get('reference', None))
-            bar_data.append(response_data[0])
-    if bar_chart:
-        fig.gca().barh(0.02 * np.arange(len(bar_data)), bar_data,
-                       color='k', height=0.01)
-        endmember_title = ' to '.join([':'.join(i) for i in endpoints])
-        fig.suptitle('{} (T = {} K)'.format(endmember_title, temperatures), fontsize=20)
-        fig.gca().set_yticks(0.02 * np.arange(len(bar_data)))
-        fig.gca().set_yticklabels(bar_labels, fontsize=20)
-        # This bar chart is rotated 90 degrees, so "y" is now x
-        fig.gca().set_xlabel(plot_mapping.get(y, y))
-    else:
-        fig.gca().set_frame_on(False)
-        leg = fig.gca().legend(loc='best')
-        leg.get_frame().set_edgecolor('black')
-    fig.canvas.draw()
+            fig.gca().set_frame_on(False)
+            leg = fig.gca().legend(loc='best')
+            leg.get_frame().set_edgecolor('black')
+        fig.canvas.draw()
+
+    if deferred:
+        return draw
+    predictor.compute()
+    draw()
 
 
 def plot_parameters(dbf, comps, phase_name, configuration, symmetry, datasets=None):
@@ -622,14 +968,17 @@ def plot_parameters(dbf, comps, phase_name, configuration, symmetry, datasets=No
                 ('T', 'HM'), ('T', 'HM_FORM')]
     mix_plots = [('Z', 'HM_FORM'), ('Z', 'HM_MIX'), ('Z', 'SM_MIX')]
     comps = sorted(comps)
-    mod = Model(dbf, comps, phase_name)
+    mod = model_cache.get(dbf, comps, phase_name)
     # This is for computing properties of formation
-    mod_norefstate = Model(dbf, comps, phase_name, parameters={'GHSER'+c.upper(): 0 for c in comps})
+    mod_norefstate = model_cache.get(dbf, comps, phase_name, parameters={'GHSER'+c.upper(): 0 for c in comps})
+    # All plots share one predictor, so each (model, output) is calculated once
+    predictor = _PhasePredictor(dbf, comps, phase_name)
     # Is this an interaction parameter or endmember?
     if any([isinstance(conf, list) or isinstance(conf, tuple) for conf in configuration]):
         plots = mix_plots
     else:
         plots = em_plots
+    draws = []
     for x_val, y_val in plots:
         if datasets is not None:
             if y_val.endswith('_MIX'):
@@ -641,10 +990,12 @@ def plot_parameters(dbf, comps, phase_name, configuration, symmetry, datasets=No
             desired_data = []
         if len(desired_data) == 0:
             continue
-        if y_val.endswith('_FORM'):
-            _compare_data_to_parameters(dbf, comps, phase_name, desired_data, mod_norefstate, configuration, x_val, y_val)
-        else:
-            _compare_data_to_parameters(dbf, comps, phase_name, desired_data, mod, configuration, x_val, y_val)
+        plot_mod = mod_norefstate if y_val.endswith('_FORM') else mod
+        draws.append(_compare_data_to_parameters(dbf, comps, phase_name, desired_data, plot_mod,
+                                                 configuration, x_val, y_val, predictor=predictor))
+    predictor.compute()
+    for draw in draws:
+        draw()
 
 
 def _list_to_tuple(x):
@@ -694,6 +1045,48 @@ def _generate_symmetric_group(configuration, symmetry):
     return sorted(set(configurations), key=canonical_sort_key)
 
 
+class _ConfigurationIndex(object):
+    """
+    Canonical sublattice configurations of one phase that have thermochemical data,
+    with the outputs measured for each. Built in one pass over the datasets, so configurations
+    without data can be skipped without searching the datasets or building Models.
+
+    Matches the same datasets as _get_data: single-phase, manual solver mode and
+    components within 'comps'.
+    """
+    def __init__(self, datasets, comps, phase_name, symmetry):
+        self.symmetry = symmetry
+        self._outputs = defaultdict(set)
+        desired_data = datasets.search((tinydb.where('components').test(lambda x: set(x).issubset(comps))) &
+                                       (tinydb.where('solver').test(lambda x: x.get('mode', None) == 'manual')) &
+                                       (tinydb.where('phases') == [phase_name]))
+        for data in desired_data:
+            for data_config in data['solver']['sublattice_configurations']:
+                self._outputs[canonicalize(data_config, symmetry)].add(data['output'])
+
+    def has_data(self, configuration, outputs):
+        return len(self._outputs.get(canonicalize(configuration, self.symmetry), set()).intersection(outputs)) > 0
+
+
+def _ternary_interactions(subl_model, symmetry):
+    """
+    Configurations with three constituents mixing on one sublattice and one constituent on every other.
+
+    Returns
+    =======
+    list of tuple
+        Distinct by symmetry.
+    """
+    interactions = set()
+    for subl_idx, subl in enumerate(subl_model):
+        for mixing in itertools.combinations(sorted(subl), 3):
+            others = [sorted(other) if other_idx != subl_idx else [mixing]
+                      for other_idx, other in enumerate(subl_model)]
+            for configuration in itertools.product(*others):
+                interactions.add(canonicalize(configuration, symmetry))
+    return sorted(interactions, key=canonical_sort_key)
+
+
 def phase_fit(dbf, phase_name, symmetry, subl_model, site_ratios, datasets, refdata, aliases=None):
     """
     Generate an initial CALPHAD model for a given phase and
@@ -760,14 +1153,15 @@ def phase_fit(dbf, phase_name, symmetry, subl_model, site_ratios, datasets, refd
                         if (0, True) not in stability.args:
                             new_args = stability.args + ((0, True),)
                             stability = sympy.Piecewise(*new_args)
-                    dbf.symbols[sym_name] = stability
+                    _set_symbol(dbf, sym_name, stability)
                     break
             if dbf.symbols.get(sym_name, None) is not None:
                 num_moles = sum([sites for elem, sites in zip(endmember, site_ratios) if elem != 'VA'])
                 fit_eq = num_moles * sympy.Symbol(sym_name)
         if fit_eq is None:
             # No reference lattice stability data -- we have to fit it
-            parameters = fit_formation_energy(dbf, sorted(dbf.elements), phase_name, endmember, symmetry, datasets)
+            with timer('fit_formation_energy', phase=phase_name):
+                parameters = fit_formation_energy(dbf, sorted(dbf.elements), phase_name, endmember, symmetry, datasets)
             for key, value in sorted(parameters.items(), key=str):
                 if value == 0:
                     continue
@@ -775,7 +1169,7 @@ def phase_fit(dbf, phase_name, symmetry, subl_model, site_ratios, datasets, refd
                 while dbf.symbols.get(symbol_name, None) is not None:
                     dbf.varcounter += 1
                     symbol_name = 'VV' + str(dbf.varcounter).zfill(4)
-                dbf.symbols[symbol_name] = sigfigs(value, numdigits)
+                _set_symbol(dbf, symbol_name, sigfigs(value, numdigits))
                 parameters[key] = sympy.Symbol(symbol_name)
             fit_eq = sympy.Add(*[value * key for key, value in parameters.items()])
             ref = 0
@@ -789,7 +1183,7 @@ def phase_fit(dbf, phase_name, symmetry, subl_model, site_ratios, datasets, refd
         all_endmembers.extend(symmetric_endmembers)
         for em in symmetric_endmembers:
             em_dict[em] = fit_eq
-            dbf.add_parameter('G', phase_name, tuple(map(_to_tuple, em)), 0, fit_eq)
+            _add_parameter(dbf, 'G', phase_name, tuple(map(_to_tuple, em)), 0, fit_eq)
     # Now fit all binary interactions
     # Need to use 'all_endmembers' instead of 'endmembers' because you need to generate combinations
     # of ALL endmembers, not just symmetry equivalent ones
@@ -811,16 +1205,8 @@ def phase_fit(dbf, phase_name, symmetry, subl_model, site_ratios, datasets, refd
     bin_interactions = sorted(set(canonicalize(i, symmetry) for i in transformed_bin_interactions),
                               key=bin_int_sort_key)
     print('{0} distinct binary interactions'.format(len(bin_interactions)))
-    for interaction in bin_interactions:
-        ixx = []
-        for i in interaction:
-            if isinstance(i, (tuple, list)):
-                ixx.append(tuple(i))
-            else:
-                ixx.append(i)
-        ixx = tuple(ixx)
-        print('INTERACTION: '+str(ixx))
-        parameters = fit_formation_energy(dbf, sorted(dbf.elements), phase_name, ixx, symmetry, datasets)
+
+    def add_interaction(interaction, parameters):
         # Organize parameters by polynomial degree
         degree_polys = np.zeros(10, dtype=np.object)
         for degree in reversed(range(10)):
@@ -833,7 +1219,7 @@ def phase_fit(dbf, phase_name, symmetry, subl_model, site_ratios, datasets, refd
                         while dbf.symbols.get(symbol_name, None) is not None:
                             dbf.varcounter += 1
                             symbol_name = 'VV' + str(dbf.varcounter).zfill(4)
-                        dbf.symbols[symbol_name] = sigfigs(parameters[key], numdigits)
+                        _set_symbol(dbf, symbol_name, sigfigs(parameters[key], numdigits))
                         parameters[key] = sympy.Symbol(symbol_name)
                     coef = parameters[key] * (key / check_symbol)
                     try:
@@ -850,15 +1236,109 @@ def phase_fit(dbf, phase_name, symmetry, subl_model, site_ratios, datasets, refd
         for degree in np.arange(degree_polys.shape[0]):
             if degree_polys[degree] != 0:
                 for syminter in symmetric_interactions:
-                    dbf.add_parameter('L', phase_name, tuple(map(_to_tuple, syminter)), degree, degree_polys[degree])
-    # Now fit ternary interactions
+                    _add_parameter(dbf, 'L', phase_name, tuple(map(_to_tuple, syminter)), degree,
+                                   degree_polys[degree])
+
+    # Interactions without data would fit to zero and add no parameters; skip them without searching
+    interaction_outputs = ('CPM_FORM', 'CPM_MIX', 'SM_FORM', 'SM_MIX', 'HM_FORM', 'HM_MIX')
+    data_index = _ConfigurationIndex(datasets, sorted(dbf.elements), phase_name, symmetry)
+    bin_interactions = [i for i in bin_interactions if data_index.has_data(i, interaction_outputs)]
+    print('{0} binary interactions with data'.format(len(bin_interactions)))
+    for interaction in bin_interactions:
+        ixx = []
+        for i in interaction:
+            if isinstance(i, (tuple, list)):
+                ixx.append(tuple(i))
+            else:
+                ixx.append(i)
+        ixx = tuple(ixx)
+        print('INTERACTION: '+str(ixx))
+        with timer('fit_formation_energy', phase=phase_name):
+            parameters = fit_formation_energy(dbf, sorted(dbf.elements), phase_name, ixx, symmetry, datasets)
+        add_interaction(interaction, parameters)
+    # Now fit ternary interactions, only where there is data for them
+    # Only the composition-independent (degree zero) term is fit
+    tern_interactions = [i for i in _ternary_interactions(subl_model, symmetry)
+                         if data_index.has_data(i, interaction_outputs)]
+    print('{0} ternary interactions with data'.format(len(tern_interactions)))
+    for interaction in tern_interactions:
+        print('TERNARY INTERACTION: '+str(interaction))
+        with timer('fit_formation_energy', phase=phase_name):
+            parameters = fit_formation_energy(dbf, sorted(dbf.elements), phase_name, interaction, symmetry, datasets,
+                                              max_degree=0)
+        add_interaction(interaction, parameters)
 
     if hasattr(dbf, 'varcounter'):
         del dbf.varcounter
 
 
+def _expand_zpf_conditions(conditions, num_equilibria, broadcast=False):
+    """
+    Expand the conditions of a ZPF dataset to one value per phase equilibrium in its payload.
+
+    Parameters
+    ==========
+    conditions : dict
+        Maps state variable name to a scalar or a list of values.
+    num_equilibria : int
+    broadcast : bool, optional
+        If True, the equilibria are the Cartesian product of the condition values, in sorted
+        order of the state variable names (the 'broadcast_conditions' dataset flag).
+        Otherwise condition lists are aligned with the equilibria and scalars are repeated.
+
+    Returns
+    =======
+    OrderedDict
+        Maps state variable name to an array of length num_equilibria.
+    """
+    keys = sorted(conditions.keys())
+    values = [np.atleast_1d(np.asarray(conditions[key], dtype=np.float)) for key in keys]
+    if broadcast:
+        grids = np.meshgrid(*values, indexing='ij')
+        expanded = [grid.ravel() for grid in grids]
+    else:
+        expanded = [value if len(value) > 1 else np.repeat(value, num_equilibria) for value in values]
+    for idx, (key, value) in enumerate(zip(keys, expanded)):
+        if not broadcast and len(value) > num_equilibria:
+            # Extra values were always ignored when indexing by equilibrium; keep that, but say so
+            print('Condition {} has {} values for {} equilibria; ignoring the extra values'.format(
+                key, len(value), num_equilibria))
+            expanded[idx] = value = value[:num_equilibria]
+        if len(value) != num_equilibria:
+            raise ValueError('Condition {} has {} values for {} equilibria'.format(key, len(value), num_equilibria))
+    return OrderedDict(zip(keys, expanded))
+
+
+def _zpf_arrays(data, real_components, chosen_comp):
+    """
+    Flatten a ZPF dataset to one array entry per tie-line vertex.
+
+    Returns
+    =======
+    dict
+        'conditions' (OrderedDict of arrays), 'phases', 'compositions' (mole fraction of chosen_comp)
+        and 'vertices' (number of phases in the equilibrium each vertex belongs to).
+    """
+    zpf = _zpf_record(data)
+    if chosen_comp in zpf['components']:
+        comp_idx = zpf['components'].index(chosen_comp)
+        # TODO: Assuming N=1 for the dependent component
+        dependent = 1 - np.where(zpf['specified'], zpf['compositions'], 0).sum(axis=1)
+        compositions = np.where(zpf['specified'][:, comp_idx], zpf['compositions'][:, comp_idx], dependent)
+    else:
+        compositions = np.zeros(len(zpf['phases']))
+    # TODO: Fix to only include equilibria listed in 'phases'
+    return {
+        'conditions': OrderedDict((key, np.repeat(value, zpf['vertices'])) for key, value in zpf['conditions'].items()),
+        'phases': zpf['phases'],
+        'compositions': compositions,
+        'vertices': np.repeat(zpf['vertices'], zpf['vertices'])
+    }
+
+
 def multi_plot(dbf, comps, phases, datasets, ax=None):
     import matplotlib.pyplot as plt
+    from pycalphad.plot.utils import phase_legend
     plots = [('ZPF', 'T')]
     real_components = sorted(set(comps) - {'VA'})
     legend_handles, phase_color_map = phase_legend(phases)
@@ -873,43 +1353,21 @@ def multi_plot(dbf, comps, phases, datasets, ax=None):
         ax.set_ylabel(indep_var)
         ax.set_xlim((0, 1))
         symbol_map = {1: "o", 2: "s", 3: "^"}
-        for data in desired_data:
-            payload = data['values']
-            # TODO: Add broadcast_conditions support
-            # Repeat the temperature (or whatever variable) vector to align with the unraveled data
-            temp_repeats = np.zeros(len(np.atleast_1d(data['conditions'][indep_var])), dtype=np.int)
-            for idx, x in enumerate(payload):
-                temp_repeats[idx] = len(x)
-            temps_ravelled = np.repeat(data['conditions'][indep_var], temp_repeats)
-            payload_ravelled = []
-            phases_ravelled = []
-            comps_ravelled = []
-            symbols_ravelled = []
-            # TODO: Fix to only include equilibria listed in 'phases'
-            for p in payload:
-                symbols_ravelled.extend([symbol_map[len(p)]] * len(p))
-                payload_ravelled.extend(p)
-            for rp in payload_ravelled:
-                phases_ravelled.append(rp[0])
-                comp_dict = dict(zip([x.upper() for x in rp[1]], rp[2]))
-                dependent_comp = list(set(real_components) - set(comp_dict.keys()))
-                if len(dependent_comp) > 1:
-                    raise ValueError('Dependent components greater than one')
-                elif len(dependent_comp) == 1:
-                    dependent_comp = dependent_comp[0]
-                    # TODO: Assuming N=1
-                    comp_dict[dependent_comp] = 1 - sum(np.array(list(comp_dict.values()), dtype=np.float))
-                chosen_comp_value = comp_dict[chosen_comp]
-                comps_ravelled.append(chosen_comp_value)
-            symbols_ravelled = np.array(symbols_ravelled)
-            comps_ravelled = np.array(comps_ravelled)
-            temps_ravelled = np.array(temps_ravelled)
-            phases_ravelled = np.array(phases_ravelled)
-            # We can't pass an array of markers to scatter, sadly
-            for sym in symbols_ravelled:
-                selected = symbols_ravelled == sym
-                ax.scatter(comps_ravelled[selected], temps_ravelled[selected], marker=sym, s=100,
-                           c='none', edgecolors=[phase_color_map[x] for x in phases_ravelled[selected]])
+        if len(desired_data) == 0:
+            continue
+        # Flatten all datasets once, then draw one scatter per (marker, phase) group
+        all_arrays = [_zpf_arrays(data, real_components, chosen_comp) for data in desired_data]
+        indep_values = np.concatenate([a['conditions'][indep_var] for a in all_arrays])
+        compositions = np.concatenate([a['compositions'] for a in all_arrays])
+        plot_phases = np.concatenate([a['phases'] for a in all_arrays])
+        vertices = np.concatenate([a['vertices'] for a in all_arrays])
+        for num_vertices in np.unique(vertices):
+            for phase_name in np.unique(plot_phases):
+                selected = (vertices == num_vertices) & (plot_phases == phase_name)
+                if not np.any(selected):
+                    continue
+                ax.scatter(compositions[selected], indep_values[selected], marker=symbol_map[num_vertices],
+                           s=100, c='none', edgecolors=phase_color_map[phase_name])
         ax.legend(handles=legend_handles, loc='center left', bbox_to_anchor=(1, 0.5))
 
 
@@ -923,220 +1381,367 @@ def _sublattice_model_to_variables(phase_name, subl_model):
     return result
 
 
-def estimate_hyperplane(dbf, comps, phases, current_statevars, comp_dicts, phase_obj_callables,
-                        phase_grad_callables, phase_hess_callables, phase_models, parameters):
-    region_chemical_potentials = []
-    parameters = OrderedDict(sorted(parameters.items(), key=str))
-    for cond_dict, phase_flag in comp_dicts:
-        # We are now considering a particular tie vertex
-        for key, val in cond_dict.items():
-            if val is None:
-                cond_dict[key] = np.nan
-        cond_dict.update(current_statevars)
-        # print('COND_DICT (MULTI)', cond_dict)
-        # print('PHASE FLAG', phase_flag)
-        if np.any(np.isnan(list(cond_dict.values()))):
-            # This composition is unknown -- it doesn't contribute to hyperplane estimation
-            pass
-        else:
-            # Extract chemical potential hyperplane from multi-phase calculation
-            # Note that we consider all phases in the system, not just ones in this tie region
-            multi_eqdata = equilibrium(dbf, comps, phases, cond_dict, pbar=False, verbose=False,
-                                       callables=phase_obj_callables, grad_callables=phase_grad_callables,
-                                       hess_callables=phase_hess_callables, model=phase_models,
-                                       scheduler=dask.async.get_sync, parameters=parameters)
-            if np.all(np.isnan(multi_eqdata.NP.values)):
-                error_time = time.time()
-                template_error = """
-                from pycalphad import Database, equilibrium
-                from pycalphad.variables import T, P, X
-                import dask
-                dbf_string = \"\"\"
-                {0}
-                \"\"\"
-                dbf = Database(dbf_string)
-                comps = {1}
-                phases = {2}
-                cond_dict = {3}
-                parameters = {4}
-                equilibrium(dbf, comps, phases, cond_dict, scheduler=dask.async.get_sync, parameters=parameters)
-                """
-                template_error = textwrap.dedent(template_error)
-                print('Dumping', 'error-'+str(error_time)+'.py')
-                with open('error-'+str(error_time)+'.py', 'w') as f:
-                    f.write(template_error.format(dbf.to_string(fmt='tdb'), comps, phases, cond_dict, {key: float(x) for key, x in parameters.items()}))
-            # print('MULTI_EQDATA', multi_eqdata)
-            # Does there exist only a single phase in the result with zero internal degrees of freedom?
-            # We should exclude those chemical potentials from the average because they are meaningless.
-            num_phases = len(np.squeeze(multi_eqdata['Phase'].values != ''))
-            zero_dof = np.all((multi_eqdata['Y'].values == 1.) | np.isnan(multi_eqdata['Y'].values))
-            if (num_phases == 1) and zero_dof:
-                region_chemical_potentials.append(np.full_like(np.squeeze(multi_eqdata['MU'].values), np.nan))
-            else:
-                region_chemical_potentials.append(np.squeeze(multi_eqdata['MU'].values))
-    # print('REGION_CHEMICAL_POTENTIALS', region_chemical_potentials)
-    region_chemical_potentials = np.nanmean(region_chemical_potentials, axis=0, dtype=np.float)
-    return region_chemical_potentials
-
-
-def tieline_error(dbf, comps, current_phase, cond_dict, region_chemical_potentials, phase_flag,
-                  phase_models, phase_obj_callables, phase_grad_callables, phase_hess_callables, parameters):
-    # print('COND_DICT ({})'.format(current_phase), cond_dict)
-    # print('PHASE FLAG', phase_flag)
-    if np.any(np.isnan(list(cond_dict.values()))):
-        # We don't actually know the phase composition here, so we estimate it
-        single_eqdata = calculate(dbf, comps, [current_phase],
-                                  T=cond_dict[v.T], P=cond_dict[v.P],
-                                  model=phase_models, callables=phase_obj_callables, parameters=parameters)
-        # print('SINGLE_EQDATA (UNKNOWN COMP)', single_eqdata)
-        driving_force = np.multiply(region_chemical_potentials,
-                                    single_eqdata['X'].values).sum(axis=-1) - single_eqdata['GM'].values
-        desired_sitefracs = single_eqdata['Y'].values[..., np.argmax(driving_force), :]
-        error = float(driving_force.max())
-    elif phase_flag == 'disordered':
-        # Construct disordered sublattice configuration from composition dict
-        # Compute energy
-        # Compute residual driving force
-        # TODO: Check that it actually makes sense to declare this phase 'disordered'
-        num_dof = sum([len(set(c).intersection(comps)) for c in dbf.phases[current_phase].constituents])
-        desired_sitefracs = np.ones(num_dof, dtype=np.float)
-        dof_idx = 0
-        for c in dbf.phases[current_phase].constituents:
-            dof = sorted(set(c).intersection(comps))
-            # print('DOF', dof)
-            if (len(dof) == 1) and (dof[0] == 'VA'):
-                return 0
-            # If it's disordered config of BCC_B2 with VA, disordered config is tiny vacancy count
-            sitefracs_to_add = np.array([cond_dict.get(v.X(d)) for d in dof],
-                                        dtype=np.float)
-            # Fix composition of dependent component
-            sitefracs_to_add[np.isnan(sitefracs_to_add)] = 1 - np.nansum(sitefracs_to_add)
-            desired_sitefracs[dof_idx:dof_idx + len(dof)] = sitefracs_to_add
-            dof_idx += len(dof)
-        # print('DISORDERED SITEFRACS', desired_sitefracs)
-        single_eqdata = calculate(dbf, comps, [current_phase],
-                                  T=cond_dict[v.T], P=cond_dict[v.P], points=desired_sitefracs,
-                                  model=phase_models, callables=phase_obj_callables, parameters=parameters)
-        driving_force = np.multiply(region_chemical_potentials,
-                                    single_eqdata['X'].values).sum(axis=-1) - single_eqdata['GM'].values
-        error = float(np.squeeze(driving_force))
-    else:
-        # Extract energies from single-phase calculations
-        single_eqdata = equilibrium(dbf, comps, [current_phase], cond_dict, pbar=False, verbose=False,
-                                    callables=phase_obj_callables, grad_callables=phase_grad_callables,
-                                    hess_callables=phase_hess_callables, model=phase_models,
-                                    scheduler=dask.async.get_sync, parameters=parameters)
-        if np.all(np.isnan(single_eqdata['NP'].values)):
-            error_time = time.time()
-            template_error = """
-            from pycalphad import Database, equilibrium
-            from pycalphad.variables import T, P, X
-            import dask
-            dbf_string = \"\"\"
-            {0}
-            \"\"\"
-            dbf = Database(dbf_string)
-            comps = {1}
-            phases = {2}
-            cond_dict = {3}
-            parameters = {4}
-            equilibrium(dbf, comps, phases, cond_dict, scheduler=dask.async.get_sync, parameters=parameters)
-            """
-            template_error = textwrap.dedent(template_error)
-            print('Dumping', 'error-'+str(error_time)+'.py')
-            with open('error-'+str(error_time)+'.py', 'w') as f:
-                f.write(template_error.format(dbf.to_string(fmt='tdb'), comps, [current_phase], cond_dict, {key: float(x) for key, x in parameters.items()}))
-        # print('SINGLE_EQDATA', single_eqdata)
-        # Sometimes we can get a miscibility gap in our "single-phase" calculation
-        # Choose the weighted mixture of site fractions
-        # print('Y FRACTIONS', single_eqdata['Y'].values)
-        if np.all(np.isnan(single_eqdata['NP'].values)):
-            print('Dropping condition due to calculation failure: ', cond_dict)
-            return 0
-        phases_idx = np.nonzero(~np.isnan(np.squeeze(single_eqdata['NP'].values)))
-        cur_vertex = np.nanargmax(np.squeeze(single_eqdata['NP'].values))
-        # desired_sitefracs = np.multiply(single_eqdata['NP'].values[..., phases_idx, np.newaxis],
-        #                                single_eqdata['Y'].values[..., phases_idx, :]).sum(axis=-2)
-        desired_sitefracs = single_eqdata['Y'].values[..., cur_vertex, :]
-        select_energy = float(single_eqdata['GM'].values)
-        region_comps = []
-        for comp in [c for c in sorted(comps) if c != 'VA']:
-            region_comps.append(cond_dict.get(v.X(comp), np.nan))
-        region_comps[region_comps.index(np.nan)] = 1 - np.nansum(region_comps)
-        # print('REGION_COMPS', region_comps)
-        error = np.multiply(region_chemical_potentials, region_comps).sum() - select_energy
-        error = float(error)
-    return error
+def multi_phase_fit(dbf, comps, phases, datasets, phase_models,
+                    obj_callables=None, grad_callables=None, hess_callables=None, parameters=None, scheduler=None,
+                    reference_tables=None, subset=None, metrics=None):
+    jobs = _multi_phase_fit_jobs(dbf, comps, phases, datasets, phase_models,
+                                 obj_callables=obj_callables, grad_callables=grad_callables,
+                                 hess_callables=hess_callables, parameters=parameters,
+                                 reference_tables=reference_tables, subset=subset)
+    return _compute_fit_jobs([jobs], scheduler, metrics=metrics)[0]
+
+
+def multi_phase_fit_batch(dbf, comps, phases, datasets, phase_models, parameter_sets,
+                          obj_callables=None, grad_callables=None, hess_callables=None, scheduler=None,
+                          reference_tables=None, subset=None, metrics=None):
+    """
+    Evaluate `multi_phase_fit` for several parameter sets in one round of cluster tasks.
+
+    Parameters
+    ==========
+    parameter_sets : list of OrderedDict
+        Each maps parameter name to value, as for the 'parameters' argument of `multi_phase_fit`.
+    subset : ZPFSubset, optional
+        If specified, only these tie-lines are evaluated.
+
+    Returns
+    =======
+    list of tuple of float
+        Tie-line errors for each parameter set.
+    """
+    job_sets = [_multi_phase_fit_jobs(dbf, comps, phases, datasets, phase_models,
+                                      obj_callables=obj_callables, grad_callables=grad_callables,
+                                      hess_callables=hess_callables, parameters=parameters,
+                                      reference_tables=reference_tables, subset=subset)
+                for parameters in parameter_sets]
+    return _compute_fit_jobs(job_sets, scheduler, metrics=metrics)
 
 
-def multi_phase_fit(dbf, comps, phases, datasets, phase_models,
-                    obj_callables=None, grad_callables=None, hess_callables=None, parameters=None, scheduler=None):
+def _compute_fit_jobs(job_sets, scheduler, metrics=None):
+    """
+    Compute several sets of (fit_jobs, timing_jobs) from `_multi_phase_fit_jobs` with a single call
+    to the scheduler, so independent sets are spread over the cluster together.
+    Batch sizes, the tasks still queued or running, and task times are recorded in 'metrics'
+    (default: instrumentation.fit_metrics).
+
+    Returns
+    =======
+    list of tuple of float
+        Errors for each job set.
+    """
+    all_fit_jobs = list(itertools.chain(*[fit_jobs for fit_jobs, _ in job_sets]))
+    all_timing_jobs = list(itertools.chain(*[timing_jobs for _, timing_jobs in job_sets]))
+    metrics = metrics if metrics is not None else fit_metrics
+    metrics.set_batch_size(len(all_timing_jobs))
+    batch_start = time.time()
+    from distributed import as_completed
+    try:
+        futures = scheduler.compute(all_fit_jobs + all_timing_jobs)
+        # There is one timing job per tie-line task; each completes when its task does
+        timing_futures = futures[len(all_fit_jobs):]
+        metrics.set_queue_depth(len(timing_futures))
+        for _ in as_completed(timing_futures):
+            metrics.task_done()
+        results = scheduler.gather(futures)
+    finally:
+        metrics.set_batch_size(0)
+        metrics.set_queue_depth(0)
+    # Timings recorded on the workers come back with the results; collect them here
+    busy_time = 0
+    for task_timings in results[len(all_fit_jobs):]:
+        timing_registry.merge(task_timings)
+        busy_time += sum(stats.total for key, stats in task_timings.items()
+                         if key[0] in ('estimate_hyperplane', 'tieline_error'))
+    metrics.record_batch(len(all_timing_jobs), time.time() - batch_start, busy_time)
+    errors = []
+    offset = 0
+    for fit_jobs, _ in job_sets:
+        errors.append(results[offset:offset + len(fit_jobs)])
+        offset += len(fit_jobs)
+    return errors
+
+
+def _zpf_datasets(datasets, comps, phases):
+    "ZPF datasets relevant to the given components and phases."
+    return datasets.search((tinydb.where('output') == 'ZPF') &
+                           (tinydb.where('components').test(lambda x: set(x).issubset(comps))) &
+                           (tinydb.where('phases').test(lambda x: len(set(phases).intersection(x)) > 0)))
+
+
+def _zpf_phase_regions(data):
+    """
+    Group the tie-lines of one ZPF dataset by phase region.
+
+    Returns
+    =======
+    dict
+        Maps a sorted tuple of phase names to a list of (conditions, comp_dicts), one per tie-line.
+        Unknown compositions are NaN.
+    """
+    zpf = _zpf_record(data)
+    # Same arrays as multi_plot, so plots show exactly the conditions being fit
+    variables = [v.X(comp) for comp in zpf['components']]
+    offsets = np.concatenate([[0], np.cumsum(zpf['vertices'])])
+    phase_regions = defaultdict(lambda: list())
+    # TODO: Fix to only include equilibria listed in 'phases'
+    for idx in range(len(zpf['vertices'])):
+        rows = range(offsets[idx], offsets[idx+1])
+        # Vertices are already sorted by phase name
+        phase_key = tuple(zpf['phases'][row] for row in rows)
+        if len(phase_key) < 2:
+            # Skip single-phase regions for fitting purposes
+            continue
+        comp_dicts = [({variables[comp_idx]: float(zpf['compositions'][row, comp_idx])
+                        for comp_idx in np.flatnonzero(zpf['specified'][row])}, zpf['flags'][row])
+                      for row in rows]
+        cur_conds = {getattr(v, key): float(value[idx]) for key, value in zpf['conditions'].items()}
+        phase_regions[phase_key].append((cur_conds, comp_dicts))
+    return phase_regions
+
+
+class ZPFSubset(object):
+    """
+    Stratified random subset of the ZPF tie-lines, for cheap estimates of the ZPF error.
+
+    Each stratum is one phase region of one dataset. A fraction of the tie-lines in every stratum
+    (at least one) is drawn without replacement, and each selected error is scaled by
+    sqrt(N/n), so the sum of squared errors is an unbiased estimate of the sum over all tie-lines.
+
+    Parameters
+    ==========
+    datasets : tinydb
+    comps, phases : list of str
+    fraction : float
+        Fraction of the tie-lines in each stratum to select, in (0, 1].
+    seed : int, optional
+    """
+    def __init__(self, datasets, comps, phases, fraction, seed=0):
+        self.fraction = fraction
+        self.seed = seed
+        random_state = np.random.RandomState(seed)
+        self._strata = {}
+        total = selected = 0
+        for data_idx, data in enumerate(_zpf_datasets(datasets, comps, phases)):
+            for region, region_eq in sorted(_zpf_phase_regions(data).items()):
+                num_tielines = len(region_eq)
+                num_selected = min(max(1, int(round(fraction * num_tielines))), num_tielines)
+                chosen = random_state.choice(num_tielines, num_selected, replace=False)
+                self._strata[(data_idx, region)] = (set(chosen.tolist()), float(np.sqrt(num_tielines / num_selected)))
+                total += num_tielines
+                selected += num_selected
+        self.total = total
+        self.selected = selected
+
+    def scale(self, data_idx, region, idx):
+        """
+        Scale factor for a tie-line's error, or None if it is not in the subset.
+        Datasets are numbered in the order returned by `_zpf_datasets`.
+        """
+        chosen, scale = self._strata[(data_idx, region)]
+        return scale if idx in chosen else None
+
+    def __repr__(self):
+        # Used as part of ObjectiveCache keys; identifies the selection
+        return 'ZPFSubset(fraction={!r}, seed={!r})'.format(self.fraction, self.seed)
+
+
+def _multi_phase_fit_jobs(dbf, comps, phases, datasets, phase_models,
+                          obj_callables=None, grad_callables=None, hess_callables=None, parameters=None,
+                          reference_tables=None, subset=None):
+    """
+    Build the dask graph for one evaluation of the ZPF error.
+    If ReferenceTables are given, their values at each tie-line's temperature are added to the parameters.
+    If a ZPFSubset is given, only its tie-lines are evaluated and their errors are scaled by it.
+
+    Returns
+    =======
+    (fit_jobs, timing_jobs)
+        Delayed tie-line errors and delayed timing snapshots.
+    """
     obj_callables = obj_callables if obj_callables is not None else defaultdict(lambda: None)
     grad_callables = grad_callables if grad_callables is not None else defaultdict(lambda: None)
     hess_callables = hess_callables if hess_callables is not None else defaultdict(lambda: None)
-    desired_data = datasets.search((tinydb.where('output') == 'ZPF') &
-                                   (tinydb.where('components').test(lambda x: set(x).issubset(comps))) &
-                                   (tinydb.where('phases').test(lambda x: len(set(phases).intersection(x)) > 0)))
-    phase_errors = tinydb.TinyDB(storage=tinydb.storages.MemoryStorage)
-    error_id = 0
-
-    def safe_get(itms, idxx):
-        try:
-            return itms[idxx]
-        except IndexError:
-            return None
+    desired_data = _zpf_datasets(datasets, comps, phases)
 
     fit_jobs = []
-    for data in desired_data:
-        payload = data['values']
-        conditions = data['conditions']
+    timing_jobs = []
+    for data_idx, data in enumerate(desired_data):
+        dataset_label = data.get('dataset_file', None)
         data_comps = list(set(data['components']).union({'VA'}))
-        broadcast = data.get('broadcast_conditions', False)
-        #print(conditions)
-        phase_regions = defaultdict(lambda: list())
-        # TODO: Fix to only include equilibria listed in 'phases'
-        for idx, p in enumerate(payload):
-            phase_key = tuple(sorted(rp[0] for rp in p))
-            if len(phase_key) < 2:
-                # Skip single-phase regions for fitting purposes
-                continue
-            # Need to sort 'p' here so we have the sorted ordering used in 'phase_key'
-            #print('SORTED P', sorted(p, key=operator.itemgetter(0)))
-            # rp[3] optionally contains additional flags, e.g., "disordered", to help the solver
-            comp_dicts = [(dict(zip([v.X(x.upper()) for x in rp[1]], rp[2])), safe_get(rp, 3))
-                          for rp in sorted(p, key=operator.itemgetter(0))]
-            cur_conds = {}
-            for key, value in conditions.items():
-                value = np.atleast_1d(np.asarray(value))
-                if len(value) > 1:
-                    value = value[idx]
-                cur_conds[getattr(v, key)] = float(value)
-            phase_regions[phase_key].append((cur_conds, comp_dicts))
+        phase_regions = _zpf_phase_regions(data)
         #print('PHASE_REGIONS', phase_regions)
         for region, region_eq in phase_regions.items():
             #print('REGION', region)
-            for req in region_eq:
+            region_label = '+'.join(region)
+            for req_idx, req in enumerate(region_eq):
+                scale = subset.scale(data_idx, region, req_idx) if subset is not None else 1
+                if scale is None:
+                    continue
                 # We are now considering a particular tie region
                 current_statevars, comp_dicts = req
-                region_chemical_potentials = \
-                    dask.delayed(estimate_hyperplane)(dbf, data_comps, phases, current_statevars, comp_dicts, obj_callables,
-                                                      grad_callables, hess_callables,
-                                                      phase_models, parameters)
+                if reference_tables is not None:
+                    job_parameters = reference_tables.with_parameters(parameters, current_statevars[v.T])
+                else:
+                    job_parameters = parameters
+                region_chemical_potentials, hyperplane_timings = \
+                    dask.delayed(timed_task, nout=2)(estimate_hyperplane, dbf, data_comps, phases, current_statevars,
+                                                     comp_dicts, obj_callables, grad_callables, hess_callables,
+                                                     phase_models, job_parameters,
+                                                     dataset=dataset_label, region=region_label)
+                timing_jobs.append(hyperplane_timings)
                 # Now perform the equilibrium calculation for the isolated phases and add the result to the error record
                 for current_phase, cond_dict in zip(region, comp_dicts):
                     # XXX: Messy unpacking
                     cond_dict, phase_flag = cond_dict
-                    # We are now considering a particular tie vertex
-                    for key, val in cond_dict.items():
-                        if val is None:
-                            cond_dict[key] = np.nan
+                    # We are now considering a particular tie vertex; unknown compositions are already NaN
                     cond_dict.update(current_statevars)
-                    error = dask.delayed(tieline_error)(dbf, data_comps, current_phase, cond_dict, region_chemical_potentials, phase_flag,
-                                                        phase_models, obj_callables,
-                                                        grad_callables, hess_callables, parameters)
+                    error, error_timings = \
+                        dask.delayed(timed_task, nout=2)(tieline_error, dbf, data_comps, current_phase, cond_dict,
+                                                         region_chemical_potentials, phase_flag,
+                                                         phase_models, obj_callables,
+                                                         grad_callables, hess_callables, job_parameters,
+                                                         dataset=dataset_label, region=region_label)
+                    if scale != 1:
+                        error = dask.delayed(operator.mul)(error, scale)
                     fit_jobs.append(error)
-    errors = dask.compute(*fit_jobs, get=scheduler.get)
-    return errors
+                    timing_jobs.append(error_timings)
+    return fit_jobs, timing_jobs
+
+
+class ObjectiveCache(object):
+    """
+    Bounded LRU cache of tie-line error vectors from `multi_phase_fit`, keyed by parameter vector.
+    Optimizers often revisit the same point (line search restarts, re-checking the optimum);
+    a hit skips a full round of equilibrium calculations.
+
+    Parameters
+    ==========
+    maxsize : int
+        Maximum number of error vectors kept in memory.
+    digits : int
+        Parameter values are rounded to this many significant digits before hashing,
+        so numerically identical vectors share an entry.
+    path : str, optional
+        If specified, entries are also stored in a shelve database at this path
+        and survive across runs. Entries are only valid for the fit they came from,
+        so set a namespace identifying it (see `set_namespace` and `fit_digest`).
+
+    Attributes
+    ==========
+    hits, misses : int
+    namespace : str or None
+        Part of every key.
+    """
+    def __init__(self, maxsize=1024, digits=12, path=None):
+        self.maxsize = maxsize
+        self.digits = digits
+        self.hits = 0
+        self.misses = 0
+        self.namespace = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._shelf = shelve.open(path) if path is not None else None
+
+    def key(self, parameters, extra=None):
+        """
+        Hash of the rounded parameter vector.
+
+        Parameters
+        ==========
+        parameters : dict
+            Maps parameter name to value.
+        extra : object, optional
+            Anything else the result depends on, e.g., a data subset. Must have a stable repr().
+        """
+        rounded = ['{}={:.{}g}'.format(name, float(val), self.digits)
+                   for name, val in sorted(parameters.items(), key=str)]
+        if self.namespace is not None:
+            rounded.insert(0, self.namespace)
+        if extra is not None:
+            rounded.append(repr(extra))
+        return hashlib.sha1(';'.join(rounded).encode('utf-8')).hexdigest()
+
+    def set_namespace(self, namespace):
+        "Key later entries by 'namespace', e.g., a digest of the fit inputs from `fit_digest`."
+        with self._lock:
+            if namespace != self.namespace:
+                self._entries.clear()
+            self.namespace = namespace
+
+    def get(self, parameters, extra=None):
+        "Cached error vector, or None."
+        key = self.key(parameters, extra=extra)
+        with self._lock:
+            result = self._entries.get(key, None)
+            if result is None and self._shelf is not None:
+                result = self._shelf.get(key, None)
+                if result is not None:
+                    self._insert(key, result)
+            if result is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return result
+
+    def put(self, parameters, errors, extra=None):
+        key = self.key(parameters, extra=extra)
+        errors = tuple(float(x) for x in errors)
+        with self._lock:
+            self._insert(key, errors)
+            if self._shelf is not None:
+                self._shelf[key] = errors
+
+    def _insert(self, key, errors):
+        self._entries[key] = errors
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def close(self):
+        if self._shelf is not None:
+            self._shelf.sync()
+            self._shelf.close()
+            self._shelf = None
+
+
+def _json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+
+def fit_digest(settings, datasets, phase_keys, reference_functions):
+    """
+    Digest of everything a fit's objective depends on besides the parameter values.
+
+    Parameters
+    ==========
+    settings : dict
+        Fit settings (input JSON).
+    datasets : tinydb
+    phase_keys : list of str
+        CompiledFunctionCache keys of the compiled phases; these cover the phase models,
+        the fitted symbols and the callable reference functions.
+    reference_functions : dict
+        Reference functions lowered to tables, by name.
+
+    Returns
+    =======
+    str
+    """
+    # Normalized arrays are derived from the rest of each record
+    records = sorted(json.dumps({key: value for key, value in record.items() if key != 'zpf'},
+                                sort_keys=True, default=_json_default)
+                     for record in datasets.all())
+    sha = hashlib.sha1()
+    for part in [json.dumps(settings, sort_keys=True, default=_json_default)] + records + list(phase_keys) + \
+            ['{}={}'.format(name, value) for name, value in sorted(reference_functions.items())]:
+        sha.update(part.encode('utf-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()
 
 
 def _multiphase_error(dbf, data, datasets, **kwargs):
@@ -1156,8 +1761,8 @@ def _multiphase_error(dbf, data, datasets, **kwargs):
     for phase_name in phases:
         desired_props = ["SM_FORM", "SM_MIX", "HM_FORM", "HM_MIX"]
         # Subtract out all of these contributions (zero out reference state because these are formation properties)
-        fixed_model = Model(dbf, comps, phase_name, parameters={'GHSER' + c.upper(): 0 for c in comps})
-        fixed_model.models['idmix'] = 0
+        fixed_model = model_cache.get(dbf, comps, phase_name, parameters={'GHSER' + c.upper(): 0 for c in comps},
+                                      variant='noidmix')
         # TODO: What about phase name aliases?
         desired_data = datasets.search((tinydb.where('output').test(lambda k: k in desired_props)) &
                                        (tinydb.where('components').test(lambda k: set(k).issubset(comps))) &
@@ -1254,7 +1859,548 @@ def tuplify(x):
     return tuple(res)
 
 
-def fit(input_fname, datasets, resume=None, scheduler=None, recfile=None):
+def _bracket_bounds(condition):
+    """
+    Temperature interval [lower, upper) of one Piecewise condition.
+    Raises ValueError for conditions other than bounds on T.
+    """
+    if condition == sympy.true or condition is True:
+        return -np.inf, np.inf
+    if isinstance(condition, sympy.And):
+        lower, upper = -np.inf, np.inf
+        for arg in condition.args:
+            arg_lower, arg_upper = _bracket_bounds(arg)
+            lower, upper = max(lower, arg_lower), min(upper, arg_upper)
+        return lower, upper
+    if isinstance(condition, sympy.core.relational.Relational):
+        lhs, rhs = condition.lhs, condition.rhs
+        if lhs == v.T and rhs.is_Number:
+            bound, is_lower = float(rhs), condition.rel_op in ('>=', '>')
+        elif rhs == v.T and lhs.is_Number:
+            bound, is_lower = float(lhs), condition.rel_op in ('<=', '<')
+        else:
+            raise ValueError('Unsupported condition: {}'.format(condition))
+        return (bound, np.inf) if is_lower else (-np.inf, bound)
+    raise ValueError('Unsupported condition: {}'.format(condition))
+
+
+class ReferenceTables(object):
+    """
+    Temperature-piecewise reference functions (e.g., GHSER* symbols) lowered to coefficient tables.
+
+    Each bracket of each function is stored as coefficients of shared basis terms in T
+    (1, T, T*log(T), T**2, ...). Evaluating all functions at an array of temperatures is a
+    vectorized bracket lookup followed by one dot product with the basis, instead of
+    every compiled callable walking the Piecewise branches for every point.
+    The functions are passed to the callables as extra parameters.
+
+    Parameters
+    ==========
+    functions : dict
+        Maps symbol name to a sympy.Piecewise of T only.
+    """
+    def __init__(self, functions):
+        self.names = sorted(functions.keys())
+        terms = OrderedDict()
+        brackets = []
+        for name in self.names:
+            function_brackets = []
+            for expr, condition in functions[name].args:
+                lower, upper = _bracket_bounds(condition)
+                coefficients = {}
+                for term, coef in sympy.expand(expr).as_coefficients_dict().items():
+                    if not coef.is_Number or not term.free_symbols <= {v.T}:
+                        raise ValueError('{} is not a function of T only'.format(name))
+                    coefficients[terms.setdefault(term, len(terms))] = float(coef)
+                function_brackets.append((lower, upper, coefficients))
+            brackets.append(function_brackets)
+        max_brackets = max([len(b) for b in brackets] + [0])
+        # Padding brackets never match; the extra last row is the zero default outside all brackets
+        self._lower = np.full((len(self.names), max_brackets), np.nan)
+        self._upper = np.full((len(self.names), max_brackets), np.nan)
+        self._coefficients = np.zeros((len(self.names), max_brackets + 1, len(terms)))
+        for func_idx, function_brackets in enumerate(brackets):
+            for bracket_idx, (lower, upper, coefficients) in enumerate(function_brackets):
+                self._lower[func_idx, bracket_idx] = lower
+                self._upper[func_idx, bracket_idx] = upper
+                for term_idx, coef in coefficients.items():
+                    self._coefficients[func_idx, bracket_idx, term_idx] = coef
+        self._basis = sympy.lambdify([v.T], list(terms.keys()), modules='numpy')
+        self._values = {}
+
+    @classmethod
+    def lower_database(cls, dbf, exclude=()):
+        """
+        Remove all temperature-piecewise symbols from a Database and build tables for them.
+
+        Returns
+        =======
+        (ReferenceTables, dict)
+            The tables, and the removed symbols so they can be restored later.
+        """
+        lowered = {}
+        for name, value in sorted(dbf.symbols.items()):
+            if name in exclude or not isinstance(value, sympy.Piecewise) or not value.free_symbols <= {v.T}:
+                continue
+            try:
+                cls({name: value})
+            except ValueError:
+                continue
+            lowered[name] = value
+        for name in lowered:
+            del dbf.symbols[name]
+        bump_model_revision(dbf)
+        return cls(lowered), lowered
+
+    def evaluate(self, temperatures):
+        """
+        Returns
+        =======
+        ndarray (len(temperatures), len(names))
+        """
+        temperatures = np.atleast_1d(np.asarray(temperatures, dtype=np.float))
+        basis = np.column_stack([np.broadcast_to(np.asarray(term, dtype=np.float), temperatures.shape)
+                                 for term in self._basis(temperatures)]) if self._coefficients.shape[2] > 0 \
+            else np.zeros((len(temperatures), 0))
+        temps = temperatures[:, None, None]
+        with np.errstate(invalid='ignore'):
+            in_bracket = (temps >= self._lower) & (temps < self._upper)
+        # First matching bracket, as for Piecewise; the zero row otherwise
+        bracket_idx = np.where(np.any(in_bracket, axis=-1), np.argmax(in_bracket, axis=-1), self._lower.shape[1])
+        coefficients = self._coefficients[np.arange(len(self.names)), bracket_idx]
+        return np.einsum('tfk,tk->tf', coefficients, basis)
+
+    def at(self, temperature):
+        "OrderedDict of symbol name to value at one temperature. Memoized across calls."
+        temperature = float(temperature)
+        values = self._values.get(temperature, None)
+        if values is None:
+            values = OrderedDict(zip(self.names, self.evaluate([temperature])[0]))
+            self._values[temperature] = values
+        return values
+
+    def with_parameters(self, parameters, temperature):
+        """
+        Parameters extended with the reference function values at a temperature, sorted by name
+        as the callables expect them.
+        """
+        result = dict(parameters) if parameters is not None else {}
+        result.update(self.at(temperature))
+        return OrderedDict(sorted(result.items(), key=str))
+
+
+def _factor_for_compilation(expr, parameters):
+    """
+    Factor a Gibbs energy expression by the fitted parameters and the Piecewise reference functions.
+
+    phase_fit adds every symmetry-equivalent permutation of a parameter with the same symbol,
+    so after distributing products each parameter (or reference function) multiplies one sum
+    of site fraction products instead of appearing once per permutation. Derivatives taken by
+    _build_shared_functions inherit the smaller form. The factored expression is only used if it has
+    fewer operations than the original.
+
+    Parameters
+    ==========
+    expr : sympy.Expr
+    parameters : list of sympy.Symbol
+
+    Returns
+    =======
+    (expression, ops_before, ops_after)
+    """
+    ops_before = sympy.count_ops(expr)
+    collect_syms = sorted(parameters, key=str) + sorted(expr.atoms(sympy.Piecewise), key=str)
+    factored = sympy.collect(sympy.expand_mul(expr), collect_syms)
+    ops_after = sympy.count_ops(factored)
+    if ops_after >= ops_before:
+        return expr, ops_before, ops_before
+    return factored, ops_before, ops_after
+
+
+def _build_shared_functions(expr, variables, parameters):
+    """
+    Compile the Gibbs energy, its gradient and its Hessian with subexpressions shared between them.
+
+    Mirrors the callables of pycalphad's build_functions (same arguments and argument layout),
+    but differentiates once, takes the Hessian from the gradient, and runs sympy.cse over all
+    three expression sets together. pycalphad's C printer emits each output as one expression,
+    so the reduced forms are expanded again over the shared replacement graph before wrapping;
+    the argument substitution is applied once per shared subexpression instead of once per tree.
+
+    Parameters
+    ==========
+    expr : sympy.Expr
+    variables : list of sympy.Symbol
+    parameters : list of sympy.Symbol
+
+    Returns
+    =======
+    (obj, grad, hess, ops_before, ops_after, num_shared)
+        Callables, operations in the three sets before and after elimination (including the
+        shared subexpressions), and the number of shared subexpressions.
+    """
+    from pycalphad.core.sympydiff_utils import AutowrapFunction, CompileLock
+    variables = tuple(variables)
+    parameters = tuple(parameters)
+    num_vars = len(variables)
+    with CompileLock:
+        gradient = [expr.diff(x) for x in variables]
+        # The Hessian is symmetric; only the upper triangle is differentiated
+        hessian_upper = [gradient[i].diff(variables[j]) for i in range(num_vars) for j in range(i, num_vars)]
+        outputs = [expr] + gradient + hessian_upper
+        ops_before = sum(sympy.count_ops(x) for x in outputs)
+        replacements, reduced = sympy.cse(outputs, optimizations='basic')
+        ops_after = sum(sympy.count_ops(value) for _, value in replacements) + \
+            sum(sympy.count_ops(x) for x in reduced)
+
+    m = sympy.Symbol('veclen', integer=True)
+    vecidx = sympy.Idx(sympy.Symbol('vecidx', integer=True), m)
+    outp = sympy.IndexedBase(sympy.Symbol('outp'))
+    params = sympy.MatrixSymbol('params', 1, len(parameters))
+    inp = sympy.MatrixSymbol('inp', m, num_vars)
+    inp_nobroadcast = sympy.MatrixSymbol('inp', 1, num_vars)
+    args_with_indices = [inp[vecidx, i] for i in range(num_vars)] + [params[0, i] for i in range(len(parameters))]
+    args_nobroadcast = [inp_nobroadcast[0, i] for i in range(num_vars)] + \
+        [params[0, i] for i in range(len(parameters))]
+
+    with CompileLock:
+        # Derivative arguments are matrix elements; each shared subexpression is substituted once
+        shared = dict(zip(variables + parameters, args_nobroadcast))
+        for symbol, value in replacements:
+            shared[symbol] = value.xreplace(shared).xreplace({sympy.zoo: sympy.oo})
+        derivatives = [x.xreplace(shared).xreplace({sympy.zoo: sympy.oo}) for x in reduced[1:]]
+        # The objective is broadcast over rows, so it keeps pycalphad's implemented function form
+        objective = reduced[0].xreplace(_expand_replacements(replacements))
+    grad_diffs = derivatives[:num_vars]
+    upper = iter(derivatives[num_vars:])
+    hess_diffs = [[None] * num_vars for _ in range(num_vars)]
+    for i in range(num_vars):
+        for j in range(i, num_vars):
+            hess_diffs[i][j] = hess_diffs[j][i] = next(upper)
+
+    # workaround for sympy/sympy#11692, as in pycalphad
+    class gibbs_energy(sympy.Function):
+        _imp_ = sympy.Lambda(variables + parameters, objective)
+    obj = AutowrapFunction([outp, inp, params, m], sympy.Eq(outp[vecidx], gibbs_energy(*args_with_indices)))
+    grad = AutowrapFunction((inp_nobroadcast, params), sympy.ImmutableMatrix(grad_diffs))
+    hess = AutowrapFunction((inp_nobroadcast, params), sympy.ImmutableMatrix(hess_diffs))
+    return obj, grad, hess, ops_before, ops_after, len(replacements)
+
+
+def _expand_replacements(replacements):
+    """
+    Map each sympy.cse replacement symbol to its value with the earlier replacements substituted in.
+    """
+    expanded = dict()
+    for symbol, value in replacements:
+        expanded[symbol] = value.xreplace(expanded)
+    return expanded
+
+
+def _morris_screening(log_prob_batch, bounds, trajectories=4, levels=4, random_state=None):
+    """
+    Morris elementary effects of each parameter on the objective.
+
+    Each trajectory starts from a random point on a grid over the bounds and moves every
+    parameter once, in random order, by a fixed step. All trajectory points are evaluated
+    in a single batch.
+
+    Parameters
+    ==========
+    log_prob_batch : callable
+        Maps an array of positions (K, ndim) to log-probabilities (K,), i.e., minus the objective.
+    bounds : list of (float, float)
+    trajectories : int, optional
+    levels : int, optional
+        Number of grid levels per parameter. Should be even.
+    random_state : numpy.random.RandomState, optional
+
+    Returns
+    =======
+    (mu_star, sigma) : ndarray (ndim,), ndarray (ndim,)
+        Mean absolute elementary effect and standard deviation of the elementary effects,
+        in objective units per fraction of the bound width.
+    """
+    random_state = random_state if random_state is not None else np.random.RandomState()
+    bounds = np.array(bounds, dtype=np.float)
+    ndim = len(bounds)
+    delta = levels / (2. * (levels - 1))
+    unit_points = []
+    steps = []
+    for _ in range(trajectories):
+        point = random_state.randint(levels // 2, size=ndim) / (levels - 1.)
+        unit_points.append(point.copy())
+        for param_idx in random_state.permutation(ndim):
+            step = delta if point[param_idx] + delta <= 1 else -delta
+            point[param_idx] += step
+            unit_points.append(point.copy())
+            steps.append((param_idx, step))
+    unit_points = np.array(unit_points)
+    positions = bounds[:, 0] + unit_points * (bounds[:, 1] - bounds[:, 0])
+    objective = -np.asarray(log_prob_batch(positions), dtype=np.float)
+    finite = np.isfinite(objective)
+    if not np.any(finite):
+        raise ValueError('Objective is not finite anywhere in the screening design')
+    # Failed evaluations count as the worst objective seen, so they register as influential without dominating
+    objective[~finite] = objective[finite].max()
+    objective = objective.reshape(trajectories, ndim + 1)
+    effects = np.zeros((trajectories, ndim))
+    for traj_idx in range(trajectories):
+        for move_idx in range(ndim):
+            param_idx, step = steps[traj_idx * ndim + move_idx]
+            effects[traj_idx, param_idx] = (objective[traj_idx, move_idx + 1] - objective[traj_idx, move_idx]) / step
+    return np.abs(effects).mean(axis=0), effects.std(axis=0)
+
+
+def _freeze_inert_parameters(names, values, mu_star, sigma, threshold=0.01, max_frozen=None,
+                             report='screening.csv'):
+    """
+    Choose parameters to fix at their current values from Morris screening results.
+
+    A parameter is frozen if both its mean absolute effect and the spread of its effects are below
+    'threshold' times the largest mean absolute effect, i.e., it neither matters on average nor
+    through interactions.
+
+    Parameters
+    ==========
+    names : list of str
+    values : dict
+        Current value of each parameter.
+    mu_star, sigma : ndarray
+        From _morris_screening.
+    threshold : float, optional
+    max_frozen : int, optional
+        Freeze at most this many parameters, the least influential first.
+    report : str, optional
+        CSV file to write the ranking to. None disables the report.
+
+    Returns
+    =======
+    dict
+        Maps each frozen parameter name to its value.
+    """
+    cutoff = threshold * np.max(mu_star)
+    order = np.argsort(mu_star)
+    frozen = [idx for idx in order if mu_star[idx] < cutoff and sigma[idx] < cutoff]
+    if max_frozen is not None:
+        frozen = frozen[:max_frozen]
+    frozen = set(frozen)
+    print('{:<12} {:>12} {:>12} {:>8}'.format('Parameter', 'mu*', 'sigma', 'Frozen'))
+    rows = []
+    for idx in order[::-1]:
+        if idx in frozen:
+            reason = 'mu* and sigma below {:.3g} ({} x max mu*)'.format(cutoff, threshold)
+        else:
+            reason = ''
+        print('{:<12} {:>12.4g} {:>12.4g} {:>8}'.format(names[idx], mu_star[idx], sigma[idx],
+                                                         'yes' if idx in frozen else ''))
+        rows.append([names[idx], mu_star[idx], sigma[idx], values[names[idx]], idx in frozen, reason])
+    print('Froze {} of {} parameters'.format(len(frozen), len(names)))
+    if report is not None:
+        with open(report, 'w') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['Parameter', 'mu_star', 'sigma', 'value', 'frozen', 'reason'])
+            writer.writerows(rows)
+    return {names[idx]: values[names[idx]] for idx in sorted(frozen)}
+
+
+def _read_iteration_log(fname, names, fixed_values=None):
+    """
+    Read evaluated points from an iteration log written by `fit` (the 'recfile').
+    Rows evaluated on a ZPF subset (zpf_fraction below one) are skipped, since their
+    errors are only estimates.
+
+    Parameters
+    ==========
+    fname : str
+    names : list of str
+        Parameters to return, in order.
+    fixed_values : dict, optional
+        Only rows where these parameters have these values are returned.
+
+    Returns
+    =======
+    (points, values) : ndarray (K, len(names)), ndarray (K,)
+        Points and their objective values (sum of squared tie-line errors).
+    """
+    fixed_values = fixed_values if fixed_values is not None else {}
+    points, values = [], []
+    if not os.path.exists(fname):
+        return np.zeros((0, len(names))), np.zeros(0)
+    with open(fname) as csvfile:
+        header = None
+        for row in csv.reader(csvfile):
+            if len(row) > 0 and row[0] == 'error':
+                header = {name: idx for idx, name in enumerate(row)}
+                continue
+            if header is None or len(row) != len(header) or any(name not in header for name in names):
+                continue
+            try:
+                if any(name not in header or not np.isclose(float(row[header[name]]), value)
+                       for name, value in fixed_values.items()):
+                    continue
+                if 'zpf_fraction' in header and float(row[header['zpf_fraction']]) < 1:
+                    continue
+                points.append([float(row[header[name]]) for name in names])
+                values.append(float(row[header['error']]))
+            except ValueError:
+                # Partially written row
+                continue
+    return np.array(points, dtype=np.float).reshape(-1, len(names)), np.array(values, dtype=np.float)
+
+
+def _surrogate_optimize(log_prob_batch, free_symbols, frozen_parameters, initial_values, bounds, model_dof,
+                        evaluations=200, history=None, **optimizer_kwargs):
+    """
+    Minimize the objective with surrogate.SurrogateOptimizer and set the pymc variables to the result.
+
+    Parameters
+    ==========
+    evaluations : int, optional
+        Budget of real objective evaluations.
+    history : str, optional
+        Iteration log of previous runs to seed the surrogate with.
+    optimizer_kwargs
+        Passed to SurrogateOptimizer, e.g., 'initial_radius' or 'candidates'.
+    """
+    from surrogate import SurrogateOptimizer
+    optimizer = SurrogateOptimizer(lambda points: -log_prob_batch(points), [bounds[x] for x in free_symbols],
+                                   **optimizer_kwargs)
+    if history is not None:
+        points, values = _read_iteration_log(history, free_symbols, fixed_values=frozen_parameters)
+        print('Seeding surrogate with {} evaluations from {}'.format(len(values), history))
+        optimizer.add_history(points, values)
+
+    def report(num_evaluations, value, radius):
+        print('SURROGATE', num_evaluations, value, 'radius', radius, flush=True)
+    best, best_value = optimizer.minimize([initial_values[x] for x in free_symbols], max_evaluations=evaluations,
+                                          callback=report)
+    print('Surrogate optimization finished after {} evaluations: {}'.format(optimizer.evaluations, best_value))
+    for variable, value in zip(model_dof, best):
+        variable.value = value
+
+
+def _sample_chains(build_model, symbols_to_fit, initial_values, bounds, chains=2, iter=1000, burn=0, thin=1,
+                   trace_path='.', **sample_kwargs):
+    """
+    Run several independent MCMC chains concurrently, one thread per chain.
+    Each chain evaluates its objective on the shared scheduler, so the cluster stays busy
+    while any single chain waits on its own iteration.
+
+    Parameters
+    ==========
+    build_model : callable
+        Maps a dict of initial values to a list of pymc nodes.
+    symbols_to_fit : list of str
+    initial_values : dict
+        Starting point of the first chain, e.g., the MAP estimate.
+    bounds : dict
+        Maps symbol name to (lower, upper) prior bounds.
+        Other chains start from points dispersed around 'initial_values' within these bounds.
+    chains : int
+    iter, burn, thin : int
+        Passed to pymc.MCMC.sample.
+    trace_path : str
+        Directory for the trace files. Each chain writes to its own file.
+
+    Returns
+    =======
+    list of pymc.MCMC
+    """
+    import pymc
+    if not os.path.exists(trace_path):
+        os.makedirs(trace_path)
+    samplers = []
+    for chain_idx in range(chains):
+        start = dict(initial_values)
+        if chain_idx > 0:
+            for x in symbols_to_fit:
+                lower, upper = bounds[x]
+                start[x] = float(np.clip(start[x] + np.random.uniform(-0.1, 0.1) * (upper - lower), lower, upper))
+        # pickle backend: HDF5 is not safe to write from several threads
+        samplers.append(pymc.MCMC(pymc.Model(build_model(start)), db='pickle',
+                                  dbname=os.path.join(trace_path, 'chain{}.pickle'.format(chain_idx))))
+    failures = []
+
+    def run_chain(sampler):
+        try:
+            sampler.sample(iter=iter, burn=burn, thin=thin, progress_bar=False, **sample_kwargs)
+        except Exception as e:
+            failures.append(e)
+        finally:
+            sampler.db.close()
+
+    threads = [threading.Thread(target=run_chain, args=(sampler,), name='chain{}'.format(idx))
+               for idx, sampler in enumerate(samplers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(failures) > 0:
+        raise failures[0]
+    if chains > 1:
+        # Cross-chain convergence
+        from diagnostics import gelman_rubin
+        with open(os.path.join(trace_path, 'convergence.csv'), 'w') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['Parameter', 'R-hat'] + ['chain{} mean'.format(i) for i in range(chains)])
+            print('{:<12} {:>8}'.format('Parameter', 'R-hat'))
+            for x in symbols_to_fit:
+                traces = np.array([sampler.trace(x)[:] for sampler in samplers], dtype=np.float)
+                rhat = gelman_rubin(traces)
+                print('{:<12} {:>8.4f}'.format(x, rhat))
+                writer.writerow([x, rhat] + list(traces.mean(axis=1)))
+    return samplers
+
+
+def _ensemble_sample(log_prob_batch, symbols_to_fit, initial_values, bounds, walkers=None, iter=1000,
+                     trace_path='.'):
+    """
+    Sample with the affine-invariant ensemble sampler. Moves for half of the walkers are
+    evaluated together as one batch of cluster tasks.
+
+    Parameters
+    ==========
+    log_prob_batch : callable
+        Maps an array of positions (K, len(symbols_to_fit)) to log-probabilities (K,).
+    symbols_to_fit : list of str
+    initial_values : dict
+        Center of the initial ensemble, e.g., the MAP estimate.
+    bounds : dict
+        Maps symbol name to (lower, upper) prior bounds.
+    walkers : int, optional
+        Number of walkers. Defaults to the smallest even number above twice the number of parameters.
+    iter : int
+        Total number of ensemble iterations.
+    trace_path : str
+        Directory for the chain store. An existing store is resumed.
+
+    Returns
+    =======
+    EnsembleSampler
+    """
+    from ensemble import EnsembleSampler, ChainStore
+    ndim = len(symbols_to_fit)
+    if walkers is None:
+        walkers = 2 * ndim + 2
+    walkers += walkers % 2
+    if not os.path.exists(trace_path):
+        os.makedirs(trace_path)
+    lower = np.array([bounds[x][0] for x in symbols_to_fit])
+    upper = np.array([bounds[x][1] for x in symbols_to_fit])
+    center = np.array([initial_values[x] for x in symbols_to_fit])
+    # Small ball around the starting point; the stretch move expands it as needed
+    initial_positions = center + 0.01 * (upper - lower) * np.random.randn(walkers, ndim)
+    initial_positions = np.clip(initial_positions, lower, upper)
+    store = ChainStore(os.path.join(trace_path, 'ensemble.csv'), symbols_to_fit)
+    sampler = EnsembleSampler(log_prob_batch, walkers, store=store)
+    sampler.run(initial_positions, iter)
+    print('ENSEMBLE ACCEPTANCE FRACTION', sampler.acceptance_fraction.mean())
+    return sampler
+
+
+def fit(input_fname, datasets, resume=None, scheduler=None, recfile=None, mcmc=None, cache=None, screening=None,
+        surrogate=None, minibatch=None, metrics=None):
     """
     Fit thermodynamic and phase equilibria data to a model.
 
@@ -1266,15 +2412,42 @@ def fit(input_fname, datasets, resume=None, scheduler=None, recfile=None):
     resume : Database, optional
         If specified, start multi-phase fitting using this Database.
         Useful for resuming calculations from Databases generated by 'saveall'.
+    mcmc : dict, optional
+        If specified, sample the posterior after finding the MAP estimate.
+        'sampler' selects 'metropolis' (default) or 'ensemble'. Other keys are passed to
+        _sample_chains ('chains', 'iter', 'burn', 'thin', 'trace_path') or
+        _ensemble_sample ('walkers', 'iter', 'trace_path'), respectively.
+    cache : ObjectiveCache, optional
+        If specified, objective evaluations are looked up here before running on the cluster.
+    screening : dict, optional
+        If specified, rank parameters by Morris elementary effects on the objective before
+        optimizing and freeze the least influential at their selected values.
+        Keys: 'trajectories', 'levels' (see _morris_screening), 'threshold', 'max_frozen'
+        and 'report' (see _freeze_inert_parameters).
+    surrogate : dict, optional
+        If specified, find the MAP estimate with a surrogate-assisted trust region method instead
+        of pymc.MAP. Keys are passed to _surrogate_optimize.
+    minibatch : dict, optional
+        If specified, optimize in stages on growing stratified subsets of the ZPF tie-lines
+        (see ZPFSubset), each stage starting from the previous result. 'fractions' lists the
+        subset fraction of each stage (default [0.1, 0.3, 1.0]); a final stage on all tie-lines
+        is always added. 'seed' selects the subsets. Sampling always uses all tie-lines.
+    metrics : FitMetrics, optional
+        Progress of this fit is recorded here. Defaults to instrumentation.fit_metrics;
+        pass a separate FitMetrics for each of several fits running in one process.
 
     Returns
     =======
     dbf : Database
+        Parameters are set to the MAP estimate.
+    mdl : pymc.MCMC, list of pymc.MCMC (one per chain) or EnsembleSampler, depending on 'mcmc'
+    model_dof : list of pymc nodes
     """
     start_time = datetime.utcnow()
     # TODO: Validate input JSON
     data = json.load(open(input_fname))
     if resume is None:
+        import pycalphad.refdata
         dbf = Database()
         dbf.elements = set(data['components'])
         # Write reference state to Database
@@ -1291,6 +2464,7 @@ def fit(input_fname, datasets, resume=None, scheduler=None, recfile=None):
         comp_refs = {c.upper(): stabledata[c.upper()] for c in dbf.elements if c.upper() != 'VA'}
         comp_refs['VA'] = 0
         dbf.symbols.update({'GHSER'+c.upper(): data for c, data in comp_refs.items()})
+        bump_model_revision(dbf)
         for phase_name, phase_obj in sorted(data['phases'].items(), key=operator.itemgetter(0)):
             # Perform parameter selection and single-phase fitting based on input
             # TODO: Need to pass particular models to include: magnetic, order-disorder, etc.
@@ -1322,82 +2496,225 @@ def fit(input_fname, datasets, resume=None, scheduler=None, recfile=None):
             dbf.symbols[x] = dbf.symbols[x].args[0].expr
 
     import pymc
-    model_dof = [pymc.Uniform(x, float(dbf.symbols[x]) - 0.5*abs(float(dbf.symbols[x])),
-                              float(dbf.symbols[x]) + 0.5*abs(float(dbf.symbols[x])), value=float(dbf.symbols[x]))
-                 for x in symbols_to_fit]
-    print([y.value for y in model_dof])
+    initial_values = {x: float(dbf.symbols[x]) for x in symbols_to_fit}
+    bounds = {x: (value - 0.5*abs(value), value + 0.5*abs(value)) for x, value in initial_values.items()}
+    print([initial_values[x] for x in symbols_to_fit])
     for x in symbols_to_fit:
         del dbf.symbols[x]
+    # Models built before the fitted symbols were removed would have them substituted in
+    bump_model_revision(dbf)
+    # Reference functions become extra callable parameters, evaluated once per temperature from tables
+    reference_tables, lowered_symbols = ReferenceTables.lower_database(dbf, exclude=symbols_to_fit)
+    print('Lowered {} reference functions to coefficient tables'.format(len(lowered_symbols)))
+    callable_symbols = [sympy.Symbol(s) for s in sorted(symbols_to_fit + reference_tables.names)]
 
     obj_funcs = dict()
     grad_funcs = dict()
     hess_funcs = dict()
     phase_models = dict()
+    phase_keys = []
     print('Building functions', flush=True)
     for phase_name in sorted(data['phases'].keys()):
-        mod = Model(dbf, comps, phase_name)
-        phase_models[phase_name] = mod
-        obj, grad, hess = compiled_build_functions(mod.GM, [v.P, v.T] + mod.site_fractions,
-                                                   wrt=[v.P, v.T] + mod.site_fractions,
-                                                   parameters=[sympy.Symbol(s) for s in symbols_to_fit])
-        obj_funcs[phase_name] = obj
-        grad_funcs[phase_name] = grad
-        hess_funcs[phase_name] = hess
+        mod = model_cache.get(dbf, comps, phase_name)
+        variables = [v.P, v.T] + mod.site_fractions
+        phase_key = compiled_cache.key(mod.GM, variables, callable_symbols)
+
+        def build(phase_name=phase_name, mod=mod, variables=variables):
+            with timer('factor_for_compilation', phase=phase_name):
+                gibbs_energy, ops_before, ops_after = _factor_for_compilation(mod.GM, callable_symbols)
+            print('{}: {} operations before factoring, {} after'.format(phase_name, ops_before, ops_after),
+                  flush=True)
+            with timer('build_functions', phase=phase_name):
+                obj, grad, hess, ops_before, ops_after, num_shared = \
+                    _build_shared_functions(gibbs_energy, variables, callable_symbols)
+            print('{}: {} operations in energy, gradient and Hessian, {} after eliminating {} common '
+                  'subexpressions'.format(phase_name, ops_before, ops_after, num_shared), flush=True)
+            return mod, (obj, grad, hess)
+        # Fits in the same process with an identical phase model reuse the first one's Model and callables
+        phase_models[phase_name], (obj_funcs[phase_name], grad_funcs[phase_name], hess_funcs[phase_name]) = \
+            compiled_cache.get(phase_key, build)
+        phase_keys.append(phase_key)
+    if cache is not None:
+        # Persistent entries from a fit with different data or models must not be reused
+        cache.set_namespace(fit_digest(data, datasets, phase_keys, lowered_symbols))
     print('Building finished', flush=True)
-    dbf = dask.delayed(dbf, pure=True)
-    obj_funcs = dask.delayed(obj_funcs, pure=True)
-    grad_funcs = dask.delayed(grad_funcs, pure=True)
-    hess_funcs = dask.delayed(hess_funcs, pure=True)
-    phase_models = dask.delayed(phase_models, pure=True)
-    dbf, obj_funcs, grad_funcs, hess_funcs, phase_models = \
-        scheduler.persist([dbf, obj_funcs, grad_funcs, hess_funcs, phase_models], broadcast=True)
-
-    error_args = ",".join(['{}=model_dof[{}]'.format(x, idx) for idx, x in enumerate(symbols_to_fit)])
+    # The fitted Database stays here; workers get their own copy
+    local_dbf = dbf
+    print('Worker payload: Database {} bytes, Models {} bytes, callables {} bytes'.format(
+        _payload_size(dbf), _payload_size(phase_models), _payload_size([obj_funcs, grad_funcs, hess_funcs])),
+        flush=True)
+    from distributed import wait
+    from distributed.client import futures_of
+    rss_before = scheduler.run(_worker_rss)
+    broadcast_start = time.time()
+    with timer('broadcast'):
+        dbf, = scheduler.persist([dask.delayed(dbf, pure=True)], broadcast=True)
+        shared_key = tuple(phase_keys)
+        obj_funcs = compiled_cache.persist(scheduler, ('obj',) + shared_key, obj_funcs)
+        grad_funcs = compiled_cache.persist(scheduler, ('grad',) + shared_key, grad_funcs)
+        hess_funcs = compiled_cache.persist(scheduler, ('hess',) + shared_key, hess_funcs)
+        phase_models = compiled_cache.persist(scheduler, ('models',) + shared_key, phase_models)
+        wait(futures_of([dbf, obj_funcs, grad_funcs, hess_funcs, phase_models]))
+    rss_after = scheduler.run(_worker_rss)
+    print('Broadcast took {:.2f} s; worker RSS {:.1f} MB before, {:.1f} MB after (mean of {} workers)'.format(
+        time.time() - broadcast_start, np.mean(list(rss_before.values())) / 2**20,
+        np.mean(list(rss_after.values())) / 2**20, len(rss_after)), flush=True)
+
+    metrics = metrics if metrics is not None else fit_metrics
+    # Parameters frozen by screening keep their selected values; the rest are free
+    free_symbols = list(symbols_to_fit)
+    frozen_parameters = {}
+    # ZPF tie-line subset of the current optimization stage; None evaluates all of them
+    minibatch_state = {'subset': None}
     error_code = """
     def error({0}):
-        parameters = OrderedDict(sorted(locals().items(), key=str))
+        parameters = OrderedDict(sorted(list(locals().items()) + list(frozen_parameters.items()), key=str))
         import time
         enter_time = time.time()
-        try:
-            iter_error = multi_phase_fit(dbf, comps, phases, datasets, phase_models,
-                                         obj_callables=obj_funcs,
-                                         grad_callables=grad_funcs,
-                                         hess_callables=hess_funcs, parameters=parameters, scheduler=scheduler)
-        except ValueError as e:
-            print(e)
-            iter_error = [np.inf]
+        subset = minibatch_state['subset']
+        iter_error = cache.get(parameters, extra=subset) if cache is not None else None
+        if iter_error is None:
+            try:
+                with timer('objective'):
+                    iter_error = multi_phase_fit(dbf, comps, phases, datasets, phase_models,
+                                                 obj_callables=obj_funcs,
+                                                 grad_callables=grad_funcs,
+                                                 hess_callables=hess_funcs, parameters=parameters, scheduler=scheduler,
+                                                 reference_tables=reference_tables, subset=subset,
+                                                 metrics=metrics)
+                if cache is not None:
+                    cache.put(parameters, iter_error, extra=subset)
+            except ValueError as e:
+                print(e)
+                iter_error = [np.inf]
         iter_error = [np.inf if np.isnan(x) else x**2 for x in iter_error]
         iter_error = -np.sum(iter_error)
-        print(time.time()-enter_time, 'exit', iter_error, flush=True)
+        cache_stats = [cache.hits, cache.misses] if cache is not None else ['', '']
+        print(time.time()-enter_time, 'exit', iter_error, 'cache hits/misses', *cache_stats, flush=True)
+        metrics.record_iteration(-iter_error, time.time()-enter_time, estimate=subset is not None)
         if recfile:
-            recfile.write(','.join([str(-iter_error), str(time.time()-enter_time)] + [str(x) for x in parameters.values()]) + '\\n')
+            with recfile_lock:
+                recfile.write(','.join([str(-iter_error), str(time.time()-enter_time)] + [str(x) for x in parameters.values()] +
+                                       [str(x) for x in cache_stats] +
+                                       [str(subset.fraction if subset is not None else 1.0)]) + '\\n')
         return iter_error
     """
     import textwrap
-    error_code = textwrap.dedent(error_code).format(error_args)
+    error_code = textwrap.dedent(error_code)
     if recfile:
-        recfile.write(','.join(['error', 'time'] + [str(x) for x in symbols_to_fit]) + '\n')
+        # zpf_fraction is below one for ZPF subset estimates of the error (see ZPFSubset)
+        recfile.write(','.join(['error', 'time'] + [str(x) for x in symbols_to_fit] +
+                               ['cache_hits', 'cache_misses', 'zpf_fraction']) + '\n')
 
-    result_obj = {'model_dof': model_dof}
     error_context = {'data': data, 'comps': comps, 'dbf': dbf, 'phases': sorted(data['phases'].keys()),
                      'datasets': datasets, 'symbols_to_fit': symbols_to_fit,
                      'obj_funcs': obj_funcs, 'grad_funcs': grad_funcs, 'hess_funcs': hess_funcs,
-                     'phase_models': phase_models, 'scheduler': scheduler, 'recfile': recfile}
+                     'phase_models': phase_models, 'scheduler': scheduler, 'recfile': recfile,
+                     'recfile_lock': threading.Lock(), 'cache': cache, 'reference_tables': reference_tables,
+                     'frozen_parameters': frozen_parameters, 'minibatch_state': minibatch_state}
     error_context.update(globals())
-    exec(error_code, error_context, result_obj)
-    error = result_obj['error']
-    error = pymc.potential(error)
-    model_dof.append(error)
+    error_context['metrics'] = metrics
+
+    def build_model(start_values):
+        # Each call creates independent pymc nodes sharing the persisted callables and datasets
+        model_dof = [pymc.Uniform(x, bounds[x][0], bounds[x][1], value=start_values[x]) for x in free_symbols]
+        result_obj = {'model_dof': model_dof}
+        error_args = ",".join(['{}=model_dof[{}]'.format(x, idx) for idx, x in enumerate(free_symbols)])
+        exec(error_code.format(error_args), error_context, result_obj)
+        error = result_obj['error']
+        error = pymc.potential(error)
+        model_dof.append(error)
+        return model_dof
+
+    def log_prob_batch(positions):
+        # Batched counterpart of error(), with the uniform prior bounds applied
+        log_probs = np.full(len(positions), -np.inf)
+        in_bounds = [idx for idx, position in enumerate(positions)
+                     if all(bounds[x][0] <= val <= bounds[x][1] for x, val in zip(free_symbols, position))]
+        parameter_sets = [OrderedDict(sorted(list(zip(free_symbols, positions[idx])) + list(frozen_parameters.items()),
+                                             key=str))
+                          for idx in in_bounds]
+        enter_time = time.time()
+        subset = minibatch_state['subset']
+        batch_errors = [cache.get(parameters, extra=subset) if cache is not None else None
+                        for parameters in parameter_sets]
+        to_compute = [idx for idx, errors in enumerate(batch_errors) if errors is None]
+        try:
+            with timer('objective_batch'):
+                computed = multi_phase_fit_batch(dbf, comps, error_context['phases'], datasets, phase_models,
+                                                 [parameter_sets[idx] for idx in to_compute], obj_callables=obj_funcs,
+                                                 grad_callables=grad_funcs, hess_callables=hess_funcs,
+                                                 scheduler=scheduler, reference_tables=reference_tables,
+                                                 subset=subset, metrics=metrics)
+            for idx, errors in zip(to_compute, computed):
+                batch_errors[idx] = errors
+                if cache is not None:
+                    cache.put(parameter_sets[idx], errors, extra=subset)
+        except ValueError as e:
+            print(e)
+            for idx in to_compute:
+                batch_errors[idx] = [np.inf]
+        elapsed = time.time() - enter_time
+        cache_stats = [cache.hits, cache.misses] if cache is not None else ['', '']
+        for idx, parameters, iter_error in zip(in_bounds, parameter_sets, batch_errors):
+            iter_error = -np.sum([np.inf if np.isnan(x) else x**2 for x in iter_error])
+            log_probs[idx] = iter_error
+            metrics.record_iteration(-iter_error, elapsed / len(parameter_sets), estimate=subset is not None)
+            if recfile:
+                with error_context['recfile_lock']:
+                    recfile.write(','.join([str(-iter_error), str(elapsed / len(parameter_sets))] +
+                                           [str(x) for x in parameters.values()] +
+                                           [str(x) for x in cache_stats] +
+                                           [str(subset.fraction if subset is not None else 1.0)]) + '\n')
+        print(elapsed, 'batch exit', len(parameter_sets), np.max(log_probs), 'cache hits/misses', *cache_stats,
+              flush=True)
+        return log_probs
+
+    if screening is not None:
+        screening = dict(screening)
+        mu_star, sigma = _morris_screening(log_prob_batch, [bounds[x] for x in symbols_to_fit],
+                                           trajectories=screening.pop('trajectories', 4),
+                                           levels=screening.pop('levels', 4))
+        frozen_parameters.update(_freeze_inert_parameters(symbols_to_fit, initial_values, mu_star, sigma,
+                                                          **screening))
+        free_symbols[:] = [x for x in symbols_to_fit if x not in frozen_parameters]
+        if len(free_symbols) == 0:
+            raise ValueError('Screening froze every parameter; lower the screening threshold')
+    model_dof = build_model(initial_values)
     pymod = pymc.Model(model_dof)
     mdl = pymc.MCMC(pymod)
+    minibatch = dict(minibatch) if minibatch is not None else {}
+    fractions = [f for f in minibatch.get('fractions', [0.1, 0.3, 1.0] if minibatch else []) if f < 1] + [1.0]
     try:
-        pymc.MAP(pymod).fit()
-        #mdl.sample(iter=100, burn=0, burn_till_tuned=False, thin=2, progress_bar=True)
+        for fraction in fractions:
+            if fraction < 1:
+                minibatch_state['subset'] = ZPFSubset(datasets, comps, error_context['phases'], fraction,
+                                                      seed=minibatch.get('seed', 0))
+                print('Optimizing on {} of {} ZPF tie-lines'.format(minibatch_state['subset'].selected,
+                                                                  minibatch_state['subset'].total), flush=True)
+            else:
+                minibatch_state['subset'] = None
+            if surrogate is not None:
+                # Each stage starts from the previous stage's result
+                stage_values = {x: float(variable.value) for x, variable in zip(free_symbols, model_dof)}
+                _surrogate_optimize(log_prob_batch, free_symbols, frozen_parameters, stage_values, bounds,
+                                    model_dof, **surrogate)
+            else:
+                pymc.MAP(pymod).fit()
+        if mcmc is not None:
+            mcmc = dict(mcmc)
+            map_values = {key: float(variable.value) for key, variable in zip(free_symbols, model_dof)}
+            if mcmc.pop('sampler', 'metropolis') == 'ensemble':
+                mdl = _ensemble_sample(log_prob_batch, free_symbols, map_values, bounds, **mcmc)
+            else:
+                mdl = _sample_chains(build_model, free_symbols, map_values, bounds, **mcmc)
     finally:
         if recfile:
             recfile.close()
-    model_dof = result_obj['model_dof']
-    dbf = dbf.compute()
-    for key, variable in zip(symbols_to_fit, model_dof):
+    dbf = local_dbf
+    dbf.symbols.update(lowered_symbols)
+    for key, variable in zip(free_symbols, model_dof):
         dbf.symbols[key] = variable.value
+    dbf.symbols.update(frozen_parameters)
+    bump_model_revision(dbf)
     return dbf, mdl, model_dof
@@ -3,113 +3,332 @@ from pycalphad import Database
 from sumatra.projects import load_project
 from sumatra.parameters import build_parameters
 from sumatra.datastore.filesystem import DataFile
-from corner import corner
-import tables
+from sumatra.datastore.base import DataKey
 import matplotlib
+# Figures are rendered in worker processes with no display
+matplotlib.use('Agg')
 matplotlib.style.use('bmh')
+from corner import corner
+from cornerplot import CornerHistogram, binned_corner
+import tracestore
+from inputstore import InputStore
+from diagnostics import (autocorrelation, iat_from_acf, StreamingSummary, split_gelman_rubin,
+                         effective_sample_size, acceptance_rate)
 import matplotlib.pyplot as plt
 import pymc
-from pymc.database.base import batchsd
-from pymc import utils
 import numpy as np
 import sys
 import os
-import shutil
+import mimetypes
+import multiprocessing
+import threading
 import time
 import glob
 import csv
-from collections import OrderedDict, defaultdict
+from datetime import datetime
+from collections import OrderedDict, defaultdict, deque
 from itertools import chain
 
 
-def autocorr(x):
-    x = (x - x.mean()) / np.linalg.norm(x)
-    result = np.correlate(x, x, mode='full')
-    return result[result.size/2:]
-
 output_files = []
 
 
+class ConvergenceMonitor(object):
+    """
+    Checks convergence on the most recent trace chunks of every chain as they are written,
+    and halts sampling once the targets are met.
+
+    Parameters
+    ==========
+    samplers : list of pymc.MCMC
+    target_ess : float, optional
+        Minimum effective sample size of every parameter, summed over chains.
+    target_rhat : float, optional
+        Maximum split R-hat of every parameter across chains.
+    window_chunks : int, optional
+        Number of most recent chunks per chain the diagnostics are computed on.
+    min_acceptance : float, optional
+        Minimum mean acceptance rate.
+    log_fname : str, optional
+        CSV file to append the diagnostics to after each check.
+    """
+    def __init__(self, samplers, target_ess=1000, target_rhat=1.01, window_chunks=10, min_acceptance=0.0,
+                 log_fname=None):
+        self.samplers = samplers
+        self.target_ess = target_ess
+        self.target_rhat = target_rhat
+        self.window_chunks = window_chunks
+        self.min_acceptance = min_acceptance
+        self.log_fname = log_fname
+        self.stop_reason = None
+        self._recent = OrderedDict()
+        self._samples = defaultdict(int)
+        self._columns = {}
+        self._lock = threading.Lock()
+
+    def chunk_written(self, chain_path, chunk_fname):
+        "Chunk listener; runs on the writer thread of the chain."
+        if chain_path not in self._columns:
+            columns = tracestore.ChainReader(chain_path).columns
+            self._columns[chain_path] = [idx for idx, name in enumerate(columns)
+                                         if not name.startswith('Metropolis') and name != 'deviance']
+        block = np.column_stack(tracestore.Chunk(chunk_fname).read(self._columns[chain_path]))
+        with self._lock:
+            self._recent.setdefault(chain_path, deque(maxlen=self.window_chunks)).append(block)
+            self._samples[chain_path] += block.shape[0]
+            if len(self._recent) == len(self.samplers) and self.stop_reason is None:
+                self._check()
+
+    def _check(self):
+        windows = [np.concatenate(list(blocks)) for blocks in self._recent.values()]
+        length = min(len(window) for window in windows)
+        # Chains are compared over their most recent samples, aligned to the same length
+        windows = np.array([window[-length:] for window in windows])
+        rhat = np.nanmax(split_gelman_rubin(windows))
+        ess = np.min(np.sum([effective_sample_size(window) for window in windows], axis=0))
+        acceptance = np.nanmean([acceptance_rate(window) for window in windows])
+        iteration = min(self._samples.values())
+        print('CONVERGENCE', iteration, 'ESS', ess, 'R-hat', rhat, 'acceptance', acceptance)
+        if self.log_fname is not None:
+            new_file = not os.path.exists(self.log_fname)
+            with open(self.log_fname, 'a') as csvfile:
+                writer = csv.writer(csvfile)
+                if new_file:
+                    writer.writerow(['samples', 'ESS', 'R-hat', 'acceptance'])
+                writer.writerow([iteration, ess, rhat, acceptance])
+        if ess >= self.target_ess and rhat <= self.target_rhat and acceptance >= self.min_acceptance:
+            self.stop_reason = ('Stopped early after {} samples per chain: ESS {:.0f} >= {}, '
+                                'R-hat {:.4f} <= {}, acceptance {:.3f}').format(iteration, ess, self.target_ess,
+                                                                               rhat, self.target_rhat, acceptance)
+            for sampler in self.samplers:
+                sampler.status = 'halt'
+
+
 def main(parameters, seed):
     np.random.seed(seed)
     input_database = Database(parameters['input_database'])
     dataset_names = sorted(glob.glob(parameters['data_path']))
-    params = []
-    for pname, paramdist in parameters['parameters'].items():
-        paramdist = paramdist.copy()  # don't want to modify original
-        paramdist.pop('compare')  # don't pass this as a kwarg
-        dist = getattr(pymc, paramdist.pop('dist'))
-        params.append(dist(str(pname), **paramdist))
-    mod, datasets = build_pymc_model(input_database, dataset_names, params)
     trace_path = os.path.join('Data', parameters['sumatra_label'])
     os.makedirs(trace_path)
-    mdl = pymc.MCMC(mod, db='hdf5', dbname=str(os.path.join(trace_path, 'traces.h5')),
-                    dbcomplevel=4, dbcomplib='bzip2')
-    mdl.sample(**parameters['mcmc'])
-    mdl.db.close()
-    output_files.append(os.path.join(parameters['sumatra_label'], 'traces.h5'))
-    return datasets
+    num_chains = parameters.as_dict().get('chains', 1)
+    samplers = []
+    for chain_idx in range(num_chains):
+        # Each chain needs its own stochastics; initial values are drawn from the priors
+        params = []
+        for pname, paramdist in parameters['parameters'].items():
+            paramdist = paramdist.copy()  # don't want to modify original
+            paramdist.pop('compare')  # don't pass this as a kwarg
+            dist = getattr(pymc, paramdist.pop('dist'))
+            params.append(dist(str(pname), **paramdist))
+        mod, datasets = build_pymc_model(input_database, dataset_names, params)
+        # Chunked store: compression happens off the sampling thread and finished chunks can be read during sampling
+        db = tracestore.Database(str(os.path.join(trace_path, 'traces')),
+                                 chunk_size=parameters.as_dict().get('trace_chunk_size', 1000))
+        samplers.append(pymc.MCMC(mod, db=db))
+    monitor = None
+    if 'convergence' in parameters.as_dict():
+        monitor = ConvergenceMonitor(samplers, log_fname=str(os.path.join(trace_path, 'convergence.csv')),
+                                     **parameters.as_dict()['convergence'])
+        for mdl in samplers:
+            mdl.db.add_chunk_listener(monitor.chunk_written)
+    failures = []
 
+    def run_chain(mdl):
+        try:
+            mdl.sample(**parameters['mcmc'])
+        except Exception as e:
+            failures.append(e)
+        finally:
+            mdl.db.close()
 
-def analyze(parameters, datasets):
-    image_path = os.path.join('Data', parameters['sumatra_label'])
-    # Save traces
-    trace_file = str(os.path.join('Data', parameters['sumatra_label'], 'traces.h5'))
-    data_dict = OrderedDict()
-    os.makedirs(os.path.join(image_path, 'acf'))
-    with tables.open_file(trace_file, mode='r') as data:
-        parnames = [x for x in data.root.chain0.PyMCsamples.colnames
-                    if not x.startswith('Metropolis') and x != 'deviance']
-        for param in sorted(parnames):
-            data_dict[param] = np.asarray(data.root.chain0.PyMCsamples.read(field=param), dtype='float')
-    for param, trace in data_dict.items():
+    threads = [threading.Thread(target=run_chain, args=(mdl,), name='chain{}'.format(idx))
+               for idx, mdl in enumerate(samplers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(failures) > 0:
+        raise failures[0]
+    output_files.extend(os.path.relpath(fname, 'Data') for fname in samplers[0].db.store.files())
+    if monitor is not None and os.path.exists(monitor.log_fname):
+        output_files.append(os.path.relpath(monitor.log_fname, 'Data'))
+    if monitor is not None and monitor.stop_reason is not None:
+        stop_reason = monitor.stop_reason
+    else:
+        stop_reason = 'Completed all {} iterations'.format(parameters.as_dict()['mcmc'].get('iter', ''))
+    return datasets, stop_reason
+
+
+def _stream_blocks(chains, columns):
+    "Yield (N, len(columns)) arrays, one per finished chunk, over all chains in order."
+    for chain in chains:
+        for chunk in chain.iter_chunks(columns):
+            yield np.column_stack([chunk[column] for column in columns])
+
+
+def _stream_thinned(chains, columns, step):
+    "Like _stream_blocks, but keeping only every step-th sample across chunk boundaries."
+    offset = 0
+    for block in _stream_blocks(chains, columns):
+        yield block[(-offset) % step::step]
+        offset += block.shape[0]
+
+
+def _read_thinned(chains, columns, step):
+    "Read every step-th sample of each column, keeping only the thinned samples in memory."
+    parts = list(_stream_thinned(chains, columns, step))
+    if len(parts) == 0:
+        return np.zeros((0, len(columns)))
+    return np.concatenate(parts)
+
+
+# State shared with the figure rendering processes. It is set before the pool is created and
+# inherited through fork, so the datasets and databases are never pickled.
+_render_state = {}
+
+
+def _up_to_date(fname, source_mtime):
+    return os.path.exists(fname) and os.path.getmtime(fname) >= source_mtime
+
+
+def _render_acf(param):
+    """
+    Plot the autocorrelation function of one parameter and return its integrated autocorrelation time.
+    Returns NaN, without a figure, if no chain has at least two samples.
+    """
+    state = _render_state
+    # One chain in memory at a time; concatenating chains would also add spurious correlation at the joins
+    acfs = [autocorrelation(chain.read(param)) for chain in tracestore.TraceStore(state['trace_path']).chains()
+            if chain.rows > 1]
+    if len(acfs) == 0:
+        # Too few samples, e.g., sampling stopped early or burn-in took them all
+        return np.nan
+    length = min(len(acf) for acf in acfs)
+    acf = np.mean([acf[:length] for acf in acfs], axis=0)
+    fname = os.path.join(state['image_path'], 'acf', param+'.png')
+    if not _up_to_date(fname, state['trace_mtime']):
         figure = plt.figure()
-        figure.gca().plot(autocorr(trace))
+        figure.gca().plot(acf)
         figure.gca().set_title(param+' Autocorrelation')
-        figure.savefig(str(os.path.join(image_path, 'acf', param+'.png')))
+        figure.savefig(str(fname))
         plt.close(figure)
-        output_files.append(str(os.path.join(parameters['sumatra_label'], 'acf', param+'.png')))
-
-    data = np.vstack(list(data_dict.values())).T
-    data_truths = [parameters.as_dict()['parameters'][key].get('compare', None) for key in data_dict.keys()]
-    figure = corner(data, labels=list(data_dict.keys()),
-                    quantiles=[0.16, 0.5, 0.84],
-                    truths=data_truths,
-                    show_titles=True, title_args={"fontsize": 40}, rasterized=True)
-    figure.savefig(str(os.path.join(image_path, 'cornerplot.png')))
-    output_files.append(str(os.path.join(parameters['sumatra_label'], 'cornerplot.png')))
-    plt.close(figure)
-    # Write CSV file with parameter summary (should be close to pymc's format)
-    with open(str(os.path.join(image_path, 'parameters.csv')), 'w') as csvfile:
-        fieldnames = ['Parameter', 'Mean', 'SD', 'Lower 95% HPD', 'Upper 95% HPD',
-                      'MC error', 'q2.5', 'q25', 'q50', 'q75', 'q97.5']
-        writer = csv.DictWriter(csvfile, fieldnames)
-        writer.writeheader()
-        for parname, trace in data_dict.items():
-            qxx = utils.quantiles(trace, qlist=(2.5, 25, 50, 75, 97.5))
-            q2d5, q25, q50, q75, q975 = qxx[2.5], qxx[25], qxx[50], qxx[75], qxx[97.5]
-            lower_hpd, upper_hpd = utils.hpd(trace, 0.05)
-            row = {
-                'Parameter': parname,
-                'Mean': trace.mean(0),
-                'SD': trace.std(0),
-                'Lower 95% HPD': lower_hpd,
-                'Upper 95% HPD': upper_hpd,
-                'MC error': batchsd(trace, min(len(trace), 100)),
-                'q2.5': q2d5, 'q25': q25, 'q50': q50, 'q75': q75, 'q97.5': q975
-            }
-            writer.writerow(row)
-    output_files.append(str(os.path.join(parameters['sumatra_label'], 'parameters.csv')))
-    # Generate comparison figures
-    os.makedirs(os.path.join(image_path, 'results'))
-    input_database = Database(parameters['input_database'])
-    compare_databases = {key: Database(value) for key, value in parameters['compare_databases'].items()}
-    idx = 1
-    for fig in plot_results(input_database, datasets, data_dict, databases=compare_databases):
-        fig.savefig(str(os.path.join(image_path, 'results', 'Figure{}.png'.format(idx))))
-        output_files.append(str(os.path.join(parameters['sumatra_label'], 'results', 'Figure{}.png'.format(idx))))
+    return iat_from_acf(acf)
+
+
+def _render_corner(thin):
+    state = _render_state
+    fname = os.path.join(state['image_path'], 'cornerplot.png')
+    if not _up_to_date(fname, state['trace_mtime']):
+        parnames = state['parnames']
+        chains = tracestore.TraceStore(state['trace_path']).chains()
+        data_truths = [state['parameters']['parameters'][key].get('compare', None) for key in parnames]
+        if state['parameters'].get('corner_mode', 'histogram') == 'histogram':
+            # Binned counts: rendering cost depends on the parameter and bin counts, not the trace length
+            hist = CornerHistogram(state['corner_ranges'], bins=state['parameters'].get('corner_bins', 50))
+            for block in _stream_thinned(chains, parnames, thin):
+                hist.update(block)
+            figure = binned_corner(hist, parnames, quantiles=[0.16, 0.5, 0.84], truths=data_truths,
+                                   show_titles=True, title_kwargs={"fontsize": 12})
+        else:
+            figure = corner(_read_thinned(chains, parnames, thin), labels=parnames,
+                            quantiles=[0.16, 0.5, 0.84],
+                            truths=data_truths,
+                            show_titles=True, title_args={"fontsize": 40}, rasterized=True)
+        figure.savefig(str(fname))
+        plt.close(figure)
+    return [fname]
+
+
+def _render_results(dataset_idx, thin):
+    "Plot the comparison figures for one dataset. Returns the figure file names."
+    state = _render_state
+    pattern = os.path.join(state['image_path'], 'results', 'Figure{}-*.png'.format(dataset_idx + 1))
+    existing = sorted(glob.glob(pattern))
+    if len(existing) > 0 and all(_up_to_date(fname, state['trace_mtime']) for fname in existing):
+        return existing
+    parnames = state['parnames']
+    data = _read_thinned(tracestore.TraceStore(state['trace_path']).chains(), parnames, thin)
+    data_dict = OrderedDict((param, data[:, param_idx]) for param_idx, param in enumerate(parnames))
+    input_database = Database(state['parameters']['input_database'])
+    fnames = []
+    for fig in plot_results(input_database, [state['datasets'][dataset_idx]], data_dict,
+                            databases=state['compare_databases']):
+        fname = pattern.replace('*', str(len(fnames) + 1))
+        fig.savefig(str(fname))
         plt.close(fig)
-        idx += 1
+        fnames.append(fname)
+    return fnames
+
+
+def analyze(parameters, datasets):
+    image_path = os.path.join('Data', parameters['sumatra_label'])
+    trace_path = str(os.path.join(image_path, 'traces'))
+    # Traces are never loaded whole: statistics are computed in a single pass over the chunks
+    store = tracestore.TraceStore(trace_path)
+    chains = store.chains()
+    os.makedirs(os.path.join(image_path, 'acf'), exist_ok=True)
+    os.makedirs(os.path.join(image_path, 'results'), exist_ok=True)
+    parnames = sorted(x for x in chains[0].columns
+                      if not x.startswith('Metropolis') and x != 'deviance')
+    total_samples = sum(chain.rows for chain in chains)
+    summary = StreamingSummary(len(parnames), total_samples)
+    for block in _stream_blocks(chains, parnames):
+        summary.update(block)
+
+    # Each figure is an independent job; jobs read only the trace columns they need from the store
+    _render_state.clear()
+    _render_state.update(trace_path=trace_path, image_path=image_path, parnames=parnames,
+                         trace_mtime=max(chain.mtime() for chain in chains),
+                         corner_ranges=summary.quantiles((0.1, 99.9)),
+                         parameters=parameters.as_dict(), datasets=datasets,
+                         compare_databases={key: Database(value)
+                                            for key, value in parameters['compare_databases'].items()})
+    processes = parameters.as_dict().get('plot_processes', None) or os.cpu_count()
+    # Each autocorrelation job holds one chain's column and its FFT buffers (about four times the
+    # zero-padded column), so run only as many processes at once as fit in the budget
+    memory_budget = parameters.as_dict().get('analysis_memory_mb', 256) * 2**20
+    per_process = 4 * 2 * 8 * max([chain.rows for chain in chains] + [1])
+    processes = max(1, min(processes, int(memory_budget // per_process)))
+    pool = multiprocessing.get_context('fork').Pool(processes)
+    try:
+        iats = np.array(pool.map(_render_acf, parnames))
+        output_files.extend(str(os.path.join(parameters['sumatra_label'], 'acf', param+'.png'))
+                            for param, iat in zip(parnames, iats) if np.isfinite(iat))
+        # Thinning by the autocorrelation time keeps (nearly) all the information in the trace
+        thin = max(1, int(np.ceil(np.nanmax(iats)))) if np.any(np.isfinite(iats)) else 1
+        figure_jobs = [pool.apply_async(_render_corner, (thin,))]
+        figure_jobs.extend(pool.apply_async(_render_results, (dataset_idx, thin))
+                           for dataset_idx in range(len(datasets)))
+        # Write CSV file with parameter summary (should be close to pymc's format) while the figures render
+        with open(str(os.path.join(image_path, 'parameters.csv')), 'w') as csvfile:
+            fieldnames = ['Parameter', 'Mean', 'SD', 'Lower 95% HPD', 'Upper 95% HPD',
+                          'MC error', 'IAT', 'ESS', 'q2.5', 'q25', 'q50', 'q75', 'q97.5']
+            writer = csv.DictWriter(csvfile, fieldnames)
+            writer.writeheader()
+            quantiles = summary.quantiles((2.5, 25, 50, 75, 97.5))
+            hpds = summary.hpd(0.05)
+            for param_idx, parname in enumerate(parnames):
+                q2d5, q25, q50, q75, q975 = quantiles[param_idx]
+                lower_hpd, upper_hpd = hpds[param_idx]
+                row = {
+                    'Parameter': parname,
+                    'Mean': summary.mean[param_idx],
+                    'SD': summary.std[param_idx],
+                    'Lower 95% HPD': lower_hpd,
+                    'Upper 95% HPD': upper_hpd,
+                    'MC error': summary.mc_error[param_idx],
+                    'IAT': iats[param_idx],
+                    'ESS': total_samples / iats[param_idx],
+                    'q2.5': q2d5, 'q25': q25, 'q50': q50, 'q75': q75, 'q97.5': q975
+                }
+                writer.writerow(row)
+        output_files.append(str(os.path.join(parameters['sumatra_label'], 'parameters.csv')))
+        for job in figure_jobs:
+            output_files.extend(os.path.relpath(fname, 'Data') for fname in job.get())
+    finally:
+        pool.close()
+        pool.join()
+        _render_state.clear()
 
 parameter_file = sys.argv[1]
 parameters = build_parameters(parameter_file)
@@ -127,7 +346,8 @@ seed = parameters.as_dict().get('seed', np.random.randint(0, 1e5))
 parameters.update({"sumatra_label": record.label, "seed": seed})
 start_time = time.time()
 
-datasets = main(parameters, seed)
+datasets, stop_reason = main(parameters, seed)
+record.outcome = stop_reason
 analyze(parameters, datasets)
 
 record.duration = time.time() - start_time
@@ -137,14 +357,22 @@ os.makedirs(input_path)
 
 mime_exts = defaultdict(lambda: 'text/plain')
 mime_exts.update({'.csv': 'text/csv',
-                  '.h5': None})
+                  '.h5': None,
+                  '.trc': 'application/octet-stream',
+                  '.json': 'application/json'})
 
+# Inputs are stored once by content and hardlinked into each record, so only changed files are hashed or copied
+input_store = InputStore(os.path.join('Data', 'objects'))
 for inp in [parameters['input_database']] + sorted(glob.glob(parameters['data_path'])):
-    # copy2 preserves most metadata
-    shutil.copy2(str(inp), input_path)
-    record.input_data.append(DataFile(os.path.join(str(parameters['sumatra_label']), 'input',
-                                                   os.path.basename(str(inp))),
-                                      project.data_store).generate_key())
+    digest = input_store.add(str(inp))
+    dest = os.path.join(input_path, os.path.basename(str(inp)))
+    input_store.link(digest, dest)
+    mimetype, encoding = mimetypes.guess_type(dest)
+    record.input_data.append(DataKey(os.path.join(str(parameters['sumatra_label']), 'input',
+                                                  os.path.basename(str(inp))),
+                                     digest, datetime.fromtimestamp(os.stat(dest).st_ctime),
+                                     mimetype=mimetype, encoding=encoding, size=os.path.getsize(dest)))
+input_store.save()
 
 for outp in output_files:
     record.output_data.append(DataFile(outp,
@@ -0,0 +1,188 @@
+"""
+The surrogate module minimizes expensive objectives with a trust-region method driven by a
+cheap local model.
+
+A separable quadratic (linear terms plus diagonal curvature) is fit by least squares to the
+evaluated points near the current best point. Candidates are proposed by minimizing the model
+within the trust region, and the real objective is only used to accept or reject them and to
+refresh the model. Candidates are evaluated in batches, so several can share one round of
+cluster work.
+"""
+import numpy as np
+
+
+def fit_diagonal_quadratic(points, values, center, ridge=1e-8):
+    """
+    Least-squares fit of f(x) ~ c + g.(x - center) + 0.5 * sum(h * (x - center)**2).
+
+    Parameters
+    ==========
+    points : ndarray (K, ndim)
+    values : ndarray (K,)
+    center : ndarray (ndim,)
+    ridge : float, optional
+        Tikhonov regularization, relative to the scale of the design matrix.
+
+    Returns
+    =======
+    (c, g, h)
+    """
+    offsets = points - center
+    design = np.hstack([np.ones((len(points), 1)), offsets, 0.5 * offsets ** 2])
+    scale = np.maximum(np.abs(design).max(axis=0), 1e-300)
+    design = design / scale
+    lhs = design.T.dot(design) + ridge * np.eye(design.shape[1])
+    coefficients = np.linalg.solve(lhs, design.T.dot(values)) / scale
+    ndim = points.shape[1]
+    return coefficients[0], coefficients[1:ndim+1], coefficients[ndim+1:]
+
+
+def minimize_diagonal_quadratic(g, h, radius, lower, upper):
+    """
+    Minimize g.s + 0.5 * sum(h * s**2) over the box |s| <= radius, lower <= s <= upper.
+    Separable, so each coordinate is minimized on its own.
+    """
+    lo = np.maximum(-radius, lower)
+    hi = np.minimum(radius, upper)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stationary = np.where(h > 0, -g / h, np.nan)
+    # Candidates per coordinate: both ends of the interval and the stationary point if inside
+    candidates = np.stack([lo, hi, np.clip(np.nan_to_num(stationary), lo, hi)])
+    model = g * candidates + 0.5 * h * candidates ** 2
+    return candidates[np.argmin(model, axis=0), np.arange(len(g))]
+
+
+class SurrogateOptimizer(object):
+    """
+    Trust-region minimization of an expensive objective with a separable quadratic surrogate.
+    Works in coordinates scaled to the unit box given by the bounds.
+
+    Parameters
+    ==========
+    objective_batch : callable
+        Maps an array of points (K, ndim) to objective values (K,). Non-finite values are treated as failures.
+    bounds : array_like (ndim, 2)
+    initial_radius : float, optional
+        Initial trust region radius, as a fraction of each bound width.
+    min_radius : float, optional
+        Smallest trust region radius. The search stops after 'max_failures' consecutive
+        iterations at this radius without improvement.
+    candidates : int, optional
+        Candidates evaluated per iteration: the model minimizer within the full, half, quarter, ... radius.
+    max_failures : int, optional
+
+    Dimensions whose bounds have zero width are held at their bound.
+
+    Attributes
+    ==========
+    points, values : ndarray
+        Every real evaluation so far, in original coordinates.
+    evaluations : int
+        Number of real evaluations made by this optimizer (excluding seeded history).
+    """
+    def __init__(self, objective_batch, bounds, initial_radius=0.1, min_radius=1e-4, candidates=2, max_failures=3):
+        self.objective_batch = objective_batch
+        self.bounds = np.array(bounds, dtype=np.float64)
+        self.fixed = self.bounds[:, 1] <= self.bounds[:, 0]
+        # Fixed dimensions get a unit scale; their unit coordinate stays at zero
+        self.width = np.where(self.fixed, 1.0, self.bounds[:, 1] - self.bounds[:, 0])
+        self.radius = initial_radius
+        self.min_radius = min_radius
+        self.candidates = candidates
+        self.max_failures = max_failures
+        self.points = np.zeros((0, len(self.bounds)))
+        self.values = np.zeros(0)
+        self.evaluations = 0
+
+    def _to_unit(self, x):
+        return (np.asarray(x) - self.bounds[:, 0]) / self.width
+
+    def _from_unit(self, u):
+        return self.bounds[:, 0] + np.asarray(u) * self.width
+
+    def add_history(self, points, values):
+        "Seed the surrogate with previous evaluations, e.g., from an iteration log."
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        values = np.asarray(values, dtype=np.float64)
+        keep = np.isfinite(values) & np.all(np.isfinite(points), axis=1)
+        self.points = np.vstack([self.points, points[keep]])
+        self.values = np.concatenate([self.values, values[keep]])
+
+    def _evaluate(self, unit_points):
+        points = self._from_unit(unit_points)
+        values = np.asarray(self.objective_batch(points), dtype=np.float64)
+        self.evaluations += len(points)
+        self.points = np.vstack([self.points, points])
+        self.values = np.concatenate([self.values, values])
+        return values
+
+    def _best(self):
+        finite = np.isfinite(self.values)
+        idx = np.flatnonzero(finite)[np.argmin(self.values[finite])]
+        return self._to_unit(self.points[idx]), self.values[idx]
+
+    def minimize(self, x0, max_evaluations=200, callback=None):
+        """
+        Parameters
+        ==========
+        x0 : array_like (ndim,)
+        max_evaluations : int, optional
+            Budget of real objective evaluations.
+        callback : callable, optional
+            Called as callback(evaluations, best_value, radius) after each iteration.
+
+        Returns
+        =======
+        (x, value) : best point found and its objective value
+        """
+        free = np.flatnonzero(~self.fixed)
+        ndim = len(free)
+        center = np.where(self.fixed, 0, self._to_unit(np.clip(x0, self.bounds[:, 0], self.bounds[:, 1])))
+        # Axis design around the start: enough points to fit the diagonal quadratic
+        design = [center]
+        for idx in free:
+            for sign in (1, -1):
+                point = center.copy()
+                point[idx] = np.clip(point[idx] + sign * self.radius, 0, 1)
+                design.append(point)
+        self._evaluate(np.array(design))
+        if not np.any(np.isfinite(self.values)):
+            raise ValueError('Objective is not finite at any point of the initial design')
+        center, center_value = self._best()
+        failures = 0
+        while ndim > 0 and self.evaluations < max_evaluations and failures < self.max_failures:
+            unit_points = self._to_unit(self.points)[:, free]
+            finite = np.isfinite(self.values)
+            # Fit to the points nearest the center, at least enough to determine the model
+            distances = np.max(np.abs(unit_points - center[free]), axis=1)
+            distances[~finite] = np.inf
+            num_fit = min(max(2 * ndim + 1, int(np.sum(distances <= 2 * self.radius))), int(np.sum(finite)))
+            nearest = np.argsort(distances)[:num_fit]
+            _, g, h = fit_diagonal_quadratic(unit_points[nearest], self.values[nearest], center[free])
+            steps = []
+            for k in range(self.candidates):
+                step = np.zeros_like(center)
+                step[free] = minimize_diagonal_quadratic(g, h, self.radius / 2 ** k, -center[free], 1 - center[free])
+                steps.append(step)
+            predicted = np.array([g.dot(s[free]) + 0.5 * h.dot(s[free] ** 2) for s in steps])
+            values = self._evaluate(np.array([center + s for s in steps]))
+            best_idx = np.argmin(np.where(np.isfinite(values), values, np.inf))
+            actual = center_value - values[best_idx]
+            ratio = actual / -predicted[best_idx] if predicted[best_idx] < 0 else -np.inf
+            improved = bool(np.isfinite(values[best_idx]) and values[best_idx] < center_value)
+            if improved:
+                center, center_value = center + steps[best_idx], values[best_idx]
+            # Standard trust region update on the agreement between model and objective
+            step_length = np.max(np.abs(steps[best_idx]))
+            if ratio > 0.75 and step_length >= 0.99 * self.radius:
+                self.radius = min(2 * self.radius, 0.5)
+            elif ratio < 0.25:
+                self.radius /= 2
+            if self.radius <= self.min_radius:
+                self.radius = self.min_radius
+                failures = 0 if improved else failures + 1
+            else:
+                failures = 0
+            if callback is not None:
+                callback(self.evaluations, center_value, self.radius)
+        return self._from_unit(center), center_value
@@ -0,0 +1,105 @@
+import numpy as np
+from diagnostics import (gelman_rubin, split_gelman_rubin, acceptance_rate, autocorrelation,
+                         integrated_autocorrelation_time, iat_from_acf, effective_sample_size,
+                         QuantileSketch, StreamingSummary)
+
+
+def ar1(phi, num_samples, num_series=1, seed=0):
+    "AR(1) series with unit stationary variance; their IAT is (1 + phi) / (1 - phi)."
+    random_state = np.random.RandomState(seed)
+    noise = random_state.normal(scale=np.sqrt(1 - phi**2), size=(num_samples, num_series))
+    x = np.empty_like(noise)
+    x[0] = random_state.normal(size=num_series)
+    for idx in range(1, num_samples):
+        x[idx] = phi * x[idx - 1] + noise[idx]
+    return x
+
+
+def test_autocorrelation_matches_direct_sum():
+    x = np.random.RandomState(0).normal(size=(100, 2))
+    acf = autocorrelation(x)
+    centered = x - x.mean(axis=0)
+    direct = np.array([np.sum(centered[:100 - lag] * centered[lag:], axis=0) for lag in range(100)])
+    assert np.allclose(acf, direct / direct[0])
+
+
+def test_iat_of_ar1():
+    for phi in (0.0, 0.5, 0.9):
+        x = ar1(phi, 100000, num_series=2)
+        expected = (1 + phi) / (1 - phi)
+        taus = integrated_autocorrelation_time(x)
+        assert np.allclose(taus, expected, rtol=0.1)
+        assert np.allclose(iat_from_acf(autocorrelation(x[:, 0])), taus[0])
+        assert np.allclose(effective_sample_size(x), 100000 / taus)
+
+
+def test_gelman_rubin():
+    chains = ar1(0.5, 2000, num_series=4, seed=1).T
+    assert abs(gelman_rubin(chains) - 1) < 0.01
+    assert abs(split_gelman_rubin(chains) - 1) < 0.01
+    shifted = chains + np.arange(4)[:, None]
+    assert gelman_rubin(shifted) > 1.5
+    # A single chain with a trend is only caught by splitting it
+    trend = chains[:1] + np.linspace(0, 3, 2000)
+    assert split_gelman_rubin(trend) > 1.1
+
+
+def test_gelman_rubin_per_parameter():
+    chains = np.stack([ar1(0.5, 1000, num_series=2, seed=seed) for seed in range(3)])
+    chains[:, :, 1] += np.arange(3)[:, None]
+    rhat = gelman_rubin(chains)
+    assert rhat.shape == (2,)
+    assert rhat[0] < 1.05 < rhat[1]
+
+
+def test_acceptance_rate():
+    x = np.array([[0, 0], [1, 0], [1, 0], [2, 1], [3, 1]])
+    assert np.allclose(acceptance_rate(x), [0.75, 0.25])
+
+
+def rank_error(samples, values, q):
+    "Largest distance between the requested quantiles and the empirical ranks of the returned values."
+    ranks = np.searchsorted(np.sort(samples), values, side='right') / float(len(samples))
+    return np.max(np.abs(ranks - q))
+
+
+def test_quantile_sketch_rank_error():
+    samples = np.random.RandomState(2).standard_t(3, size=200000)
+    sketch = QuantileSketch(k=256)
+    for block in np.array_split(samples, 97):
+        sketch.update(block)
+    q = np.array([0.001, 0.025, 0.25, 0.5, 0.75, 0.975, 0.999])
+    values = sketch.quantile(q)
+    assert rank_error(samples, values, q) < 0.01
+    assert np.allclose(values[2:5], np.percentile(samples, [25, 50, 75]), atol=0.05)
+    # Memory stays bounded by the level capacities
+    assert sum(len(items) for items in sketch.levels) <= 256 * len(sketch.levels)
+
+
+def test_quantile_sketch_merge():
+    samples = np.random.RandomState(3).normal(size=50000)
+    merged = QuantileSketch(k=128)
+    for part in np.array_split(samples, 5):
+        sketch = QuantileSketch(k=128)
+        sketch.update(part)
+        merged.merge(sketch)
+    q = np.linspace(0.01, 0.99, 25)
+    assert merged.count == len(samples)
+    assert rank_error(samples, merged.quantile(q), q) < 0.02
+
+
+def test_streaming_summary():
+    samples = ar1(0.5, 20000, num_series=3, seed=4) * [1, 2, 3] + [0, 10, -5]
+    summary = StreamingSummary(3, len(samples))
+    for block in np.array_split(samples, 13):
+        summary.update(block)
+    assert np.allclose(summary.mean, samples.mean(axis=0))
+    assert np.allclose(summary.std, samples.std(axis=0))
+    quantiles = summary.quantiles((2.5, 50, 97.5))
+    for param_idx in range(3):
+        assert rank_error(samples[:, param_idx], quantiles[param_idx], np.array([0.025, 0.5, 0.975])) < 0.01
+    lower, upper = summary.hpd(0.05).T
+    inside = np.mean((samples >= lower) & (samples <= upper), axis=0)
+    assert np.allclose(inside, 0.95, atol=0.01)
+    # Batch means of AR(1) series: the MC error is about sqrt(IAT / N) times the standard deviation
+    assert np.allclose(summary.mc_error, np.sqrt(3.0 / len(samples)) * np.array([1, 2, 3]), rtol=0.3)
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from ensemble import ChainStore, EnsembleSampler
+
+COVARIANCE = np.array([[1.0, 0.8], [0.8, 2.0]])
+PRECISION = np.linalg.inv(COVARIANCE)
+
+
+def gaussian_log_prob(positions):
+    return -0.5 * np.einsum('ij,jk,ik->i', positions, PRECISION, positions)
+
+
+def test_stretch_move_samples_target():
+    # With the z^(ndim-1) factor in the acceptance the stretch move leaves the target invariant,
+    # so long-run moments must match those of the correlated Gaussian
+    random_state = np.random.RandomState(1)
+    sampler = EnsembleSampler(gaussian_log_prob, 32, random_state=random_state)
+    sampler.run(random_state.normal(size=(32, 2)), 3000)
+    samples = sampler.chain[500:].reshape(-1, 2)
+    assert np.allclose(samples.mean(axis=0), 0, atol=0.1)
+    assert np.allclose(np.cov(samples.T), COVARIANCE, rtol=0.1, atol=0.05)
+    assert np.all((sampler.acceptance_fraction > 0.2) & (sampler.acceptance_fraction < 0.9))
+
+
+def test_stretch_move_batches_half_ensemble():
+    batch_sizes = []
+
+    def log_prob_batch(positions):
+        batch_sizes.append(len(positions))
+        return gaussian_log_prob(positions)
+
+    sampler = EnsembleSampler(log_prob_batch, 8, random_state=np.random.RandomState(0))
+    sampler.run(np.random.RandomState(0).normal(size=(8, 2)), 3)
+    assert batch_sizes == [8] + [4] * 6
+
+
+def test_chain_store_resume(tmp_path):
+    fname = str(tmp_path / 'ensemble.csv')
+    initial = np.random.RandomState(0).normal(size=(6, 2))
+    first = EnsembleSampler(gaussian_log_prob, 6, store=ChainStore(fname, ['a', 'b']),
+                            random_state=np.random.RandomState(2))
+    positions = first.run(initial, 5)
+    # Simulate an interrupted write of the next iteration
+    with open(fname, 'a') as f:
+        f.write('5,0,-1.0\n5,1,-1.0,0.1')
+    iteration, loaded, log_probs = ChainStore(fname, ['a', 'b']).load(6)
+    assert iteration == 4
+    assert np.array_equal(loaded, positions)
+    assert np.allclose(log_probs, gaussian_log_prob(positions))
+
+    calls = []
+
+    def log_prob_batch(positions):
+        calls.append(len(positions))
+        return gaussian_log_prob(positions)
+
+    second = EnsembleSampler(log_prob_batch, 6, store=ChainStore(fname, ['a', 'b']),
+                             random_state=np.random.RandomState(3))
+    second.run(initial, 8)
+    # The initial positions are not re-evaluated when resuming
+    assert calls == [3] * 6
+    assert second.chain.shape == (3, 6, 2)
+    assert ChainStore(fname, ['a', 'b']).load(6)[0] == 7
+
+
+def test_chain_store_rejects_other_parameters(tmp_path):
+    fname = str(tmp_path / 'ensemble.csv')
+    ChainStore(fname, ['a', 'b']).append(0, np.zeros((2, 2)), np.zeros(2))
+    with pytest.raises(ValueError):
+        ChainStore(fname, ['a', 'c']).load(2)
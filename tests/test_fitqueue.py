@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+import pytest
+from fitqueue import FairShareGate, check_output_paths
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Timed out')
+        time.sleep(0.001)
+
+
+def start_waiter(gate, name, admitted):
+    def run():
+        gate.acquire(name)
+        admitted.append(name)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def test_gate_capacity():
+    gate = FairShareGate(2)
+    admitted = []
+    for name in ('a', 'b', 'c'):
+        start_waiter(gate, name, admitted)
+    wait_for(lambda: len(admitted) == 2 and len(gate._waiting) == 1)
+    time.sleep(0.05)
+    assert len(admitted) == 2
+    gate.release(admitted[0])
+    wait_for(lambda: len(admitted) == 3)
+
+
+def test_gate_admits_fit_with_fewest_running():
+    gate = FairShareGate(2)
+    gate.acquire('a')
+    gate.acquire('a')
+    admitted = []
+    start_waiter(gate, 'a', admitted)
+    wait_for(lambda: len(gate._waiting) == 1)
+    start_waiter(gate, 'b', admitted)
+    wait_for(lambda: len(gate._waiting) == 2)
+    # 'b' has nothing running, so it goes first although 'a' has waited longer
+    gate.release('a')
+    wait_for(lambda: len(admitted) == 1)
+    assert admitted == ['b']
+    gate.release('a')
+    wait_for(lambda: len(admitted) == 2)
+    assert admitted == ['b', 'a']
+
+
+def test_gate_fills_slots_freed_together():
+    gate = FairShareGate(2)
+    gate.acquire('a')
+    gate.acquire('a')
+    admitted = []
+    for name in ('b', 'c'):
+        start_waiter(gate, name, admitted)
+        wait_for(lambda: name in [waiter[1] for waiter in gate._waiting])
+    # Both slots free up before either waiter runs; the first one admitted must wake the other
+    with gate._condition:
+        gate.release('a')
+        gate.release('a')
+    wait_for(lambda: len(admitted) == 2, timeout=2.0)
+    assert sorted(admitted) == ['b', 'c']
+
+
+def spec(name, tmp_path, **paths):
+    result = {'name': name, 'output_tdb': str(tmp_path / (name + '.tdb'))}
+    result.update(paths)
+    return result
+
+
+def test_check_output_paths_distinct(tmp_path):
+    check_output_paths([
+        spec('a', tmp_path, mcmc={'trace_path': str(tmp_path / 'a-traces')},
+             screening={'report': str(tmp_path / 'a-screening.csv')}, iter_record=str(tmp_path / 'a.csv')),
+        spec('b', tmp_path, mcmc={'trace_path': str(tmp_path / 'b-traces')}, screening={'report': None}),
+    ])
+
+
+def test_check_output_paths_conflicts(tmp_path):
+    traces = str(tmp_path / 'traces')
+    with pytest.raises(ValueError) as excinfo:
+        check_output_paths([spec('a', tmp_path, mcmc={'trace_path': traces}),
+                            spec('b', tmp_path, mcmc={'trace_path': os.path.join(traces, '..', 'traces')})])
+    assert 'mcmc trace_path of a' in str(excinfo.value)
+    assert 'mcmc trace_path of b' in str(excinfo.value)
+    with pytest.raises(ValueError):
+        check_output_paths([spec('a', tmp_path, iter_record=str(tmp_path / 'iterations.csv')),
+                            spec('b', tmp_path, screening={'report': str(tmp_path / 'iterations.csv')})])
+    # Two outputs of the same fit
+    with pytest.raises(ValueError):
+        check_output_paths([spec('a', tmp_path, iter_record=str(tmp_path / 'a.tdb'))])
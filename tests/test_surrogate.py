@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from surrogate import SurrogateOptimizer, fit_diagonal_quadratic, minimize_diagonal_quadratic
+
+
+def separable(points):
+    return np.sum((points - [0.3, -0.2, 0.5]) ** 2 * [1, 10, 100], axis=1)
+
+
+def correlated(points):
+    precision = np.linalg.inv([[1.0, 0.99], [0.99, 1.0]])
+    return 0.01 * np.einsum('ij,jk,ik->i', points, precision, points)
+
+
+def test_fit_diagonal_quadratic_is_exact_on_quadratics():
+    points = np.random.RandomState(0).uniform(-1, 1, size=(20, 2))
+    values = 2 + points.dot([1, -3]) + 0.5 * (points ** 2).dot([4, 0.5])
+    c, g, h = fit_diagonal_quadratic(points, values, np.zeros(2))
+    assert np.allclose([c], [2])
+    assert np.allclose(g, [1, -3])
+    assert np.allclose(h, [4, 0.5])
+
+
+def test_minimize_diagonal_quadratic_respects_box():
+    step = minimize_diagonal_quadratic(np.array([-1., 1., 1.]), np.array([4., 1., -1.]), 0.5,
+                                       np.array([-1., -1., -0.1]), np.array([1., 1., 1.]))
+    assert np.allclose(step, [0.25, -0.5, -0.1])
+
+
+def test_separable_quadratic():
+    optimizer = SurrogateOptimizer(separable, [(-1, 1)] * 3)
+    x, value = optimizer.minimize([0.9, 0.9, -0.9], max_evaluations=200)
+    assert np.allclose(x, [0.3, -0.2, 0.5], atol=1e-3)
+    assert value < 1e-6
+    assert optimizer.evaluations <= 201
+
+
+def test_correlated_quadratic():
+    # A separable model of a strongly correlated objective takes many short steps along the valley;
+    # the trust region must not collapse while they still make progress
+    start = [-0.8, 0.9]
+    optimizer = SurrogateOptimizer(correlated, [(-1, 1), (-1, 1)])
+    x, value = optimizer.minimize(start, max_evaluations=400)
+    assert optimizer.evaluations > 300
+    assert value < 1e-3 * correlated(np.array([start]))[0]
+
+
+def test_stops_after_repeated_failures():
+    # Flat objective: no step ever improves, so the radius shrinks to its minimum and the search stops
+    optimizer = SurrogateOptimizer(lambda points: np.ones(len(points)), [(-1, 1)] * 2, min_radius=1e-3)
+    optimizer.minimize([0, 0], max_evaluations=1000)
+    assert optimizer.evaluations < 100
+    assert optimizer.radius == 1e-3
+
+
+def test_zero_width_bounds():
+    optimizer = SurrogateOptimizer(separable, [(-1, 1), (0, 0), (-1, 1)])
+    x, value = optimizer.minimize([0.9, 0.0, -0.9], max_evaluations=200)
+    assert np.all(optimizer.points[:, 1] == 0)
+    assert np.allclose(x, [0.3, 0, 0.5], atol=1e-3)
+    assert value == pytest.approx(0.4, abs=1e-5)
+
+
+def test_all_bounds_zero_width():
+    optimizer = SurrogateOptimizer(separable, [(1, 1), (0, 0), (0, 0)])
+    x, value = optimizer.minimize([1, 0, 0])
+    assert optimizer.evaluations == 1
+    assert np.array_equal(x, [1, 0, 0])
+    assert value == pytest.approx(0.49 + 0.4 + 25)
+
+
+def test_history_and_callback():
+    progress = []
+    optimizer = SurrogateOptimizer(separable, [(-1, 1)] * 3)
+    optimizer.add_history([[0.3, -0.2, 0.5], [np.nan, 0, 0]], [0.0, 1.0])
+    x, value = optimizer.minimize([0.9, 0.9, -0.9], max_evaluations=20,
+                                  callback=lambda *args: progress.append(args))
+    # The seeded optimum is the best point once the initial design is evaluated
+    assert value == 0.0
+    assert len(optimizer.values) == 1 + optimizer.evaluations
+    assert len(progress) > 0 and progress[-1][0] == optimizer.evaluations
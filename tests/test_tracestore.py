@@ -0,0 +1,84 @@
+import os
+import numpy as np
+import pytest
+import tracestore
+from tracestore import ChainReader, TraceStore, write_chunk, Chunk
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'none'] + (['blosc-lz4'] if tracestore.blosc is not None else []))
+def test_chunk_round_trip(tmp_path, codec):
+    columns = [np.random.RandomState(0).normal(size=37), np.arange(37, dtype=np.float64)]
+    fname = str(tmp_path / 'chunk-000000.trc')
+    write_chunk(fname, columns, codec=codec)
+    chunk = Chunk(fname)
+    assert chunk.rows == 37
+    assert chunk.codec == codec
+    second, first = chunk.read([1, 0])
+    assert np.array_equal(first, columns[0])
+    assert np.array_equal(second, columns[1])
+    assert not os.path.exists(fname + '.tmp')
+
+
+def test_chain_round_trip(tmp_path):
+    store = TraceStore(str(tmp_path / 'traces'))
+    rows = np.random.RandomState(1).normal(size=(25, 3))
+    writer = store.new_chain(['a', 'b', 'c'], chunk_size=10, codec='zlib')
+    for row in rows:
+        writer.append(row)
+    writer.close()
+    reader, = store.chains()
+    assert reader.columns == ['a', 'b', 'c']
+    assert [chunk.rows for chunk in reader.chunks] == [10, 10, 5]
+    assert np.array_equal(reader.read('b'), rows[:, 1])
+    assert np.array_equal(reader.read('c', start=3, step=4), rows[3::4, 2])
+    blocks = list(reader.iter_chunks(['a'], start_chunk=1))
+    assert np.array_equal(np.concatenate([block['a'] for block in blocks]), rows[10:, 0])
+
+
+def test_discard_buffered(tmp_path):
+    writer = TraceStore(str(tmp_path)).new_chain(['a'], chunk_size=4, codec='zlib')
+    for value in range(6):
+        writer.append([value])
+    # Rows 0-3 are flushed; only rows 4 and 5 can be dropped
+    writer.discard_buffered(-10)
+    assert writer.rows == 4
+    assert writer._buffered == 0
+    writer.append([6])
+    writer.discard_buffered(5)
+    assert writer.rows == 5
+    writer.close()
+    assert np.array_equal(ChainReader(writer.path).read('a'), [0, 1, 2, 3, 6])
+
+
+def test_database_truncate(tmp_path):
+    pytest.importorskip('pymc')
+    db = tracestore.Database(str(tmp_path / 'traces'), chunk_size=4, codec='zlib')
+    db._initialize({'a': lambda: 0.0})
+    writer = db._writers[0]
+    for value in range(6):
+        writer.append([value])
+    db.truncate(5)
+    assert writer.rows == 5
+    with pytest.raises(ValueError):
+        db.truncate(2)
+    db.close()
+
+
+def test_resume_store(tmp_path):
+    root = str(tmp_path / 'traces')
+    writer = TraceStore(root).new_chain(['a'], chunk_size=3, codec='zlib')
+    for value in range(5):
+        writer.append([value])
+    reader = ChainReader(writer.path)
+    writer.close()
+    # A reader opened earlier picks up the chunks written since on refresh
+    assert reader.refresh().rows == 5
+    store = TraceStore(root)
+    second = store.new_chain(['a'], chunk_size=3, codec='zlib')
+    assert os.path.basename(second.path) == 'chain1'
+    second.append([10])
+    second.close()
+    assert [chain.rows for chain in store.chains()] == [5, 1]
+    assert set(store.files()) == set(
+        [os.path.join(path, 'columns.json') for path in store.chain_paths()] +
+        [chunk.fname for chain in store.chains() for chunk in chain.chunks])
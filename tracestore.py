@@ -0,0 +1,483 @@
+"""
+The tracestore module stores MCMC traces as directories of compressed, column-oriented chunks.
+
+Layout of a store:
+
+    <root>/chain0/columns.json          Column names, written when the chain is created
+    <root>/chain0/chunk-000000.trc      Samples 0 to chunk_size-1
+    <root>/chain0/chunk-000001.trc      ...
+    <root>/chain1/...
+
+Each chunk file starts with a one-line JSON header giving the row count, codec and byte
+range of every column, followed by the compressed columns. Reading one parameter only
+decompresses that parameter's blobs. Chunks are written by a background thread to a
+temporary name and renamed when complete, so sampling does not wait on compression
+and readers never see a partial chunk.
+
+Columns are compressed with blosc (LZ4, byte shuffle). blosc is a dependency (see
+environment.yml); if it is missing, chunks are written with zlib at its fastest level,
+which is several times slower, and a warning is logged.
+
+Run as a script to convert PyMC HDF5 trace files:
+
+    python tracestore.py Al-Ni/output-traces/*.hdf5
+"""
+import json
+import os
+import logging
+import queue
+import threading
+import zlib
+import numpy as np
+try:
+    import blosc
+except ImportError:
+    blosc = None
+try:
+    from pymc.database import base as pymc_base
+except ImportError:
+    pymc_base = None
+
+CHUNK_PREFIX = 'chunk-'
+CHUNK_SUFFIX = '.trc'
+
+_warned_fallback = False
+
+
+def default_codec():
+    global _warned_fallback
+    if blosc is not None:
+        return 'blosc-lz4'
+    if not _warned_fallback:
+        logging.warning('blosc is not installed; trace chunks will be compressed with zlib, which is much slower. '
+                        'Install python-blosc to restore the default codec.')
+        _warned_fallback = True
+    return 'zlib'
+
+
+def _compress(array, codec):
+    data = np.ascontiguousarray(array, dtype=np.float64).tobytes()
+    if codec == 'blosc-lz4':
+        return blosc.compress(data, typesize=8, cname='lz4', shuffle=blosc.SHUFFLE)
+    elif codec == 'zlib':
+        return zlib.compress(data, 1)
+    elif codec == 'none':
+        return data
+    raise ValueError('Unknown codec: {}'.format(codec))
+
+
+def _decompress(data, codec):
+    if codec == 'blosc-lz4':
+        if blosc is None:
+            raise ImportError('blosc is required to read this trace chunk')
+        data = blosc.decompress(data)
+    elif codec == 'zlib':
+        data = zlib.decompress(data)
+    elif codec != 'none':
+        raise ValueError('Unknown codec: {}'.format(codec))
+    return np.frombuffer(data, dtype=np.float64)
+
+
+def write_chunk(fname, columns, codec=None):
+    """
+    Write one chunk atomically.
+
+    Parameters
+    ==========
+    fname : str
+    columns : list of ndarray
+        One 1-D array per column, all the same length.
+    codec : str, optional
+        'blosc-lz4', 'zlib' or 'none'. Defaults to the fastest available.
+    """
+    codec = codec if codec is not None else default_codec()
+    blobs = [_compress(col, codec) for col in columns]
+    offsets = []
+    position = 0
+    for blob in blobs:
+        offsets.append([position, len(blob)])
+        position += len(blob)
+    header = {'rows': int(len(columns[0])) if len(columns) > 0 else 0, 'codec': codec, 'columns': offsets}
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        f.write(json.dumps(header).encode('utf-8') + b'\n')
+        for blob in blobs:
+            f.write(blob)
+    os.rename(tmp_fname, fname)
+
+
+class Chunk(object):
+    "Read access to one finished chunk file."
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            header = f.readline()
+        self._data_start = len(header)
+        header = json.loads(header.decode('utf-8'))
+        self.rows = header['rows']
+        self.codec = header['codec']
+        self._offsets = header['columns']
+
+    def read(self, indices):
+        """
+        Parameters
+        ==========
+        indices : list of int
+            Column indices.
+
+        Returns
+        =======
+        list of ndarray
+        """
+        result = []
+        with open(self.fname, 'rb') as f:
+            for idx in indices:
+                offset, length = self._offsets[idx]
+                f.seek(self._data_start + offset)
+                result.append(_decompress(f.read(length), self.codec))
+        return result
+
+
+class ChainReader(object):
+    """
+    Read access to the finished chunks of one chain. Safe to use while the chain is still being written;
+    call `refresh` to pick up chunks written since the reader was created.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'columns.json')) as f:
+            self.columns = json.load(f)
+        self.chunks = []
+        self.refresh()
+
+    def refresh(self):
+        known = set(c.fname for c in self.chunks)
+        fnames = sorted(fname for fname in os.listdir(self.path)
+                        if fname.startswith(CHUNK_PREFIX) and fname.endswith(CHUNK_SUFFIX))
+        for fname in fnames:
+            fname = os.path.join(self.path, fname)
+            if fname not in known:
+                self.chunks.append(Chunk(fname))
+        return self
+
+    @property
+    def rows(self):
+        return sum(c.rows for c in self.chunks)
+
+    def mtime(self):
+        "Modification time of the newest finished chunk, or 0 if there are none."
+        if len(self.chunks) == 0:
+            return 0
+        return max(os.path.getmtime(c.fname) for c in self.chunks)
+
+    def iter_chunks(self, columns=None, start_chunk=0):
+        """
+        Yield one OrderedDict-like dict of column name -> ndarray per chunk.
+
+        Parameters
+        ==========
+        columns : list of str, optional
+            Defaults to all columns.
+        start_chunk : int, optional
+            Skip chunks before this index.
+        """
+        columns = columns if columns is not None else self.columns
+        indices = [self.columns.index(c) for c in columns]
+        for chunk in self.chunks[start_chunk:]:
+            yield dict(zip(columns, chunk.read(indices)))
+
+    def read(self, column, start=0, stop=None, step=1):
+        "Read one full column (optionally sliced) into memory."
+        parts = [chunk[column] for chunk in self.iter_chunks([column])]
+        data = np.concatenate(parts) if len(parts) > 0 else np.zeros(0)
+        return data[start:stop:step]
+
+
+class ChainWriter(object):
+    """
+    Buffered, append-only writer for one chain. Full chunks are compressed and written
+    by a background thread.
+
+    Parameters
+    ==========
+    path : str
+        Chain directory. Must not already contain a chain.
+    columns : list of str
+    chunk_size : int
+        Rows per chunk.
+    codec : str, optional
+    """
+    def __init__(self, path, columns, chunk_size=1000, codec=None):
+        self.path = path
+        self.columns = list(columns)
+        self.chunk_size = chunk_size
+        self.codec = codec if codec is not None else default_codec()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'columns.json'), 'w') as f:
+            json.dump(self.columns, f)
+        self.rows = 0
+        self._buffer = np.empty((chunk_size, len(self.columns)), dtype=np.float64)
+        self._buffered = 0
+        self._chunk_idx = 0
+        self._listeners = []
+        self._errors = []
+        self._queue = queue.Queue(maxsize=4)
+        self._thread = threading.Thread(target=self._write_loop, name='tracestore-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add_listener(self, func):
+        "Call func(chain_path, chunk_fname) from the writer thread after each chunk is written."
+        self._listeners.append(func)
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            fname, block = item
+            try:
+                write_chunk(fname, list(block.T), codec=self.codec)
+                for listener in self._listeners:
+                    listener(self.path, fname)
+            except Exception as e:
+                self._errors.append(e)
+
+    def append(self, row):
+        if len(self._errors) > 0:
+            raise self._errors[0]
+        self._buffer[self._buffered] = row
+        self._buffered += 1
+        self.rows += 1
+        if self._buffered == self.chunk_size:
+            self._flush_buffer()
+
+    def _flush_buffer(self):
+        if self._buffered == 0:
+            return
+        fname = os.path.join(self.path, '{}{:06d}{}'.format(CHUNK_PREFIX, self._chunk_idx, CHUNK_SUFFIX))
+        self._queue.put((fname, self._buffer[:self._buffered].copy()))
+        self._chunk_idx += 1
+        self._buffered = 0
+
+    def discard_buffered(self, keep):
+        "Drop buffered rows beyond the first 'keep' rows of the buffer. Rows already flushed are kept."
+        dropped = self._buffered - min(max(keep, 0), self._buffered)
+        self._buffered -= dropped
+        self.rows -= dropped
+
+    def close(self):
+        "Write any partial chunk and wait for the background writer to finish."
+        self._flush_buffer()
+        self._queue.put(None)
+        self._thread.join()
+        if len(self._errors) > 0:
+            raise self._errors[0]
+
+
+class TraceStore(object):
+    """
+    Directory of chains.
+
+    Parameters
+    ==========
+    root : str
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def chain_paths(self):
+        if not os.path.isdir(self.root):
+            return []
+        names = [name for name in os.listdir(self.root)
+                 if name.startswith('chain') and os.path.exists(os.path.join(self.root, name, 'columns.json'))]
+        return [os.path.join(self.root, name) for name in sorted(names, key=lambda x: int(x[5:]))]
+
+    def chains(self):
+        return [ChainReader(path) for path in self.chain_paths()]
+
+    def new_chain(self, columns, chunk_size=1000, codec=None):
+        "Create the next free chainN directory. Safe to call from several threads or processes."
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        idx = 0
+        while True:
+            path = os.path.join(self.root, 'chain{}'.format(idx))
+            try:
+                os.mkdir(path)
+                break
+            except OSError:
+                if not os.path.exists(path):
+                    raise
+                idx += 1
+        return ChainWriter(path, columns, chunk_size=chunk_size, codec=codec)
+
+    def files(self):
+        "Paths of all files in the store, e.g., for archiving."
+        result = []
+        for path in self.chain_paths():
+            result.append(os.path.join(path, 'columns.json'))
+            result.extend(c.fname for c in ChainReader(path).chunks)
+        return result
+
+
+def convert_hdf5(src, dest, chunk_size=1000, codec=None):
+    """
+    Convert a PyMC HDF5 trace file (as written by pymc.MCMC(db='hdf5')) to a TraceStore.
+
+    Parameters
+    ==========
+    src : str
+        HDF5 file with one /chainN/PyMCsamples table per chain.
+    dest : str
+        Root directory of the new store.
+
+    Returns
+    =======
+    TraceStore
+    """
+    import tables
+    store = TraceStore(dest)
+    with tables.open_file(src, mode='r') as data:
+        groups = sorted((g for g in data.root._v_groups.values() if g._v_name.startswith('chain')),
+                        key=lambda g: int(g._v_name[5:]))
+        for group in groups:
+            table = group.PyMCsamples
+            columns = [c for c in table.colnames if len(table.coldescrs[c].shape) == 0]
+            writer = store.new_chain(columns, chunk_size=chunk_size, codec=codec)
+            for start in range(0, table.nrows, chunk_size):
+                block = table.read(start=start, stop=min(start + chunk_size, table.nrows))
+                for row in np.column_stack([np.asarray(block[c], dtype=np.float64) for c in columns]):
+                    writer.append(row)
+            writer.close()
+    return store
+
+
+if pymc_base is not None:
+    class Trace(pymc_base.Trace):
+        """
+        PyMC trace backed by a TraceStore chain. Samples are read from finished chunks
+        plus whatever is still buffered in the writer.
+        """
+        def _initialize(self, chain, length):
+            pass
+
+        def tally(self, chain):
+            # Rows are tallied by Database.tally
+            pass
+
+        def truncate(self, index, chain):
+            pass
+
+        def _column(self, chain):
+            if chain is None:
+                return np.concatenate([self._column(c) for c in range(self.db.chains)])
+            if chain < 0:
+                chain = range(self.db.chains)[chain]
+            writer = self.db._writers.get(chain, None)
+            reader = ChainReader(self.db._chain_paths[chain])
+            data = reader.read(self.name)
+            if writer is not None and writer._buffered > 0 and len(data) < writer.rows:
+                data = np.concatenate([data, writer._buffer[:writer._buffered, writer.columns.index(self.name)]])
+            return data
+
+        def gettrace(self, burn=0, thin=1, chain=-1, slicing=None):
+            if slicing is None:
+                slicing = slice(burn, None, thin)
+            return self._column(chain)[slicing]
+
+        __call__ = gettrace
+
+        def __getitem__(self, index):
+            return self._column(getattr(self, '_chain', -1))[index]
+
+        def length(self, chain=-1):
+            return len(self._column(chain))
+
+    class Database(pymc_base.Database):
+        """
+        PyMC database backend writing each chain to a TraceStore.
+
+        Parameters
+        ==========
+        dbname : str
+            Root directory of the store.
+        chunk_size : int
+        codec : str, optional
+        """
+        def __init__(self, dbname, chunk_size=1000, codec=None):
+            pymc_base.Database.__init__(self, dbname)
+            self.__name__ = 'tracestore'
+            self.__Trace__ = Trace
+            self.store = TraceStore(dbname)
+            self.chunk_size = chunk_size
+            self.codec = codec
+            self._writers = {}
+            self._chain_paths = {}
+            self._chunk_listeners = []
+
+        def add_chunk_listener(self, func):
+            "Call func(chain_path, chunk_fname) whenever a chunk of any chain has been written."
+            self._chunk_listeners.append(func)
+            for writer in self._writers.values():
+                writer.add_listener(func)
+
+        def _initialize(self, funs_to_tally, length=None):
+            names = sorted(funs_to_tally.keys())
+            for name in names:
+                value = np.asarray(funs_to_tally[name]())
+                if value.size != 1:
+                    raise ValueError('tracestore only supports scalar nodes; {} has shape {}'.format(name,
+                                                                                                    value.shape))
+                if name not in self._traces:
+                    self._traces[name] = self.__Trace__(name=name, getfunc=funs_to_tally[name], db=self)
+            writer = self.store.new_chain(names, chunk_size=self.chunk_size, codec=self.codec)
+            for listener in self._chunk_listeners:
+                writer.add_listener(listener)
+            self._writers[self.chains] = writer
+            self._chain_paths[self.chains] = writer.path
+            self.trace_names.append(names)
+            self.chains += 1
+
+        def tally(self, chain=-1):
+            chain = range(self.chains)[chain]
+            row = [float(np.asarray(self._traces[name]._getfunc())) for name in self.trace_names[chain]]
+            self._writers[chain].append(row)
+
+        def truncate(self, index, chain=-1):
+            chain = range(self.chains)[chain]
+            writer = self._writers.get(chain, None)
+            if writer is not None and index < writer.rows:
+                # Only rows which have not been written out can be dropped
+                dropped = writer.rows - index
+                if dropped > writer._buffered:
+                    raise ValueError('Cannot truncate chain {} to {} rows: only the last {} of its {} rows are '
+                                     'still buffered'.format(chain, index, writer._buffered, writer.rows))
+                writer.discard_buffered(writer._buffered - dropped)
+
+        def _finalize(self, chain=-1):
+            chain = range(self.chains)[chain]
+            writer = self._writers.pop(chain, None)
+            if writer is not None:
+                writer.close()
+            self.commit()
+
+        def close(self, *args, **kwargs):
+            for chain in list(self._writers.keys()):
+                self._finalize(chain)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert PyMC HDF5 trace files to chunked trace stores.')
+    parser.add_argument('sources', metavar='FILE', nargs='+', help='HDF5 trace files')
+    parser.add_argument('--output-dir', metavar='DIR', default=None,
+                        help='Directory for the new stores (default: next to each source file)')
+    parser.add_argument('--chunk-size', metavar='N', type=int, default=1000, help='Rows per chunk')
+    args = parser.parse_args()
+    for src in args.sources:
+        name = os.path.splitext(os.path.basename(src))[0]
+        dest = os.path.join(args.output_dir if args.output_dir else os.path.dirname(src), name + '.traces')
+        store = convert_hdf5(src, dest, chunk_size=args.chunk_size)
+        print('{} -> {} ({} chains)'.format(src, dest, len(store.chain_paths())))
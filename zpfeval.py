@@ -0,0 +1,195 @@
+"""
+The zpfeval module evaluates the ZPF error of single tie-lines on the dask workers.
+
+It is the only fitting module the workers need: tasks built by paramselect reference these
+functions, so a worker imports this module and pycalphad, but not paramselect, plotting,
+scikit-learn or the reference data. Keep its imports minimal.
+"""
+from collections import OrderedDict
+import os
+import textwrap
+import time
+import numpy as np
+import dask
+import pycalphad.variables as v
+from pycalphad import calculate, equilibrium
+from instrumentation import timer
+
+
+def estimate_hyperplane(dbf, comps, phases, current_statevars, comp_dicts, phase_obj_callables,
+                        phase_grad_callables, phase_hess_callables, phase_models, parameters,
+                        dataset=None, region=None):
+    with timer('estimate_hyperplane', dataset=dataset, region=region):
+        return _estimate_hyperplane(dbf, comps, phases, current_statevars, comp_dicts, phase_obj_callables,
+                                    phase_grad_callables, phase_hess_callables, phase_models, parameters,
+                                    dataset=dataset, region=region)
+
+
+def _estimate_hyperplane(dbf, comps, phases, current_statevars, comp_dicts, phase_obj_callables,
+                         phase_grad_callables, phase_hess_callables, phase_models, parameters,
+                         dataset=None, region=None):
+    region_chemical_potentials = []
+    parameters = OrderedDict(sorted(parameters.items(), key=str))
+    for cond_dict, phase_flag in comp_dicts:
+        # We are now considering a particular tie vertex
+        for key, val in cond_dict.items():
+            if val is None:
+                cond_dict[key] = np.nan
+        cond_dict.update(current_statevars)
+        # print('COND_DICT (MULTI)', cond_dict)
+        # print('PHASE FLAG', phase_flag)
+        if np.any(np.isnan(list(cond_dict.values()))):
+            # This composition is unknown -- it doesn't contribute to hyperplane estimation
+            pass
+        else:
+            # Extract chemical potential hyperplane from multi-phase calculation
+            # Note that we consider all phases in the system, not just ones in this tie region
+            with timer('equilibrium', dataset=dataset, region=region) as eq_timer:
+                multi_eqdata = equilibrium(dbf, comps, phases, cond_dict, pbar=False, verbose=False,
+                                           callables=phase_obj_callables, grad_callables=phase_grad_callables,
+                                           hess_callables=phase_hess_callables, model=phase_models,
+                                           scheduler=dask.async.get_sync, parameters=parameters)
+                eq_timer.failed = bool(np.all(np.isnan(multi_eqdata.NP.values)))
+            if eq_timer.failed:
+                error_time = time.time()
+                template_error = """
+                from pycalphad import Database, equilibrium
+                from pycalphad.variables import T, P, X
+                import dask
+                dbf_string = \"\"\"
+                {0}
+                \"\"\"
+                dbf = Database(dbf_string)
+                comps = {1}
+                phases = {2}
+                cond_dict = {3}
+                parameters = {4}
+                equilibrium(dbf, comps, phases, cond_dict, scheduler=dask.async.get_sync, parameters=parameters)
+                """
+                template_error = textwrap.dedent(template_error)
+                print('Dumping', 'error-'+str(error_time)+'.py')
+                with open('error-'+str(error_time)+'.py', 'w') as f:
+                    f.write(template_error.format(dbf.to_string(fmt='tdb'), comps, phases, cond_dict, {key: float(x) for key, x in parameters.items()}))
+            # print('MULTI_EQDATA', multi_eqdata)
+            # Does there exist only a single phase in the result with zero internal degrees of freedom?
+            # We should exclude those chemical potentials from the average because they are meaningless.
+            num_phases = len(np.squeeze(multi_eqdata['Phase'].values != ''))
+            zero_dof = np.all((multi_eqdata['Y'].values == 1.) | np.isnan(multi_eqdata['Y'].values))
+            if (num_phases == 1) and zero_dof:
+                region_chemical_potentials.append(np.full_like(np.squeeze(multi_eqdata['MU'].values), np.nan))
+            else:
+                region_chemical_potentials.append(np.squeeze(multi_eqdata['MU'].values))
+    # print('REGION_CHEMICAL_POTENTIALS', region_chemical_potentials)
+    region_chemical_potentials = np.nanmean(region_chemical_potentials, axis=0, dtype=np.float)
+    return region_chemical_potentials
+
+
+def tieline_error(dbf, comps, current_phase, cond_dict, region_chemical_potentials, phase_flag,
+                  phase_models, phase_obj_callables, phase_grad_callables, phase_hess_callables, parameters,
+                  dataset=None, region=None):
+    with timer('tieline_error', phase=current_phase, dataset=dataset, region=region):
+        return _tieline_error(dbf, comps, current_phase, cond_dict, region_chemical_potentials, phase_flag,
+                              phase_models, phase_obj_callables, phase_grad_callables, phase_hess_callables,
+                              parameters, dataset=dataset, region=region)
+
+
+def _tieline_error(dbf, comps, current_phase, cond_dict, region_chemical_potentials, phase_flag,
+                   phase_models, phase_obj_callables, phase_grad_callables, phase_hess_callables, parameters,
+                   dataset=None, region=None):
+    labels = dict(phase=current_phase, dataset=dataset, region=region)
+    # print('COND_DICT ({})'.format(current_phase), cond_dict)
+    # print('PHASE FLAG', phase_flag)
+    if np.any(np.isnan(list(cond_dict.values()))):
+        # We don't actually know the phase composition here, so we estimate it
+        with timer('calculate', **labels):
+            single_eqdata = calculate(dbf, comps, [current_phase],
+                                      T=cond_dict[v.T], P=cond_dict[v.P],
+                                      model=phase_models, callables=phase_obj_callables, parameters=parameters)
+        # print('SINGLE_EQDATA (UNKNOWN COMP)', single_eqdata)
+        driving_force = np.multiply(region_chemical_potentials,
+                                    single_eqdata['X'].values).sum(axis=-1) - single_eqdata['GM'].values
+        desired_sitefracs = single_eqdata['Y'].values[..., np.argmax(driving_force), :]
+        error = float(driving_force.max())
+    elif phase_flag == 'disordered':
+        # Construct disordered sublattice configuration from composition dict
+        # Compute energy
+        # Compute residual driving force
+        # TODO: Check that it actually makes sense to declare this phase 'disordered'
+        num_dof = sum([len(set(c).intersection(comps)) for c in dbf.phases[current_phase].constituents])
+        desired_sitefracs = np.ones(num_dof, dtype=np.float)
+        dof_idx = 0
+        for c in dbf.phases[current_phase].constituents:
+            dof = sorted(set(c).intersection(comps))
+            # print('DOF', dof)
+            if (len(dof) == 1) and (dof[0] == 'VA'):
+                return 0
+            # If it's disordered config of BCC_B2 with VA, disordered config is tiny vacancy count
+            sitefracs_to_add = np.array([cond_dict.get(v.X(d)) for d in dof],
+                                        dtype=np.float)
+            # Fix composition of dependent component
+            sitefracs_to_add[np.isnan(sitefracs_to_add)] = 1 - np.nansum(sitefracs_to_add)
+            desired_sitefracs[dof_idx:dof_idx + len(dof)] = sitefracs_to_add
+            dof_idx += len(dof)
+        # print('DISORDERED SITEFRACS', desired_sitefracs)
+        with timer('calculate', **labels):
+            single_eqdata = calculate(dbf, comps, [current_phase],
+                                      T=cond_dict[v.T], P=cond_dict[v.P], points=desired_sitefracs,
+                                      model=phase_models, callables=phase_obj_callables, parameters=parameters)
+        driving_force = np.multiply(region_chemical_potentials,
+                                    single_eqdata['X'].values).sum(axis=-1) - single_eqdata['GM'].values
+        error = float(np.squeeze(driving_force))
+    else:
+        # Extract energies from single-phase calculations
+        with timer('equilibrium', **labels) as eq_timer:
+            single_eqdata = equilibrium(dbf, comps, [current_phase], cond_dict, pbar=False, verbose=False,
+                                        callables=phase_obj_callables, grad_callables=phase_grad_callables,
+                                        hess_callables=phase_hess_callables, model=phase_models,
+                                        scheduler=dask.async.get_sync, parameters=parameters)
+            eq_timer.failed = bool(np.all(np.isnan(single_eqdata['NP'].values)))
+        if eq_timer.failed:
+            error_time = time.time()
+            template_error = """
+            from pycalphad import Database, equilibrium
+            from pycalphad.variables import T, P, X
+            import dask
+            dbf_string = \"\"\"
+            {0}
+            \"\"\"
+            dbf = Database(dbf_string)
+            comps = {1}
+            phases = {2}
+            cond_dict = {3}
+            parameters = {4}
+            equilibrium(dbf, comps, phases, cond_dict, scheduler=dask.async.get_sync, parameters=parameters)
+            """
+            template_error = textwrap.dedent(template_error)
+            print('Dumping', 'error-'+str(error_time)+'.py')
+            with open('error-'+str(error_time)+'.py', 'w') as f:
+                f.write(template_error.format(dbf.to_string(fmt='tdb'), comps, [current_phase], cond_dict, {key: float(x) for key, x in parameters.items()}))
+        # print('SINGLE_EQDATA', single_eqdata)
+        # Sometimes we can get a miscibility gap in our "single-phase" calculation
+        # Choose the weighted mixture of site fractions
+        # print('Y FRACTIONS', single_eqdata['Y'].values)
+        if np.all(np.isnan(single_eqdata['NP'].values)):
+            print('Dropping condition due to calculation failure: ', cond_dict)
+            return 0
+        phases_idx = np.nonzero(~np.isnan(np.squeeze(single_eqdata['NP'].values)))
+        cur_vertex = np.nanargmax(np.squeeze(single_eqdata['NP'].values))
+        # desired_sitefracs = np.multiply(single_eqdata['NP'].values[..., phases_idx, np.newaxis],
+        #                                single_eqdata['Y'].values[..., phases_idx, :]).sum(axis=-2)
+        desired_sitefracs = single_eqdata['Y'].values[..., cur_vertex, :]
+        select_energy = float(single_eqdata['GM'].values)
+        region_comps = []
+        for comp in [c for c in sorted(comps) if c != 'VA']:
+            region_comps.append(cond_dict.get(v.X(comp), np.nan))
+        region_comps[region_comps.index(np.nan)] = 1 - np.nansum(region_comps)
+        # print('REGION_COMPS', region_comps)
+        error = np.multiply(region_chemical_potentials, region_comps).sum() - select_energy
+        error = float(error)
+    return error
+
+
+def _worker_rss():
+    "Resident set size of the current worker process, in bytes. Run with Client.run."
+    import psutil
+    return psutil.Process(os.getpid()).memory_info().rss